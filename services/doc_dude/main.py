@@ -8,33 +8,51 @@
 from __future__ import annotations
 
 import asyncio
+import bisect
+import gzip
+import hashlib
 import io
 import json
 import logging
 import os
+import random
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
 import time
 import uuid
+import zipfile
+from collections import deque
 from contextlib import contextmanager
 from contextvars import ContextVar
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, BinaryIO, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import cv2
 import httpx
 import numpy as np
 from docx import Document
 from fastapi import FastAPI, File, Form, HTTPException, Request, Response, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 from openvino.runtime import Core
 from pdf2image import convert_from_bytes
 
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+from starlette.background import BackgroundTask
 from starlette.middleware.base import BaseHTTPMiddleware
-from prometheus_client import CONTENT_TYPE_LATEST, Counter as PromCounter, Histogram, generate_latest
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter as PromCounter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
 
 # ---------------------------------------------------------------------------
 # Logging utilities
@@ -164,9 +182,80 @@ SUPER_MEMORY_CONTAINER_TAGS = [
 ]
 SUPER_MEMORY_TIMEOUT = float(os.getenv("SUPER_MEMORY_TIMEOUT", "20"))
 SUPER_MEMORY_CHUNK_THRESHOLD = float(os.getenv("SUPER_MEMORY_CHUNK_THRESHOLD", "0.4"))
+SUPER_MEMORY_HTTP2 = os.getenv("SUPER_MEMORY_HTTP2", "1").strip().lower() not in {"0", "false", "off"}
+SUPER_MEMORY_MAX_CONNECTIONS = int(os.getenv("SUPER_MEMORY_MAX_CONNECTIONS", "20"))
+SUPER_MEMORY_MAX_KEEPALIVE = int(os.getenv("SUPER_MEMORY_MAX_KEEPALIVE", "10"))
+SUPER_MEMORY_KEEPALIVE_EXPIRY = float(os.getenv("SUPER_MEMORY_KEEPALIVE_EXPIRY", "30"))
+SUPER_MEMORY_MAX_RETRIES = int(os.getenv("SUPER_MEMORY_MAX_RETRIES", "3"))
+SUPER_MEMORY_RETRY_BASE_DELAY = float(os.getenv("SUPER_MEMORY_RETRY_BASE_DELAY", "0.25"))
+SUPER_MEMORY_RETRY_MAX_DELAY = float(os.getenv("SUPER_MEMORY_RETRY_MAX_DELAY", "4"))
+# เอกสารใหญ่ถูกแบ่งเป็นหลาย part ต่อ POST เพื่อไม่ให้ชน request-size limit
+SUPER_MEMORY_PART_MAX_CHARS = int(os.getenv("SUPER_MEMORY_PART_MAX_CHARS", "50000"))
+SUPER_MEMORY_INGEST_CONCURRENCY = int(os.getenv("SUPER_MEMORY_INGEST_CONCURRENCY", "4"))
+# /ready ตอบจากผลที่ cache ไว้ โดยมี task เบื้องหลังรีเฟรชทุก READY_REFRESH_SECONDS
+READY_REFRESH_SECONDS = float(os.getenv("READY_REFRESH_SECONDS", "15"))
+READY_CACHE_TTL_SECONDS = float(os.getenv("READY_CACHE_TTL_SECONDS", "60"))
+WEBHOOK_OUTBOX_PATH = Path(os.getenv("WEBHOOK_OUTBOX_PATH", "/data/outbox/webhooks.db"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "20"))
+WEBHOOK_POLL_SECONDS = float(os.getenv("WEBHOOK_POLL_SECONDS", "5"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "12"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "5"))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.getenv("WEBHOOK_RETRY_MAX_SECONDS", "900"))
+# hedged query: ยิง Chroma คู่ขนานเมื่อ Supermemory ช้ากว่า p95 (auto = เปิดเมื่อ RAG_PROVIDER=auto)
+RAG_HEDGE_MODE = os.getenv("RAG_HEDGE", "auto").strip().lower()
+RAG_HEDGE_PERCENTILE = float(os.getenv("RAG_HEDGE_PERCENTILE", "95"))
+RAG_HEDGE_WINDOW = int(os.getenv("RAG_HEDGE_WINDOW", "200"))
+RAG_HEDGE_MIN_SAMPLES = int(os.getenv("RAG_HEDGE_MIN_SAMPLES", "20"))
+RAG_HEDGE_MIN_DELAY_MS = float(os.getenv("RAG_HEDGE_MIN_DELAY_MS", "150"))
+RAG_HEDGE_MAX_DELAY_MS = float(os.getenv("RAG_HEDGE_MAX_DELAY_MS", "2000"))
 TRACE_DB_PATH = Path(os.getenv("TRACE_DB_PATH", "/data/telemetry/traces.db"))
+TRACE_QUEUE_MAX = int(os.getenv("TRACE_QUEUE_MAX", "10000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "200"))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "1.0"))
+TRACE_STATS_WINDOWS = os.getenv("TRACE_STATS_WINDOWS", "15m,1h,24h")
+# raw trace ที่เก่ากว่า retention จะถูก rollup รายนาที + archive เป็นไฟล์รายวันแล้วลบออก (<= 0 = เก็บตลอด)
+TRACE_RETENTION_DAYS = float(os.getenv("TRACE_RETENTION_DAYS", "14"))
+TRACE_RETENTION_BY_EVENT = {
+    name.strip(): float(days)
+    for name, _, days in (
+        entry.partition("=") for entry in os.getenv("TRACE_RETENTION_BY_EVENT", "").split(",")
+    )
+    if name.strip() and days.strip()
+}
+TRACE_ARCHIVE_DIR = Path(os.getenv("TRACE_ARCHIVE_DIR", str(TRACE_DB_PATH.parent / "archive")))
+TRACE_COMPACT_INTERVAL_SECONDS = float(os.getenv("TRACE_COMPACT_INTERVAL_SECONDS", "3600"))
+TRACE_VACUUM_PAGES = int(os.getenv("TRACE_VACUUM_PAGES", "2000"))
+# แปลงไฟล์ trace เดิมเป็น auto_vacuum=INCREMENTAL ต้อง VACUUM ทั้งไฟล์ (ล็อก DB ระหว่างทำ) จึงต้องเปิดเอง
+TRACE_VACUUM_CONVERT = os.getenv("TRACE_VACUUM_CONVERT", "0").strip().lower() in {"1", "true", "on"}
+TRACE_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+EMBED_CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", "/data/cache/embed_cache.db"))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "200000"))
+# 0 = ใช้ max_seq_length ของ embedder
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "16"))
+# เก็บข้อความรายหน้าไว้ข้างไฟล์ต้นฉบับ เพื่อ re-embed ได้โดยไม่ต้อง OCR ใหม่
+DOC_STORE_PATH = Path(os.getenv("DOC_STORE_PATH", str(UPLOAD_DIR / "document_store.db")))
+EMBED_MIGRATION_AUTO = os.getenv("EMBED_MIGRATION_AUTO", "1").strip().lower() not in {"0", "false", "off"}
+EMBED_MIGRATION_BATCH_DOCS = int(os.getenv("EMBED_MIGRATION_BATCH_DOCS", "4"))
+EMBED_MIGRATION_PAUSE_SECONDS = float(os.getenv("EMBED_MIGRATION_PAUSE_SECONDS", "1.0"))
+# รอให้ query ที่ resolve physical เดิมไปแล้วทำงานจบ ก่อนลบ collection เก่าหลังสลับ
+EMBED_MIGRATION_DROP_GRACE_SECONDS = float(os.getenv("EMBED_MIGRATION_DROP_GRACE_SECONDS", "60"))
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", "/data/snapshots"))
+SNAPSHOT_BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", "5000"))
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "flat").strip().lower()
+RETRIEVAL_PAGE_CANDIDATES = int(os.getenv("RETRIEVAL_PAGE_CANDIDATES", "8"))
+CHUNK_DEDUP_ENABLED = os.getenv("CHUNK_DEDUP_ENABLED", "1").strip().lower() not in {"0", "false", "off"}
+CHUNK_DEDUP_DB_PATH = Path(os.getenv("CHUNK_DEDUP_DB_PATH", "/data/cache/chunk_fingerprints.db"))
+# ค่า Jaccard ขั้นต่ำ (ประมาณจาก MinHash) ที่ถือว่าเป็น chunk ซ้ำ
+CHUNK_DEDUP_THRESHOLD = float(os.getenv("CHUNK_DEDUP_THRESHOLD", "0.85"))
+CHUNK_DEDUP_MIN_CHARS = int(os.getenv("CHUNK_DEDUP_MIN_CHARS", "24"))
 
 TRACE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+EMBED_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+CHUNK_DEDUP_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+DOC_STORE_PATH.parent.mkdir(parents=True, exist_ok=True)
+SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+WEBHOOK_OUTBOX_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 LOG_DIR.mkdir(parents=True, exist_ok=True)
@@ -182,6 +271,8 @@ app.add_middleware(CorrelationIdLoggingMiddleware, logger=logger)
 # ---------------------------------------------------------------------------
 
 RAG_BACKEND = "chroma"
+# True เมื่อ backend หลักเป็น Supermemory และต้องเขียน/ค้น Chroma ควบคู่เพื่อ hedge
+RAG_HEDGE_ACTIVE = False
 DEFAULT_SUPERMEMORY_TAG = "sm_project_default"
 
 
@@ -204,6 +295,55 @@ RAG_RESULTS_COUNTER = PromCounter(
     "สถิติผลลัพธ์ RAG (hit/miss)",
     ["provider", "collection", "result"],
 )
+TRACE_WRITTEN_COUNTER = PromCounter(
+    "doc_dude_traces_written_total",
+    "จำนวน trace ที่เขียนลง SQLite แล้ว",
+)
+TRACE_DROPPED_COUNTER = PromCounter(
+    "doc_dude_traces_dropped_total",
+    "จำนวน trace ที่ถูกทิ้ง (คิวเต็ม/เขียนไม่สำเร็จ)",
+    ["reason"],
+)
+DEDUP_COUNTER = PromCounter(
+    "doc_dude_chunk_dedup_total",
+    "จำนวน chunk ที่ผ่าน/ถูกตัดทิ้งจากการตรวจ near-duplicate",
+    ["collection", "result"],
+)
+EMBED_MIGRATION_COUNTER = PromCounter(
+    "doc_dude_embed_migrations_total",
+    "จำนวนงานย้าย embedding ตามสถานะ",
+    ["status"],
+)
+EMBED_CACHE_COUNTER = PromCounter(
+    "doc_dude_embed_cache_total",
+    "สถิติการใช้ cache ของ embedding ราย chunk (hit/miss)",
+    ["result"],
+)
+SUPERMEMORY_LATENCY = Histogram(
+    "doc_dude_supermemory_request_seconds",
+    "ระยะเวลาต่อครั้งของการเรียก Supermemory แยกตาม endpoint",
+    ["endpoint", "status"],
+)
+SUPERMEMORY_RETRY_COUNTER = PromCounter(
+    "doc_dude_supermemory_retries_total",
+    "จำนวนครั้งที่ retry การเรียก Supermemory",
+    ["endpoint", "reason"],
+)
+WEBHOOK_DELIVERY_COUNTER = PromCounter(
+    "doc_dude_webhook_deliveries_total",
+    "ผลการส่ง webhook หลัง ingest จาก outbox",
+    ["result"],
+)
+WEBHOOK_OUTBOX_BACKLOG = Gauge(
+    "doc_dude_webhook_outbox_backlog",
+    "จำนวน webhook ที่ค้างส่งใน outbox แยกตามสถานะ",
+    ["status"],
+)
+HEDGE_COUNTER = PromCounter(
+    "doc_dude_rag_hedge_total",
+    "ผลของ hedged query ระหว่าง Supermemory และ Chroma",
+    ["outcome"],
+)
 
 
 def get_correlation_id() -> Optional[str]:
@@ -224,6 +364,21 @@ CREATE TABLE IF NOT EXISTS traces (
     latency_ms REAL,
     provider TEXT
 );
+CREATE INDEX IF NOT EXISTS idx_traces_created_at ON traces (created_at);
+CREATE INDEX IF NOT EXISTS idx_traces_event_created ON traces (event_type, created_at);
+CREATE INDEX IF NOT EXISTS idx_traces_provider_created ON traces (provider, created_at);
+CREATE INDEX IF NOT EXISTS idx_traces_request_id ON traces (request_id);
+CREATE TABLE IF NOT EXISTS trace_rollups (
+    minute TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    latency_sum_ms REAL NOT NULL,
+    latency_max_ms REAL NOT NULL,
+    histogram TEXT NOT NULL,
+    PRIMARY KEY (minute, event_type, provider, status)
+);
 """
 
 
@@ -238,11 +393,124 @@ def trace_connection() -> Any:
 
 def init_trace_db() -> None:
     with trace_connection() as conn:
-        conn.execute(TRACE_SCHEMA)
+        # มีผลทันทีกับไฟล์ใหม่ ไฟล์เดิมจะถูกแปลงใน trace_compactor เมื่อเปิด TRACE_VACUUM_CONVERT
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(TRACE_SCHEMA)
         conn.commit()
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if not incremental and not TRACE_VACUUM_CONVERT:
+        logger.warning(
+            "trace_db_not_incremental",
+            extra={"fields": {"path": str(TRACE_DB_PATH), "hint": "TRACE_VACUUM_CONVERT=1"}},
+        )
+
+
+TRACE_INSERT_SQL = """
+INSERT INTO traces
+(created_at, event_type, request_id, payload, response, latency_ms, provider)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+_TRACE_STOP = object()
+
+
+class TraceWriter:
+    """เขียน trace แบบ batch ผ่านคิวในหน่วยความจำ
+
+    ใช้ connection เดียว (WAL) ตลอดอายุ process และ commit ด้วย executemany
+    เมื่อครบ batch หรือครบเวลา ถ้าคิวเต็มจะทิ้ง trace และนับไว้ใน metric
+    """
+
+    def __init__(self, path: Path, insert_sql: str) -> None:
+        self._path = path
+        self._insert_sql = insert_sql
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(TRACE_QUEUE_MAX, 1))
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _open(self) -> None:
+        # connection ถูกใช้จาก thread pool ทีละ batch จึงปิด check_same_thread ได้
+        conn = sqlite3.connect(self._path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn = conn
+
+    async def start(self) -> None:
+        if self._task is None:
+            await asyncio.to_thread(self._open)
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, record: tuple) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            TRACE_DROPPED_COUNTER.labels(reason="queue_full").inc()
+
+    async def stop(self) -> None:
+        """ส่งสัญญาณหยุด แล้วรอให้ flush trace ที่ค้างในคิวจนหมดก่อนปิด connection"""
+        if self._task is None:
+            return
+        await self._queue.put(_TRACE_STOP)
+        await self._task
+        self._task = None
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    def _write_batch(self, batch: List[tuple]) -> None:
+        try:
+            self._conn.executemany(self._insert_sql, batch)
+            self._conn.commit()
+        except sqlite3.Error as exc:
+            TRACE_DROPPED_COUNTER.labels(reason="write_error").inc(len(batch))
+            logger.warning(
+                "trace_batch_failed",
+                extra={"fields": {"rows": len(batch), "error": str(exc)}},
+            )
+            return
+        TRACE_WRITTEN_COUNTER.inc(len(batch))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is _TRACE_STOP:
+                break
+            batch = [record]
+            deadline = loop.time() + TRACE_FLUSH_SECONDS
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    record = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if record is _TRACE_STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as exc:
+                # writer ต้องไม่ตาย ไม่อย่างนั้นคิวจะเต็มและ trace ถัดไปถูกทิ้งทั้งหมด
+                TRACE_DROPPED_COUNTER.labels(reason="write_error").inc(len(batch))
+                logger.exception(
+                    "trace_writer_failed",
+                    extra={"fields": {"rows": len(batch), "error": str(exc)}},
+                )
+
+
+trace_writer = TraceWriter(TRACE_DB_PATH, TRACE_INSERT_SQL)
 
 
-def _write_trace(
+async def record_trace(
     event_type: str,
     request_id: Optional[str],
     payload: Dict[str, Any],
@@ -250,38 +518,354 @@ def _write_trace(
     latency_ms: float,
     provider: str,
 ) -> None:
-    record = (
-        datetime.utcnow().isoformat(timespec="milliseconds"),
-        event_type,
-        request_id,
-        json.dumps(payload, ensure_ascii=False),
-        json.dumps(response_payload, ensure_ascii=False),
-        float(latency_ms),
-        provider,
+    trace_writer.submit(
+        (
+            datetime.utcnow().isoformat(timespec="milliseconds"),
+            event_type,
+            request_id,
+            json.dumps(payload, ensure_ascii=False),
+            json.dumps(response_payload, ensure_ascii=False),
+            float(latency_ms),
+            provider,
+        )
     )
+
+
+# มิติที่ใช้แยกสถิติ latency ใน /traces/stats
+TRACE_STATS_DIMENSIONS = ("event_type", "provider")
+TRACE_ROLLUP_DIMENSION = "provider"
+TRACE_QUERY_MAX_LIMIT = 1000
+TRACE_DURATION_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+TRACE_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_trace_duration(value: str) -> timedelta:
+    match = TRACE_DURATION_PATTERN.match(value.strip().lower())
+    if not match:
+        raise HTTPException(status_code=400, detail=f"ช่วงเวลาไม่ถูกต้อง: {value} (เช่น 15m, 1h, 7d)")
+    return timedelta(seconds=float(match.group(1)) * TRACE_DURATION_UNITS[match.group(2)])
+
+
+def parse_trace_time(value: Optional[str]) -> Optional[str]:
+    """รับเวลาแบบ ISO-8601 หรือแบบย้อนหลัง (เช่น 1h) แล้วแปลงเป็นรูปแบบเดียวกับ created_at (UTC)"""
+    if not value:
+        return None
+    if TRACE_DURATION_PATTERN.match(value.strip().lower()):
+        moment = datetime.utcnow() - parse_trace_duration(value)
+    else:
+        try:
+            moment = datetime.fromisoformat(value.strip())
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=f"รูปแบบเวลาไม่ถูกต้อง: {value}") from exc
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.isoformat(timespec="milliseconds")
+
+
+def latency_percentiles(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    last = len(ordered) - 1
+
+    def pick(quantile: float) -> float:
+        rank = quantile * last
+        low = int(rank)
+        high = min(low + 1, last)
+        return round(ordered[low] + (ordered[high] - ordered[low]) * (rank - low), 2)
+
+    return {
+        "count": len(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 2),
+    }
+
+
+def _trace_row(row: sqlite3.Row) -> Dict[str, Any]:
+    record = dict(row)
+    for key in ("payload", "response"):
+        try:
+            record[key] = json.loads(record[key]) if record[key] else None
+        except ValueError:
+            pass
+    return record
+
+
+def _trace_conditions(
+    filters: Dict[str, Optional[str]], since: Optional[str], until: Optional[str]
+) -> Tuple[str, List[Any]]:
+    clauses: List[str] = []
+    params: List[Any] = []
+    for column, value in filters.items():
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if since:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until:
+        clauses.append("created_at < ?")
+        params.append(until)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def query_traces(
+    filters: Dict[str, Optional[str]],
+    since: Optional[str],
+    until: Optional[str],
+    limit: int,
+    before_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    where, params = _trace_conditions(filters, since, until)
+    if before_id is not None:
+        where += (" AND " if where else " WHERE ") + "id < ?"
+        params.append(before_id)
     with trace_connection() as conn:
-        conn.execute(
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            f"SELECT * FROM traces{where} ORDER BY id DESC LIMIT ?", [*params, limit]
+        ).fetchall()
+    return [_trace_row(row) for row in rows]
+
+
+def trace_latency_stats(
+    filters: Dict[str, Optional[str]], since: str, until: Optional[str]
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    where, params = _trace_conditions(filters, since, until)
+    columns = ", ".join(TRACE_STATS_DIMENSIONS)
+    with trace_connection() as conn:
+        rows = conn.execute(
+            f"SELECT {columns}, latency_ms FROM traces{where}"
+            f"{' AND' if where else ' WHERE'} latency_ms IS NOT NULL",
+            params,
+        ).fetchall()
+        rollups = _trace_rollup_rows(conn, filters, since, until)
+    stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for position, dimension in enumerate(TRACE_STATS_DIMENSIONS):
+        groups: Dict[str, List[float]] = {}
+        for row in rows:
+            groups.setdefault(row[position] or "unknown", []).append(float(row[-1]))
+        rolled: Dict[str, List[Tuple[float, int]]] = {}
+        for row in rollups:
+            rolled.setdefault(row[position] or "unknown", []).extend(_rollup_samples(row))
+        stats[f"by_{dimension}"] = {
+            key: (
+                weighted_latency_percentiles(
+                    [(value, 1) for value in groups.get(key, [])] + rolled[key]
+                )
+                if rolled.get(key)
+                else latency_percentiles(groups[key])
+            )
+            for key in sorted({*groups, *(key for key, samples in rolled.items() if samples)})
+        }
+    return stats
+
+
+def _trace_rollup_rows(
+    conn: sqlite3.Connection, filters: Dict[str, Optional[str]], since: str, until: Optional[str]
+) -> List[tuple]:
+    """แถวของ trace_rollups ในช่วงเวลา (นาทีที่ถูก compact ไปแล้วจะไม่มี raw trace เหลือ)"""
+    columns = (*TRACE_STATS_DIMENSIONS, "latency_max_ms", "histogram")
+    if any(value for key, value in filters.items() if key not in TRACE_STATS_DIMENSIONS):
+        return []
+    clauses = ["minute >= ?"]
+    params: List[Any] = [since[:16]]
+    if until:
+        clauses.append("minute < ?")
+        params.append(until)
+    for column, value in filters.items():
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    return conn.execute(
+        f"SELECT {', '.join(columns)} FROM trace_rollups WHERE {' AND '.join(clauses)}", params
+    ).fetchall()
+
+
+def _rollup_samples(row: tuple) -> List[Tuple[float, int]]:
+    # ใช้ขอบบนของ bucket เป็นตัวแทน (bucket สุดท้ายและค่าที่เกิน max ใช้ latency_max_ms)
+    latency_max = float(row[-2])
+    bounds = [*TRACE_ROLLUP_BUCKETS_MS, latency_max]
+    return [
+        (min(float(bound), latency_max), int(count))
+        for bound, count in zip(bounds, json.loads(row[-1]))
+        if count
+    ]
+
+
+def weighted_latency_percentiles(samples: List[Tuple[float, int]]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    total = sum(weight for _, weight in ordered)
+
+    def pick(quantile: float) -> float:
+        target = quantile * total
+        seen = 0
+        for value, weight in ordered:
+            seen += weight
+            if seen >= target:
+                return round(value, 2)
+        return round(ordered[-1][0], 2)
+
+    return {
+        "count": total,
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1][0], 2),
+    }
+
+
+# ขอบบนของ bucket (ms) ใน histogram ของ trace_rollups; bucket สุดท้ายคือค่าที่เกินขอบบนสุด
+TRACE_ROLLUP_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def trace_retention_days(event_type: str) -> float:
+    return TRACE_RETENTION_BY_EVENT.get(event_type, TRACE_RETENTION_DAYS)
+
+
+def _trace_cutoff(event_type: str, now: datetime) -> Optional[str]:
+    days = trace_retention_days(event_type)
+    if days <= 0:
+        return None
+    # ปัดลงเป็นต้นนาที เพื่อให้แต่ละนาทีถูก rollup ครั้งเดียวครบทั้งนาที
+    cutoff = (now - timedelta(days=days)).replace(second=0, microsecond=0)
+    return cutoff.isoformat(timespec="milliseconds")
+
+
+def _rollup_trace_rows(rows: List[sqlite3.Row]) -> List[tuple]:
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    for row in rows:
+        try:
+            status = (json.loads(row["response"] or "{}") or {}).get("status") or "unknown"
+        except (ValueError, AttributeError):
+            status = "unknown"
+        key = (
+            row["created_at"][:16],
+            row["event_type"],
+            row[TRACE_ROLLUP_DIMENSION] or "",
+            str(status),
+        )
+        group = groups.setdefault(
+            key,
+            {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(TRACE_ROLLUP_BUCKETS_MS) + 1)},
+        )
+        latency = float(row["latency_ms"] or 0.0)
+        group["count"] += 1
+        group["sum"] += latency
+        group["max"] = max(group["max"], latency)
+        group["buckets"][bisect.bisect_left(TRACE_ROLLUP_BUCKETS_MS, latency)] += 1
+    return [
+        (*key, group["count"], round(group["sum"], 3), group["max"], json.dumps(group["buckets"]))
+        for key, group in groups.items()
+    ]
+
+
+def _archive_trace_rows(event_type: str, day: str, rows: List[sqlite3.Row]) -> Path:
+    # ชื่อไฟล์ผูกกับช่วง id ของแถว ถ้า commit ล้มแล้วรอบถัดไปหยิบแถวชุดเดิม จะเขียนทับไฟล์เดิมแทนการต่อซ้ำ
+    safe_event = re.sub(r"[^A-Za-z0-9_.-]", "_", event_type)
+    path = TRACE_ARCHIVE_DIR / (
+        f"{TRACE_DB_PATH.stem}-{day}-{safe_event}-{rows[0]['id']}-{rows[-1]['id']}.jsonl.gz"
+    )
+    partial = path.with_name(f".{path.name}.tmp")
+    with gzip.open(partial, "wt", encoding="utf-8") as handle:
+        for row in rows:
+            handle.write(json.dumps(dict(row), ensure_ascii=False) + "\n")
+    os.replace(partial, path)
+    return path
+
+
+def _compact_trace_day(event_type: str, cutoff: str) -> int:
+    """rollup + archive + ลบ raw trace ของ event_type นี้ทีละวัน (วันเก่าสุดที่เลย cutoff) คืนจำนวนแถวที่ลบ"""
+    with trace_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM traces WHERE event_type = ? AND created_at < ?",
+            (event_type, cutoff),
+        ).fetchone()[0]
+        if oldest is None:
+            return 0
+        day = oldest[:10]
+        next_day = datetime.fromisoformat(day) + timedelta(days=1)
+        upper = min(next_day.isoformat(timespec="milliseconds"), cutoff)
+        rows = conn.execute(
             """
-            INSERT INTO traces
-            (created_at, event_type, request_id, payload, response, latency_ms, provider)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            SELECT * FROM traces WHERE event_type = ? AND created_at >= ? AND created_at < ?
+            ORDER BY id
+            """,
+            (event_type, oldest, upper),
+        ).fetchall()
+        _archive_trace_rows(event_type, day, rows)
+        conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO trace_rollups
+            (minute, event_type, {TRACE_ROLLUP_DIMENSION}, status, count, latency_sum_ms,
+             latency_max_ms, histogram)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            record,
+            _rollup_trace_rows(rows),
+        )
+        conn.execute(
+            "DELETE FROM traces WHERE event_type = ? AND created_at >= ? AND created_at < ?",
+            (event_type, oldest, upper),
         )
         conn.commit()
+    return len(rows)
 
 
-async def record_trace(
-    event_type: str,
-    request_id: Optional[str],
-    payload: Dict[str, Any],
-    response_payload: Dict[str, Any],
-    latency_ms: float,
-    provider: str,
-) -> None:
-    await asyncio.to_thread(
-        _write_trace, event_type, request_id, payload, response_payload, latency_ms, provider
-    )
+def _trace_event_types() -> List[str]:
+    with trace_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT DISTINCT event_type FROM traces").fetchall()]
+
+
+def _convert_trace_auto_vacuum() -> bool:
+    with trace_connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    return True
+
+
+def _incremental_vacuum() -> None:
+    with trace_connection() as conn:
+        conn.execute(f"PRAGMA incremental_vacuum({max(TRACE_VACUUM_PAGES, 1)})")
+        conn.commit()
+
+
+async def compact_traces() -> Dict[str, int]:
+    now = datetime.utcnow()
+    compacted: Dict[str, int] = {}
+    for event_type in await asyncio.to_thread(_trace_event_types):
+        cutoff = _trace_cutoff(event_type, now)
+        if cutoff is None:
+            continue
+        while True:
+            removed = await asyncio.to_thread(_compact_trace_day, event_type, cutoff)
+            if not removed:
+                break
+            compacted[event_type] = compacted.get(event_type, 0) + removed
+    if compacted:
+        await asyncio.to_thread(_incremental_vacuum)
+        logger.info("traces_compacted", extra={"fields": {"rows": compacted}})
+    return compacted
+
+
+async def trace_compactor() -> None:
+    if TRACE_VACUUM_CONVERT:
+        try:
+            if await asyncio.to_thread(_convert_trace_auto_vacuum):
+                logger.info("trace_db_converted", extra={"fields": {"auto_vacuum": "incremental"}})
+        except sqlite3.Error as exc:
+            logger.warning("trace_db_convert_failed", extra={"fields": {"error": str(exc)}})
+    while True:
+        try:
+            await compact_traces()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pragma: no cover - ไม่ให้ loop ตาย
+            logger.warning("trace_compaction_failed", extra={"fields": {"error": str(exc)}})
+        await asyncio.sleep(TRACE_COMPACT_INTERVAL_SECONDS)
+
 
 
 # ---------------------------------------------------------------------------
@@ -326,11 +910,100 @@ def supermemory_container_tags(collection: Optional[str]) -> List[str]:
     return [seen.setdefault(tag, None) or tag for tag in tags if tag not in seen]
 
 
+SUPERMEMORY_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# timeout ระหว่างอ่าน/เขียนใช้เวลาไปเต็ม budget แล้ว ไม่ retry ซ้ำ
+SUPERMEMORY_NON_RETRYABLE_ERRORS = (httpx.ReadTimeout, httpx.WriteTimeout, httpx.PoolTimeout)
+
+_supermemory_client: Optional[httpx.AsyncClient] = None
+
+
+def get_supermemory_client() -> httpx.AsyncClient:
+    global _supermemory_client
+    if _supermemory_client is None:
+        _supermemory_client = httpx.AsyncClient(
+            http2=SUPER_MEMORY_HTTP2,
+            timeout=httpx.Timeout(SUPER_MEMORY_TIMEOUT, connect=min(SUPER_MEMORY_TIMEOUT, 5.0)),
+            limits=httpx.Limits(
+                max_connections=SUPER_MEMORY_MAX_CONNECTIONS,
+                max_keepalive_connections=SUPER_MEMORY_MAX_KEEPALIVE,
+                keepalive_expiry=SUPER_MEMORY_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _supermemory_client
+
+
+async def close_supermemory_client() -> None:
+    global _supermemory_client
+    if _supermemory_client is not None:
+        await _supermemory_client.aclose()
+        _supermemory_client = None
+
+
+def _supermemory_retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return min(float(retry_after), SUPER_MEMORY_RETRY_MAX_DELAY)
+    # full jitter: สุ่มระหว่าง 0 ถึงเพดานแบบ exponential เพื่อไม่ให้ทุก request retry พร้อมกัน
+    ceiling = min(SUPER_MEMORY_RETRY_MAX_DELAY, SUPER_MEMORY_RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+async def supermemory_request(
+    url: str,
+    payload: Dict[str, Any],
+    *,
+    endpoint: str,
+    headers: Dict[str, str],
+    timeout: Optional[float] = None,
+    max_retries: Optional[int] = None,
+) -> httpx.Response:
+    """POST ผ่าน client ที่ใช้ร่วมกันทั้ง process พร้อม retry แบบ jittered backoff เมื่อเจอ 429/5xx"""
+    client = get_supermemory_client()
+    request_kwargs: Dict[str, Any] = {"json": payload, "headers": headers}
+    if timeout is not None:
+        request_kwargs["timeout"] = timeout
+    retries = SUPER_MEMORY_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        response: Optional[httpx.Response] = None
+        error: Optional[httpx.TransportError] = None
+        try:
+            response = await client.post(url, **request_kwargs)
+            status = str(response.status_code)
+            retryable = response.status_code in SUPERMEMORY_RETRY_STATUSES
+        except httpx.TransportError as exc:
+            error = exc
+            status = type(exc).__name__
+            retryable = not isinstance(exc, SUPERMEMORY_NON_RETRYABLE_ERRORS)
+        SUPERMEMORY_LATENCY.labels(endpoint=endpoint, status=status).observe(
+            time.perf_counter() - started
+        )
+        if not retryable or attempt >= retries:
+            if error is not None:
+                raise SupermemoryError(f"{status}: {error}") from error
+            return response
+        delay = _supermemory_retry_delay(attempt, response)
+        SUPERMEMORY_RETRY_COUNTER.labels(endpoint=endpoint, reason=status).inc()
+        logger.warning(
+            "supermemory_retry",
+            extra={
+                "fields": {
+                    "endpoint": endpoint,
+                    "status": status,
+                    "attempt": attempt + 1,
+                    "delay_ms": round(delay * 1000, 2),
+                }
+            },
+        )
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
 async def supermemory_post(path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-    url = supermemory_endpoint(path)
-    headers = supermemory_headers()
-    async with httpx.AsyncClient(timeout=SUPER_MEMORY_TIMEOUT) as client:
-        response = await client.post(url, json=payload, headers=headers)
+    response = await supermemory_request(
+        supermemory_endpoint(path), payload, endpoint=path, headers=supermemory_headers()
+    )
     if response.status_code >= 400:
         raise SupermemoryError(
             f"{response.status_code}: {response.text[:200]}"
@@ -368,6 +1041,26 @@ async def supermemory_health_check(collection: Optional[str]) -> bool:
 
 
 async def select_rag_backend() -> None:
+    global RAG_BACKEND, RAG_HEDGE_ACTIVE
+    await _select_rag_backend()
+    RAG_HEDGE_ACTIVE = RAG_BACKEND == "supermemory" and (
+        RAG_HEDGE_MODE in {"1", "true", "on"}
+        or (RAG_HEDGE_MODE == "auto" and RAG_PROVIDER_MODE == "auto")
+    )
+    if RAG_HEDGE_ACTIVE:
+        logger.info(
+            "rag_hedge_enabled",
+            extra={
+                "fields": {
+                    "percentile": RAG_HEDGE_PERCENTILE,
+                    "min_delay_ms": RAG_HEDGE_MIN_DELAY_MS,
+                    "max_delay_ms": RAG_HEDGE_MAX_DELAY_MS,
+                }
+            },
+        )
+
+
+async def _select_rag_backend() -> None:
     global RAG_BACKEND
     if RAG_PROVIDER_MODE == "chroma":
         RAG_BACKEND = "chroma"
@@ -408,6 +1101,157 @@ async def select_rag_backend() -> None:
     )
 
 
+def plan_supermemory_parts(chunks: List[str], max_chars: int) -> List[List[int]]:
+    """จัด chunk ตามลำดับเป็นกลุ่มที่ความยาวรวมไม่เกิน max_chars (chunk เดียวที่ยาวเกินจะอยู่ part ของตัวเอง)"""
+    parts: List[List[int]] = []
+    current: List[int] = []
+    size = 0
+    for idx, chunk in enumerate(chunks):
+        extra = len(chunk) + (2 if current else 0)
+        if current and size + extra > max_chars:
+            parts.append(current)
+            current, size, extra = [], 0, len(chunk)
+        current.append(idx)
+        size += extra
+    if current:
+        parts.append(current)
+    return parts
+
+
+def supermemory_part_id(document_id: str, part: int) -> str:
+    # customId คงที่ต่อ part ทำให้การส่งซ้ำเป็นการ update เอกสารเดิมใน Supermemory
+    return f"{document_id}-p{part:03d}"
+
+
+def _save_supermemory_plan(
+    collection: str, document_id: str, parts: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+) -> None:
+    now = datetime.utcnow().isoformat(timespec="seconds")
+    with doc_store_connection() as conn:
+        conn.execute(
+            "DELETE FROM supermemory_parts WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        conn.executemany(
+            """
+            INSERT INTO supermemory_parts
+            (collection, document_id, part, custom_id, chunks, chars, status, payload, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+            """,
+            [
+                (
+                    collection,
+                    document_id,
+                    status["part"],
+                    status["custom_id"],
+                    status["chunks"],
+                    status["chars"],
+                    json.dumps(payload, ensure_ascii=False),
+                    now,
+                )
+                for status, payload in parts
+            ],
+        )
+        conn.commit()
+
+
+def _record_supermemory_part(collection: str, document_id: str, result: Dict[str, Any]) -> None:
+    ok = result["status"] == "ok"
+    with doc_store_connection() as conn:
+        # ส่งสำเร็จแล้วไม่ต้องเก็บ payload ไว้ส่งซ้ำ
+        conn.execute(
+            f"""
+            UPDATE supermemory_parts
+            SET status = ?, supermemory_id = ?, error = ?, attempts = attempts + 1, updated_at = ?
+                {", payload = NULL" if ok else ""}
+            WHERE collection = ? AND document_id = ? AND part = ?
+            """,
+            (
+                result["status"],
+                result.get("id"),
+                result.get("error"),
+                datetime.utcnow().isoformat(timespec="seconds"),
+                collection,
+                document_id,
+                result["part"],
+            ),
+        )
+        conn.commit()
+
+
+def _load_supermemory_parts(collection: str, document_id: str) -> List[Dict[str, Any]]:
+    with doc_store_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT * FROM supermemory_parts
+            WHERE collection = ? AND document_id = ? ORDER BY part
+            """,
+            (collection, document_id),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _supermemory_part_status(row: Dict[str, Any]) -> Dict[str, Any]:
+    status = {
+        "part": row["part"],
+        "custom_id": row["custom_id"],
+        "chunks": row["chunks"],
+        "chars": row["chars"],
+        "status": row["status"],
+    }
+    if row.get("supermemory_id"):
+        status["id"] = row["supermemory_id"]
+    if row.get("error") and row["status"] != "ok":
+        status["error"] = row["error"]
+    return status
+
+
+def summarize_supermemory_parts(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    uploaded = [result for result in results if result["status"] == "ok"]
+    return {
+        "id": uploaded[0].get("id") if uploaded else None,
+        "chunks_added": sum(result["chunks"] for result in uploaded),
+        "parts": results,
+        "parts_failed": len(results) - len(uploaded),
+    }
+
+
+async def upload_supermemory_parts(
+    collection: str, document_id: str, parts: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+) -> List[Dict[str, Any]]:
+    """ส่ง part ขึ้น Supermemory พร้อมกันตามเพดาน แล้วบันทึกสถานะราย part ลง document store"""
+    semaphore = asyncio.Semaphore(max(SUPER_MEMORY_INGEST_CONCURRENCY, 1))
+
+    async def upload_part(status: Dict[str, Any], payload: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                data = await supermemory_post("/documents", payload)
+            except SupermemoryError as exc:
+                logger.warning(
+                    "supermemory_part_failed",
+                    extra={"fields": {**status, "document_id": document_id, "error": str(exc)}},
+                )
+                result = {**status, "status": "failed", "error": str(exc)}
+            else:
+                result = {
+                    **status,
+                    "status": "ok",
+                    "id": data.get("id") if isinstance(data, dict) else None,
+                }
+        try:
+            await asyncio.to_thread(_record_supermemory_part, collection, document_id, result)
+        except sqlite3.Error as exc:
+            logger.warning(
+                "supermemory_part_status_failed",
+                extra={"fields": {"document_id": document_id, "error": str(exc)}},
+            )
+        return result
+
+    return list(
+        await asyncio.gather(*(upload_part(status, payload) for status, payload in parts))
+    )
+
+
 async def supermemory_ingest(
     document_id: str,
     collection: str,
@@ -425,22 +1269,68 @@ async def supermemory_ingest(
         idx = meta.get("chunk", "?")
         decorated_chunks.append(f"[page {page} chunk {idx}]\n{chunk}")
 
-    payload = {
-        "content": "\n\n".join(decorated_chunks),
-        "containerTags": supermemory_container_tags(collection),
-        "metadata": {
-            "document_id": document_id,
-            "filename": filename,
-            "chunks": len(chunks),
-            "collection": collection,
-            "file_type": file_type,
-            "ingest_ts": datetime.utcnow().isoformat(timespec="seconds"),
-            "sm_source": "dude_hawaiian",
-        },
-        "customId": document_id,
+    plan = plan_supermemory_parts(decorated_chunks, max(SUPER_MEMORY_PART_MAX_CHARS, 1))
+    ingest_ts = datetime.utcnow().isoformat(timespec="seconds")
+    parts: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+    for part, indices in enumerate(plan):
+        custom_id = supermemory_part_id(document_id, part)
+        content = "\n\n".join(decorated_chunks[i] for i in indices)
+        pages = [metadata_entries[i].get("page") for i in indices]
+        payload = {
+            "content": content,
+            "containerTags": supermemory_container_tags(collection),
+            "metadata": {
+                "document_id": document_id,
+                "filename": filename,
+                "chunks": len(indices),
+                "document_chunks": len(chunks),
+                "part": part,
+                "parts": len(plan),
+                "first_page": pages[0],
+                "last_page": pages[-1],
+                "collection": collection,
+                "file_type": file_type,
+                "ingest_ts": ingest_ts,
+                "sm_source": "dude_hawaiian",
+            },
+            "customId": custom_id,
+        }
+        status = {
+            "part": part,
+            "custom_id": custom_id,
+            "chunks": len(indices),
+            "chars": len(content),
+        }
+        parts.append((status, payload))
+
+    # เก็บแผนการแบ่ง part ไว้ก่อนส่ง เพื่อให้ /documents/{id}/supermemory/retry ส่งซ้ำเฉพาะ part ที่ล้ม
+    await asyncio.to_thread(_save_supermemory_plan, collection, document_id, parts)
+    results = await upload_supermemory_parts(collection, document_id, parts)
+    summary = summarize_supermemory_parts(results)
+    if summary["parts_failed"] == len(results):
+        raise SupermemoryError(results[0].get("error") or "ingest_failed")
+    return summary
+
+
+async def retry_supermemory_ingest(collection: str, document_id: str) -> Dict[str, Any]:
+    """ส่งซ้ำเฉพาะ part ที่ยังไม่สำเร็จ (customId เดิม จึงเป็นการ update ไม่ใช่สร้างซ้ำ)"""
+    rows = await asyncio.to_thread(_load_supermemory_parts, collection, document_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail="ไม่พบแผนการส่งเอกสารนี้ไป Supermemory")
+    pending = [
+        (
+            {key: row[key] for key in ("part", "custom_id", "chunks", "chars")},
+            json.loads(row["payload"]),
+        )
+        for row in rows
+        if row["status"] != "ok" and row["payload"]
+    ]
+    retried = {
+        result["part"]: result
+        for result in await upload_supermemory_parts(collection, document_id, pending)
     }
-
-    return await supermemory_post("/documents", payload)
+    results = [retried.get(row["part"]) or _supermemory_part_status(row) for row in rows]
+    return {**summarize_supermemory_parts(results), "parts_retried": len(pending)}
 
 
 async def supermemory_query(
@@ -626,17 +1516,25 @@ def run_ocr(image: np.ndarray) -> List[Dict[str, object]]:
 # Embedding & Chroma integration
 # ---------------------------------------------------------------------------
 
-_embedder: Optional[SentenceTransformer] = None
+_embedders: Dict[str, SentenceTransformer] = {}
+# tokenizer อย่างเดียว (ไม่โหลด weight) สำหรับตัด chunk ตอนที่ไม่มี index ในเครื่อง
+_chunk_tokenizers: Dict[str, Any] = {}
 _chroma_client: Optional[chromadb.HttpClient] = None
 _collections: Dict[str, chromadb.api.models.Collection.Collection] = {}
 
+# collection เงาที่เก็บเวกเตอร์สรุประดับหน้า (ค่าเฉลี่ยของ chunk ในหน้านั้น)
+PAGE_COLLECTION_SUFFIX = "__pages"
+RETRIEVAL_MODES = {"flat", "two_stage"}
+
 
-def get_embedder() -> SentenceTransformer:
-    global _embedder
-    if _embedder is None:
-        logger.info("loading_embedding_model", extra={"fields": {"model": EMBED_MODEL_NAME}})
-        _embedder = SentenceTransformer(EMBED_MODEL_NAME)
-    return _embedder
+def get_embedder(model_name: Optional[str] = None) -> SentenceTransformer:
+    name = model_name or EMBED_MODEL_NAME
+    embedder = _embedders.get(name)
+    if embedder is None:
+        logger.info("loading_embedding_model", extra={"fields": {"model": name}})
+        embedder = SentenceTransformer(name)
+        _embedders[name] = embedder
+    return embedder
 
 
 def get_chroma_client() -> chromadb.HttpClient:
@@ -659,98 +1557,2412 @@ def get_collection(name: str) -> chromadb.api.models.Collection.Collection:
     return collection
 
 
-def chunk_text(text: str, chunk_size: int = 650, overlap: int = 80) -> List[str]:
-    clean = "\n".join(line.strip() for line in text.splitlines() if line.strip())
-    if not clean:
-        return []
-    chunks: List[str] = []
-    start = 0
-    while start < len(clean):
-        end = min(len(clean), start + chunk_size)
-        chunk = clean[start:end]
-        chunks.append(chunk)
-        if end == len(clean):
-            break
-        start = end - overlap
-        if start < 0:
-            start = 0
-    return chunks
+def get_page_collection(name: str) -> chromadb.api.models.Collection.Collection:
+    page_name = f"{name}{PAGE_COLLECTION_SUFFIX}"
+    if page_name in _collections:
+        return _collections[page_name]
+    client = get_chroma_client()
+    collection = client.get_or_create_collection(
+        name=page_name, metadata={"hnsw:space": "cosine"}
+    )
+    _collections[page_name] = collection
+    return collection
 
 
-def format_sources(documents: List[str], metadatas: List[dict], distances: List[float]):
-    sources = []
-    for doc, meta, dist in zip(documents, metadatas, distances):
-        item = {
-            "text": doc,
-            "score": float(dist),
-            "metadata": meta,
-        }
-        sources.append(item)
-    return sources
+# แบ่งหลังเครื่องหมายจบประโยค หรือช่องว่างระหว่างข้อความภาษาไทย (ไทยใช้ช่องว่างแทนจุดจบประโยค)
+SENTENCE_BOUNDARY_PATTERN = re.compile(
+    r"(?<=[.!?;:\u2026\u3002])\s+|(?<=[\u0E00-\u0E7F])\s+(?=[\u0E00-\u0E7F])"
+)
+# เผื่อที่ให้ special token ([CLS]/[SEP]) ที่ embedder เติมเอง
+SPECIAL_TOKEN_ALLOWANCE = 2
 
 
-# ---------------------------------------------------------------------------
-# Helper utilities
-# ---------------------------------------------------------------------------
+def get_chunk_tokenizer(model_name: Optional[str] = None) -> Tuple[Any, int]:
+    """คืน (tokenizer, จำนวน token สูงสุดต่อ chunk) โดยไม่โหลด embedder ถ้าไม่ได้ใช้ index ในเครื่อง"""
+    name = model_name or EMBED_MODEL_NAME
+    embedder = _embedders.get(name)
+    if embedder is None and local_index_enabled():
+        embedder = get_embedder(name)
+    if embedder is not None:
+        return embedder.tokenizer, int(getattr(embedder, "max_seq_length", 0) or 128)
+    tokenizer = _chunk_tokenizers.get(name)
+    if tokenizer is None:
+        logger.info("loading_chunk_tokenizer", extra={"fields": {"model": name}})
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        _chunk_tokenizers[name] = tokenizer
+    return tokenizer, min(int(getattr(tokenizer, "model_max_length", 0) or 128), 512)
 
-SUPPORTED_IMAGE_TYPES = {"image/png", "image/jpeg", "image/jpg", "image/bmp", "image/webp"}
-SUPPORTED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".webp", ".pdf", ".docx"}
 
+def chunk_token_budget(model_name: Optional[str] = None) -> int:
+    limit = CHUNK_MAX_TOKENS or get_chunk_tokenizer(model_name)[1]
+    return max(limit - SPECIAL_TOKEN_ALLOWANCE, 8)
 
-def detect_file_type(filename: str, content_type: str | None) -> str:
-    ext = Path(filename or "").suffix.lower()
-    if content_type in SUPPORTED_IMAGE_TYPES or ext in {".png", ".jpg", ".jpeg", ".bmp", ".webp"}:
-        return "image"
-    if content_type == "application/pdf" or ext == ".pdf":
-        return "pdf"
-    if content_type in {"application/vnd.openxmlformats-officedocument.wordprocessingml.document"} or ext == ".docx":
-        return "docx"
-    raise HTTPException(status_code=415, detail="ไฟล์ที่อัปโหลดยังไม่รองรับ (รองรับ: png/jpg/webp/pdf/docx)")
 
+def count_tokens(tokenizer: Any, text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
 
-async def save_upload(filename: str, data: bytes) -> Path:
-    safe_name = f"{uuid.uuid4().hex}_{Path(filename).name}"
-    path = UPLOAD_DIR / safe_name
-    await asyncio.to_thread(path.write_bytes, data)
-    return path
 
+def _iter_lines(text: str | Iterable[str]) -> Iterator[str]:
+    source = io.StringIO(text) if isinstance(text, str) else text
+    for line in source:
+        for part in line.splitlines():
+            stripped = part.strip()
+            if stripped:
+                yield stripped
 
-async def convert_pdf_to_images(data: bytes) -> List[np.ndarray]:
-    pages = await asyncio.to_thread(convert_from_bytes, data, dpi=220)
-    images = [cv2.cvtColor(np.array(page), cv2.COLOR_RGB2BGR) for page in pages]
-    return images
 
+def _iter_text_units(text: str | Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """คืน (ตัวคั่นก่อนหน้า, ประโยค) โดยอ่านทีละบรรทัด ไม่สร้างสตริงก้อนใหญ่"""
+    for line in _iter_lines(text):
+        separator = "\n"
+        for sentence in SENTENCE_BOUNDARY_PATTERN.split(line):
+            sentence = sentence.strip()
+            if sentence:
+                yield separator, sentence
+                separator = " "
 
-def extract_docx_text(data: bytes) -> str:
-    document = Document(io.BytesIO(data))
-    lines = [para.text.strip() for para in document.paragraphs if para.text.strip()]
-    return "\n".join(lines)
+
+def _token_offsets(tokenizer: Any, text: str) -> Optional[List[Tuple[int, int]]]:
+    try:
+        encoded = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return list(encoded["offset_mapping"])
+    except (NotImplementedError, KeyError):
+        return None
 
 
-async def maybe_notify_supermemory(payload: dict) -> None:
-    if not SUPER_MEMORY_WEBHOOK:
+def _split_oversized(tokenizer: Any, text: str, budget: int, overlap: int = 0) -> Iterator[str]:
+    """ตัดประโยคที่ยาวเกิน budget เป็นหน้าต่าง token ที่ซ้อนกัน overlap token"""
+    step = max(budget - overlap, 1)
+    offsets = _token_offsets(tokenizer, text)
+    if offsets is None:
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        for start in range(0, len(ids), step):
+            piece = tokenizer.decode(ids[start : start + budget]).strip()
+            if piece:
+                yield piece
+            if start + budget >= len(ids):
+                break
         return
-    headers = {"Content-Type": "application/json"}
-    if SUPER_MEMORY_TOKEN:
-        headers["Authorization"] = f"Bearer {SUPER_MEMORY_TOKEN}"
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            await client.post(SUPER_MEMORY_WEBHOOK, json=payload, headers=headers)
-    except Exception as exc:  # pragma: no cover - external dependency
-        logger.warning(
-            "supermemory_webhook_failed",
-            extra={"fields": {"error": str(exc)}},
+    for start in range(0, len(offsets), step):
+        window = offsets[start : start + budget]
+        piece = text[window[0][0] : window[-1][1]].strip()
+        if piece:
+            yield piece
+        if start + budget >= len(offsets):
+            break
+
+
+def _tail_tokens(tokenizer: Any, text: str, count: int) -> str:
+    """คืนข้อความของ count token สุดท้าย (ตัดตาม offset ของ token ไม่ใช่ทั้งประโยค)"""
+    offsets = _token_offsets(tokenizer, text)
+    if offsets is None:
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        return tokenizer.decode(ids[-count:]).strip()
+    if count >= len(offsets):
+        return text
+    return text[offsets[-count][0] : offsets[-1][1]].strip()
+
+
+def chunk_text(
+    text: str | Iterable[str],
+    max_tokens: Optional[int] = None,
+    overlap_tokens: Optional[int] = None,
+    model_name: Optional[str] = None,
+) -> Iterator[str]:
+    """แบ่งข้อความเป็น chunk ตามจำนวน token ของ embedder โดยเลือกตัดที่ขอบบรรทัด/ประโยค"""
+    tokenizer = get_chunk_tokenizer(model_name)[0]
+    budget = max_tokens or chunk_token_budget(model_name)
+    overlap = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    overlap = max(min(overlap, budget // 2), 0)
+
+    buffer: List[Tuple[str, str, int]] = []
+    used = 0
+    # จำนวน unit ต้น buffer ที่ยกมาจาก chunk ก่อน (ถ้ามีแค่นี้ไม่ต้องปล่อยเป็น chunk ใหม่)
+    carried = 0
+
+    def render(units: List[Tuple[str, str, int]]) -> str:
+        parts = [units[0][1]]
+        parts.extend(separator + sentence for separator, sentence, _ in units[1:])
+        return "".join(parts)
+
+    def carry_over(units: List[Tuple[str, str, int]]) -> List[Tuple[str, str, int]]:
+        kept: List[Tuple[str, str, int]] = []
+        total = 0
+        for unit in reversed(units):
+            if total + unit[2] > overlap:
+                break
+            kept.insert(0, unit)
+            total += unit[2]
+        if not kept and overlap and units:
+            # ไม่มีประโยคไหนสั้นพอ (เช่นวลีไทยยาว) ให้ยก overlap token สุดท้ายมาแทน
+            separator, sentence, _ = units[-1]
+            tail = _tail_tokens(tokenizer, sentence, overlap)
+            if tail:
+                kept.append((separator, tail, count_tokens(tokenizer, tail)))
+        return kept
+
+    for separator, sentence in _iter_text_units(text):
+        size = count_tokens(tokenizer, sentence)
+        if size > budget:
+            if len(buffer) > carried:
+                yield render(buffer)
+            yield from _split_oversized(tokenizer, sentence, budget, overlap)
+            buffer = carry_over([(separator, sentence, size)])
+            used = sum(unit[2] for unit in buffer)
+            carried = len(buffer)
+            continue
+        if buffer and used + size > budget:
+            if len(buffer) > carried:
+                yield render(buffer)
+                buffer = carry_over(buffer)
+            used = sum(unit[2] for unit in buffer)
+            while buffer and used + size > budget:
+                used -= buffer.pop(0)[2]
+            carried = len(buffer)
+        buffer.append((separator, sentence, size))
+        used += size
+    if len(buffer) > carried:
+        yield render(buffer)
+
+
+def make_page_key(document_id: str, page: Any) -> str:
+    return f"{document_id}:{page}"
+
+
+def upsert_page_vectors(
+    collection_name: str,
+    document_id: str,
+    embeddings: np.ndarray,
+    chunks: List[str],
+    metadata: List[dict],
+) -> int:
+    groups: Dict[Any, List[int]] = {}
+    for idx, meta in enumerate(metadata):
+        groups.setdefault(meta.get("page", 1), []).append(idx)
+    if not groups:
+        return 0
+
+    ids: List[str] = []
+    vectors: List[List[float]] = []
+    page_metas: List[dict] = []
+    page_docs: List[str] = []
+    for page, indices in groups.items():
+        block = embeddings[indices].astype(np.float32)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        mean = (block / np.maximum(norms, 1e-12)).mean(axis=0)
+        mean /= max(float(np.linalg.norm(mean)), 1e-12)
+        first_meta = metadata[indices[0]]
+        ids.append(make_page_key(document_id, page))
+        vectors.append(mean.tolist())
+        page_metas.append(
+            {
+                "document_id": document_id,
+                "page": page,
+                "filename": first_meta.get("filename"),
+                "chunks": len(indices),
+            }
         )
+        page_docs.append(chunks[indices[0]][:500])
+    get_page_collection(collection_name).upsert(
+        ids=ids, embeddings=vectors, metadatas=page_metas, documents=page_docs
+    )
+    return len(ids)
 
 
-# ---------------------------------------------------------------------------
-# FastAPI routes
-# ---------------------------------------------------------------------------
+def embed_query(question: str, model_name: str) -> List[float]:
+    return get_embedder(model_name).encode([question], convert_to_numpy=True)[0].tolist()
 
-@app.on_event("startup")
-async def startup_event():
+
+def two_stage_query(
+    collection_name: str, query_vector: List[float], top_k: int, fanout: int
+) -> Optional[Tuple[List[str], List[dict], List[float], int]]:
+    """ค้นหน้าที่เกี่ยวข้องก่อน แล้วค้น chunk เฉพาะในหน้าที่ได้ (คืน None ถ้ายังไม่มีเวกเตอร์ระดับหน้า)"""
+    page_results = get_page_collection(collection_name).query(
+        query_embeddings=[query_vector],
+        n_results=max(fanout, 1),
+        include=["metadatas"],
+    )
+    page_keys = [
+        make_page_key(meta.get("document_id"), meta.get("page"))
+        for meta in (page_results.get("metadatas") or [[]])[0]
+        if meta
+    ]
+    if not page_keys:
+        return None
+    results = get_collection(collection_name).query(
+        query_embeddings=[query_vector],
+        n_results=top_k,
+        where={"page_key": {"$in": page_keys}},
+        include=["documents", "metadatas", "distances"],
+    )
+    return (
+        results.get("documents", [[]])[0],
+        results.get("metadatas", [[]])[0],
+        results.get("distances", [[]])[0],
+        len(page_keys),
+    )
+
+
+def backfill_page_coverage(collection_name: str) -> Dict[str, int]:
+    """เติม page_key และเวกเตอร์ระดับหน้าให้ chunk ที่ ingest ก่อนมี two-stage retrieval"""
+    collection = get_collection(collection_name)
+    legacy: Dict[str, None] = {}
+    offset = 0
+    while True:
+        batch = collection.get(include=["metadatas"], limit=BACKFILL_SCAN_BATCH, offset=offset)
+        ids = batch.get("ids") or []
+        if not ids:
+            break
+        for meta in batch.get("metadatas") or []:
+            document_id = (meta or {}).get("document_id")
+            if document_id and "page_key" not in meta:
+                legacy.setdefault(document_id, None)
+        offset += len(ids)
+
+    chunks_updated = 0
+    for document_id in legacy:
+        result = collection.get(
+            where={"document_id": document_id},
+            include=["documents", "metadatas", "embeddings"],
+        )
+        ids = list(result.get("ids") or [])
+        if not ids:
+            continue
+        metadatas = [
+            {**(meta or {}), "page_key": make_page_key(document_id, (meta or {}).get("page", 1))}
+            for meta in result.get("metadatas") or []
+        ]
+        collection.update(ids=ids, metadatas=metadatas)
+        upsert_page_vectors(
+            collection_name,
+            document_id,
+            np.asarray(result.get("embeddings"), dtype=np.float32),
+            list(result.get("documents") or []),
+            metadatas,
+        )
+        chunks_updated += len(ids)
+    return {"documents": len(legacy), "chunks": chunks_updated}
+
+
+def find_document_chunks(collection_name: str, document_id: str) -> Tuple[List[str], List[str]]:
+    result = get_collection(collection_name).get(
+        where={"document_id": document_id}, include=["metadatas"]
+    )
+    chunk_ids = list(result.get("ids") or [])
+    storage_paths = {
+        meta.get("storage_path")
+        for meta in result.get("metadatas") or []
+        if meta and meta.get("storage_path")
+    }
+    return chunk_ids, sorted(storage_paths)
+
+
+def delete_document_vectors(collection_name: str, document_id: str, chunk_ids: List[str]) -> None:
+    if chunk_ids:
+        get_collection(collection_name).delete(ids=chunk_ids)
+    get_page_collection(collection_name).delete(where={"document_id": document_id})
+
+
+def remove_stored_uploads(paths: Iterable[str]) -> int:
+    removed = 0
+    upload_root = UPLOAD_DIR.resolve()
+    for raw_path in paths:
+        path = Path(raw_path).resolve()
+        # ลบเฉพาะไฟล์ที่อยู่ใต้ UPLOAD_DIR เท่านั้น
+        if upload_root not in path.parents or not path.is_file():
+            continue
+        path.unlink()
+        removed += 1
+    return removed
+
+
+# ---------------------------------------------------------------------------
+# Chunk embedding cache (SQLite, fp16 blob)
+# ---------------------------------------------------------------------------
+
+EMBED_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used);
+"""
+
+# SQLite จำกัดจำนวน parameter ต่อคำสั่ง จึงต้องแบ่ง key เป็นชุด
+EMBED_CACHE_BATCH = 500
+
+# จำนวน entry นับสะสมไว้ในหน่วยความจำ (COUNT(*) ครั้งเดียวตอนเริ่ม) เพื่อไม่ต้อง scan ทั้งตารางทุกครั้งที่ store
+_embed_cache_count: Dict[str, Optional[int]] = {"entries": None}
+_embed_cache_lock = threading.Lock()
+
+
+def embed_cache_enabled() -> bool:
+    return EMBED_CACHE_MAX_ENTRIES > 0
+
+
+@contextmanager
+def embed_cache_connection() -> Any:
+    conn = sqlite3.connect(EMBED_CACHE_PATH, timeout=5)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_embed_cache() -> None:
+    if not embed_cache_enabled():
+        return
+    with embed_cache_connection() as conn:
+        conn.executescript(EMBED_CACHE_SCHEMA)
+        conn.commit()
+        with _embed_cache_lock:
+            _embed_cache_count["entries"] = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+def embedding_cache_key(text: str, model_name: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _embed_cache_lookup(keys: List[str]) -> Dict[str, np.ndarray]:
+    found: Dict[str, np.ndarray] = {}
+    if not keys:
+        return found
+    now = time.time()
+    with embed_cache_connection() as conn:
+        for offset in range(0, len(keys), EMBED_CACHE_BATCH):
+            batch = keys[offset : offset + EMBED_CACHE_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, dim, vector FROM embeddings WHERE key IN ({placeholders})",
+                batch,
+            ).fetchall()
+            for key, dim, blob in rows:
+                vector = np.frombuffer(blob, dtype=np.float16)
+                if vector.shape[0] == dim:
+                    found[key] = vector.astype(np.float32)
+            hit_keys = [row[0] for row in rows]
+            if hit_keys:
+                conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({','.join('?' * len(hit_keys))})",
+                    [now, *hit_keys],
+                )
+        conn.commit()
+    return found
+
+
+def _embed_cache_store(entries: List[Tuple[str, np.ndarray]]) -> int:
+    if not entries:
+        return 0
+    now = time.time()
+    rows = [
+        (key, int(vector.shape[0]), vector.astype(np.float16).tobytes(), now)
+        for key, vector in entries
+    ]
+    with _embed_cache_lock, embed_cache_connection() as conn:
+        if _embed_cache_count["entries"] is None:
+            _embed_cache_count["entries"] = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        existing = 0
+        for offset in range(0, len(rows), EMBED_CACHE_BATCH):
+            batch = [row[0] for row in rows[offset : offset + EMBED_CACHE_BATCH]]
+            existing += conn.execute(
+                f"SELECT COUNT(*) FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchone()[0]
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, dim, vector, last_used) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        total = _embed_cache_count["entries"] + len(rows) - existing
+        evicted = 0
+        if total > EMBED_CACHE_MAX_ENTRIES:
+            # ไล่ entry ที่ไม่ได้ใช้นานที่สุดออก (LRU)
+            evicted = conn.execute(
+                """
+                DELETE FROM embeddings WHERE key IN (
+                    SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?
+                )
+                """,
+                (total - EMBED_CACHE_MAX_ENTRIES,),
+            ).rowcount
+        conn.commit()
+        _embed_cache_count["entries"] = total - evicted
+    return evicted
+
+
+async def embed_chunks(
+    chunks: List[str], model_name: Optional[str] = None
+) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """สร้าง embedding ของ chunk โดยเช็ค cache ก่อนเรียก encode"""
+    model_name = model_name or EMBED_MODEL_NAME
+    keys = [embedding_cache_key(chunk, model_name) for chunk in chunks]
+    cached: Dict[str, np.ndarray] = {}
+    if embed_cache_enabled():
+        try:
+            cached = await asyncio.to_thread(_embed_cache_lookup, list(dict.fromkeys(keys)))
+        except sqlite3.Error as exc:
+            logger.warning("embed_cache_lookup_failed", extra={"fields": {"error": str(exc)}})
+
+    # chunk ที่ข้อความซ้ำกันในเอกสารเดียวกัน encode เพียงครั้งเดียว
+    pending: Dict[str, str] = {}
+    for key, chunk in zip(keys, chunks):
+        if key not in cached:
+            pending.setdefault(key, chunk)
+
+    fresh: Dict[str, np.ndarray] = {}
+    if pending:
+        embedder = get_embedder(model_name)
+        texts = list(pending.values())
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(
+            None, lambda: embedder.encode(texts, convert_to_numpy=True)
+        )
+        fresh = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(pending, encoded)}
+
+    evicted = 0
+    if embed_cache_enabled() and fresh:
+        try:
+            evicted = await asyncio.to_thread(_embed_cache_store, list(fresh.items()))
+        except sqlite3.Error as exc:
+            logger.warning("embed_cache_store_failed", extra={"fields": {"error": str(exc)}})
+
+    vectors = {**cached, **fresh}
+    embeddings = np.vstack([vectors[key] for key in keys])
+    hits = sum(1 for key in keys if key in cached)
+    misses = len(keys) - hits
+    EMBED_CACHE_COUNTER.labels(result="hit").inc(hits)
+    EMBED_CACHE_COUNTER.labels(result="miss").inc(misses)
+    stats = {
+        "hits": hits,
+        "misses": misses,
+        "encoded": len(fresh),
+        "evicted": evicted,
+        "hit_ratio": round(hits / len(keys), 4) if keys else 0.0,
+    }
+    return embeddings, stats
+
+
+# ---------------------------------------------------------------------------
+# Near-duplicate chunk suppression (MinHash + LSH)
+# ---------------------------------------------------------------------------
+
+DEDUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunk_fingerprints (
+    collection TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    PRIMARY KEY (collection, chunk_id)
+);
+CREATE TABLE IF NOT EXISTS chunk_fingerprint_bands (
+    collection TEXT NOT NULL,
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    chunk_id TEXT NOT NULL,
+    document_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fp_bands_bucket ON chunk_fingerprint_bands (collection, band, bucket);
+CREATE INDEX IF NOT EXISTS idx_fp_bands_document ON chunk_fingerprint_bands (collection, document_id);
+CREATE INDEX IF NOT EXISTS idx_fp_document ON chunk_fingerprints (collection, document_id);
+CREATE TABLE IF NOT EXISTS chunk_duplicates (
+    collection TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    original_chunk_id TEXT NOT NULL,
+    original_document_id TEXT NOT NULL,
+    PRIMARY KEY (collection, chunk_id)
+);
+CREATE INDEX IF NOT EXISTS idx_fp_duplicates_original ON chunk_duplicates (collection, original_document_id);
+CREATE INDEX IF NOT EXISTS idx_fp_duplicates_document ON chunk_duplicates (collection, document_id);
+"""
+# chunk ที่ถูกตัดทิ้ง -> chunk ต้นฉบับ: (chunk_id, original_chunk_id, original_document_id)
+DuplicateLink = Tuple[str, str, str]
+
+# 64 permutation แบ่งเป็น 8 band x 8 row => คู่ที่ Jaccard ~0.77 ขึ้นไปจะชนกันใน band ใด band หนึ่ง
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 8
+MINHASH_ROWS = MINHASH_PERMUTATIONS // MINHASH_BANDS
+# multiply-shift hashing บน uint64 (ปล่อยให้ overflow วนรอบ) แล้วเก็บ 32 bit บน
+_minhash_rng = np.random.default_rng(20250925)
+MINHASH_A = _minhash_rng.integers(0, 1 << 64, size=MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+MINHASH_B = _minhash_rng.integers(0, 1 << 64, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+@contextmanager
+def dedup_connection() -> Any:
+    conn = sqlite3.connect(CHUNK_DEDUP_DB_PATH, timeout=5)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_dedup_db() -> None:
+    if not CHUNK_DEDUP_ENABLED:
+        return
+    with dedup_connection() as conn:
+        conn.executescript(DEDUP_SCHEMA)
+        has_unique = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_fp_bands_chunk'"
+        ).fetchone()
+        if not has_unique:
+            # DB รุ่นก่อนเขียน band ซ้ำได้ ล้างแถวซ้ำก่อนสร้าง unique index
+            conn.execute(
+                """
+                DELETE FROM chunk_fingerprint_bands WHERE rowid NOT IN (
+                    SELECT MAX(rowid) FROM chunk_fingerprint_bands GROUP BY collection, band, chunk_id
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE UNIQUE INDEX idx_fp_bands_chunk
+                ON chunk_fingerprint_bands (collection, band, chunk_id)
+                """
+            )
+        conn.commit()
+
+
+def make_chunk_id(document_id: str, meta: dict) -> str:
+    return f"{document_id}:{meta['page']}:{meta['chunk']}"
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    # ใช้ character 3-gram เพราะภาษาไทยไม่มีช่องว่างระหว่างคำ
+    normalized = WHITESPACE_PATTERN.sub(" ", text.lower()).strip()
+    shingles = {normalized[i : i + 3] for i in range(max(len(normalized) - 2, 1))}
+    hashes = np.fromiter(
+        (
+            int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little")
+            for item in shingles
+        ),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    with np.errstate(over="ignore"):
+        permuted = (np.outer(hashes, MINHASH_A) + MINHASH_B) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def _signature_buckets(signature: np.ndarray) -> List[int]:
+    buckets = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS : (band + 1) * MINHASH_ROWS].tobytes()
+        digest = hashlib.blake2b(rows, digest_size=8).digest()
+        buckets.append(int.from_bytes(digest, "little", signed=True))
+    return buckets
+
+
+def estimate_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.count_nonzero(a == b)) / MINHASH_PERMUTATIONS
+
+
+def _lookup_near_duplicates(
+    collection: str, signatures: Dict[int, np.ndarray], exclude_document: Optional[str] = None
+) -> Dict[int, Tuple[str, str]]:
+    matches: Dict[int, Tuple[str, str]] = {}
+    if not signatures:
+        return matches
+    band_filter = " OR ".join(["(b.band = ? AND b.bucket = ?)"] * MINHASH_BANDS)
+    with dedup_connection() as conn:
+        for idx, signature in signatures.items():
+            params: List[Any] = [collection, exclude_document or ""]
+            for band, bucket in enumerate(_signature_buckets(signature)):
+                params.extend([band, bucket])
+            rows = conn.execute(
+                f"""
+                SELECT DISTINCT f.chunk_id, f.document_id, f.signature
+                FROM chunk_fingerprint_bands b
+                JOIN chunk_fingerprints f ON f.collection = b.collection AND f.chunk_id = b.chunk_id
+                WHERE b.collection = ? AND b.document_id != ? AND ({band_filter})
+                """,
+                params,
+            ).fetchall()
+            for chunk_id, document_id, blob in rows:
+                stored = np.frombuffer(blob, dtype=np.uint32)
+                if estimate_jaccard(signature, stored) >= CHUNK_DEDUP_THRESHOLD:
+                    matches[idx] = (chunk_id, document_id)
+                    break
+    return matches
+
+
+def _store_fingerprints(
+    collection: str,
+    document_id: str,
+    entries: List[Tuple[str, np.ndarray]],
+    links: Optional[List[DuplicateLink]] = None,
+) -> None:
+    _store_fingerprint_rows(
+        collection, [(chunk_id, document_id, signature) for chunk_id, signature in entries]
+    )
+    _store_duplicate_links(
+        collection,
+        [
+            (chunk_id, document_id, original_chunk, original_document)
+            for chunk_id, original_chunk, original_document in links or []
+        ],
+    )
+
+
+def _store_duplicate_links(collection: str, rows: List[Tuple[str, str, str, str]]) -> None:
+    if not rows:
+        return
+    with dedup_connection() as conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO chunk_duplicates
+            (collection, chunk_id, document_id, original_chunk_id, original_document_id)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [(collection, *row) for row in rows],
+        )
+        conn.commit()
+
+
+def _store_fingerprint_rows(collection: str, rows: List[Tuple[str, str, np.ndarray]]) -> None:
+    if not rows:
+        return
+    band_rows = []
+    for chunk_id, document_id, signature in rows:
+        for band, bucket in enumerate(_signature_buckets(signature)):
+            band_rows.append((collection, band, bucket, chunk_id, document_id))
+    with dedup_connection() as conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO chunk_fingerprints (collection, chunk_id, document_id, signature)
+            VALUES (?, ?, ?, ?)
+            """,
+            [
+                (collection, chunk_id, document_id, signature.tobytes())
+                for chunk_id, document_id, signature in rows
+            ],
+        )
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO chunk_fingerprint_bands
+            (collection, band, bucket, chunk_id, document_id)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            band_rows,
+        )
+        conn.commit()
+
+
+def _find_duplicates(
+    collection: str,
+    document_id: str,
+    chunks: List[str],
+    metadata: List[dict],
+    exclude_document: Optional[str] = None,
+) -> Tuple[Dict[int, str], List[Tuple[str, np.ndarray]], List[DuplicateLink]]:
+    signatures = {
+        idx: minhash_signature(chunk)
+        for idx, chunk in enumerate(chunks)
+        if len(chunk) >= CHUNK_DEDUP_MIN_CHARS
+    }
+    existing = _lookup_near_duplicates(collection, signatures, exclude_document)
+
+    # ตรวจซ้ำภายในเอกสารเดียวกันด้วย LSH bucket ในหน่วยความจำ
+    local_buckets: Dict[Tuple[int, int], List[Tuple[np.ndarray, str]]] = {}
+    duplicates: Dict[int, str] = {}
+    fresh: List[Tuple[str, np.ndarray]] = []
+    links: List[DuplicateLink] = []
+    for idx, signature in signatures.items():
+        if idx in existing:
+            original, original_document = existing[idx]
+            duplicates[idx] = original
+            links.append((make_chunk_id(document_id, metadata[idx]), original, original_document))
+            continue
+        keys = list(enumerate(_signature_buckets(signature)))
+        match = next(
+            (
+                other_id
+                for key in keys
+                for other, other_id in local_buckets.get(key, [])
+                if estimate_jaccard(signature, other) >= CHUNK_DEDUP_THRESHOLD
+            ),
+            None,
+        )
+        if match:
+            duplicates[idx] = match
+            continue
+        chunk_id = make_chunk_id(document_id, metadata[idx])
+        for key in keys:
+            local_buckets.setdefault(key, []).append((signature, chunk_id))
+        fresh.append((chunk_id, signature))
+    return duplicates, fresh, links
+
+
+async def suppress_near_duplicates(
+    collection: str,
+    document_id: str,
+    chunks: List[str],
+    metadata: List[dict],
+    *,
+    replacing: bool = False,
+) -> Tuple[List[str], List[dict], List[Tuple[str, np.ndarray]], List[DuplicateLink], int]:
+    """ตัด chunk ที่เกือบซ้ำกับของเดิมใน collection ก่อนนำไปสร้าง embedding
+
+    คืน link ของ chunk ที่ซ้ำกับเอกสารอื่นด้วย เพื่อให้บันทึกคู่กับ fingerprint
+    และกู้ chunk กลับมาได้เมื่อเอกสารต้นฉบับถูกลบหรือแทนที่
+    """
+    if not CHUNK_DEDUP_ENABLED or not chunks:
+        return chunks, metadata, [], [], 0
+    try:
+        # กรณีแทนที่เอกสารเดิม ไม่นับ chunk ของเวอร์ชันเก่าเป็นตัวซ้ำ
+        duplicates, fresh, links = await asyncio.to_thread(
+            _find_duplicates,
+            collection,
+            document_id,
+            chunks,
+            metadata,
+            document_id if replacing else None,
+        )
+    except sqlite3.Error as exc:
+        logger.warning("chunk_dedup_failed", extra={"fields": {"error": str(exc)}})
+        return chunks, metadata, [], [], 0
+
+    kept_chunks = [chunk for idx, chunk in enumerate(chunks) if idx not in duplicates]
+    kept_metadata = [meta for idx, meta in enumerate(metadata) if idx not in duplicates]
+    DEDUP_COUNTER.labels(collection=collection, result="kept").inc(len(kept_chunks))
+    DEDUP_COUNTER.labels(collection=collection, result="skipped").inc(len(duplicates))
+    if duplicates:
+        logger.info(
+            "chunk_duplicates_skipped",
+            extra={
+                "fields": {
+                    "document_id": document_id,
+                    "collection": collection,
+                    "skipped": len(duplicates),
+                    "links": {
+                        make_chunk_id(document_id, metadata[idx]): target
+                        for idx, target in list(duplicates.items())[:20]
+                    },
+                }
+            },
+        )
+    return kept_chunks, kept_metadata, fresh, links, len(duplicates)
+
+
+def _delete_fingerprints(collection: str, document_id: str) -> None:
+    with dedup_connection() as conn:
+        conn.execute(
+            "DELETE FROM chunk_fingerprints WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        conn.execute(
+            "DELETE FROM chunk_fingerprint_bands WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        # link ขาเข้า (เอกสารอื่นที่ซ้ำกับเอกสารนี้) เก็บไว้ให้ reindex_duplicate_dependents ใช้
+        conn.execute(
+            "DELETE FROM chunk_duplicates WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        conn.commit()
+
+
+def _duplicate_dependents(collection: str, document_id: str) -> List[str]:
+    with dedup_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT DISTINCT document_id FROM chunk_duplicates
+            WHERE collection = ? AND original_document_id = ? AND document_id != ?
+            ORDER BY document_id
+            """,
+            (collection, document_id, document_id),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def _has_duplicate_links(collection: str, document_id: str) -> bool:
+    with dedup_connection() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM chunk_duplicates WHERE collection = ? AND document_id = ? LIMIT 1",
+            (collection, document_id),
+        ).fetchone()
+    return row is not None
+
+
+async def forget_fingerprints(collection: str, document_id: str) -> None:
+    if not CHUNK_DEDUP_ENABLED:
+        return
+    try:
+        await asyncio.to_thread(_delete_fingerprints, collection, document_id)
+    except sqlite3.Error as exc:
+        logger.warning("chunk_fingerprint_delete_failed", extra={"fields": {"error": str(exc)}})
+
+
+async def record_fingerprints(
+    collection: str,
+    document_id: str,
+    entries: List[Tuple[str, np.ndarray]],
+    links: Optional[List[DuplicateLink]] = None,
+) -> None:
+    if not CHUNK_DEDUP_ENABLED or not (entries or links):
+        return
+    try:
+        await asyncio.to_thread(_store_fingerprints, collection, document_id, entries, links)
+    except sqlite3.Error as exc:
+        logger.warning("chunk_fingerprint_store_failed", extra={"fields": {"error": str(exc)}})
+
+
+def format_sources(documents: List[str], metadatas: List[dict], distances: List[float]):
+    sources = []
+    for doc, meta, dist in zip(documents, metadatas, distances):
+        item = {
+            "text": doc,
+            "score": float(dist),
+            "metadata": meta,
+        }
+        sources.append(item)
+    return sources
+
+
+# ---------------------------------------------------------------------------
+# Document store (page text) + embedding model migrations
+# ---------------------------------------------------------------------------
+
+DOC_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    filename TEXT,
+    storage_path TEXT,
+    file_type TEXT,
+    correlation_id TEXT,
+    extra_metadata TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (collection, document_id)
+);
+CREATE TABLE IF NOT EXISTS document_pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_document_pages_doc ON document_pages (collection, document_id);
+CREATE TABLE IF NOT EXISTS collection_state (
+    collection TEXT PRIMARY KEY,
+    physical TEXT NOT NULL,
+    embed_model TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS supermemory_parts (
+    collection TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    part INTEGER NOT NULL,
+    custom_id TEXT NOT NULL,
+    chunks INTEGER NOT NULL,
+    chars INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT,
+    supermemory_id TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (collection, document_id, part)
+);
+CREATE TABLE IF NOT EXISTS embed_migrations (
+    id TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    source_physical TEXT NOT NULL,
+    target_physical TEXT NOT NULL,
+    embed_model TEXT NOT NULL,
+    status TEXT NOT NULL,
+    cursor INTEGER NOT NULL DEFAULT 0,
+    backfilled INTEGER NOT NULL DEFAULT 0,
+    documents_done INTEGER NOT NULL DEFAULT 0,
+    chunks_done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+CHUNK_CORE_METADATA_KEYS = {
+    "document_id",
+    "filename",
+    "storage_path",
+    "page",
+    "chunk",
+    "page_key",
+    "correlation_id",
+    "file_type",
+}
+SHADOW_COLLECTION_MARKER = "__emb_"
+BACKFILL_SCAN_BATCH = 1000
+
+# logical collection -> (physical collection, embed model) ที่ /query และ /ingest ใช้อยู่
+_collection_state: Dict[str, Tuple[str, str]] = {}
+_collection_locks: Dict[str, asyncio.Lock] = {}
+_migration_tasks: Dict[str, asyncio.Task] = {}
+
+
+@contextmanager
+def doc_store_connection() -> Any:
+    conn = sqlite3.connect(DOC_STORE_PATH, timeout=5)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_doc_store() -> None:
+    with doc_store_connection() as conn:
+        conn.executescript(DOC_STORE_SCHEMA)
+        conn.commit()
+        rows = conn.execute("SELECT collection, physical, embed_model FROM collection_state").fetchall()
+    _collection_state.update({row["collection"]: (row["physical"], row["embed_model"]) for row in rows})
+
+
+def resolve_collection(logical: str) -> Tuple[str, str]:
+    return _collection_state.get(logical, (logical, EMBED_MODEL_NAME))
+
+
+def _save_collection_state(logical: str, physical: str, embed_model: str) -> None:
+    with doc_store_connection() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO collection_state (collection, physical, embed_model, updated_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (logical, physical, embed_model, datetime.utcnow().isoformat(timespec="seconds")),
+        )
+        conn.commit()
+    _collection_state[logical] = (physical, embed_model)
+
+
+def _chroma_collection_names() -> List[str]:
+    # chromadb >= 0.6 คืนชื่อ ส่วนรุ่นก่อนคืน object ของ collection
+    return [getattr(item, "name", item) for item in get_chroma_client().list_collections()]
+
+
+def register_existing_collections() -> List[str]:
+    """บันทึกโมเดลของทุก collection ใน Chroma ที่ยังไม่มีใน collection_state
+
+    collection ที่สร้างก่อนมีตารางนี้ไม่มีข้อมูลโมเดลเก็บไว้ จึงถือว่าสร้างด้วย EMBED_MODEL ปัจจุบัน
+    (สมมติฐานเดียวกับ collection หลัก) หลังจากนั้นการเปลี่ยน EMBED_MODEL จะถูกตรวจเจอทุก collection
+    """
+    physical_in_use = {physical for physical, _ in _collection_state.values()}
+    registered = []
+    for name in _chroma_collection_names():
+        if (
+            name in _collection_state
+            or name in physical_in_use
+            or name.endswith(PAGE_COLLECTION_SUFFIX)
+            or SHADOW_COLLECTION_MARKER in name
+        ):
+            continue
+        _save_collection_state(name, name, EMBED_MODEL_NAME)
+        registered.append(name)
+    return registered
+
+
+def ensure_collection_state(logical: str) -> Tuple[str, str]:
+    # บันทึกว่า collection นี้สร้างด้วยโมเดลไหน เพื่อให้รู้ตัวเมื่อ EMBED_MODEL เปลี่ยน
+    if logical not in _collection_state:
+        _save_collection_state(logical, logical, EMBED_MODEL_NAME)
+    return _collection_state[logical]
+
+
+def collection_write_lock(logical: str) -> asyncio.Lock:
+    lock = _collection_locks.get(logical)
+    if lock is None:
+        lock = _collection_locks[logical] = asyncio.Lock()
+    return lock
+
+
+def store_document_pages(
+    collection: str, document_id: str, pages: List[Dict[str, object]], info: Dict[str, Any]
+) -> None:
+    with doc_store_connection() as conn:
+        conn.execute(
+            "DELETE FROM document_pages WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO documents
+            (collection, document_id, filename, storage_path, file_type, correlation_id,
+             extra_metadata, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                collection,
+                document_id,
+                info.get("filename"),
+                info.get("storage_path"),
+                info.get("file_type"),
+                info.get("correlation_id"),
+                json.dumps(info.get("extra_metadata") or {}, ensure_ascii=False),
+                datetime.utcnow().isoformat(timespec="seconds"),
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO document_pages (collection, document_id, page, text) VALUES (?, ?, ?, ?)",
+            [
+                (collection, document_id, int(page.get("page", 1)), str(page.get("text") or ""))
+                for page in pages
+            ],
+        )
+        conn.commit()
+
+
+def delete_document_pages(collection: str, document_id: str) -> None:
+    with doc_store_connection() as conn:
+        conn.execute(
+            "DELETE FROM document_pages WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        conn.execute(
+            "DELETE FROM documents WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        )
+        conn.commit()
+
+
+def load_document(
+    collection: str, document_id: str
+) -> Optional[Tuple[Dict[str, Any], List[Dict[str, object]], int]]:
+    with doc_store_connection() as conn:
+        doc = conn.execute(
+            "SELECT * FROM documents WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        ).fetchone()
+        rows = conn.execute(
+            """
+            SELECT id, page, text FROM document_pages
+            WHERE collection = ? AND document_id = ? ORDER BY id
+            """,
+            (collection, document_id),
+        ).fetchall()
+    if doc is None or not rows:
+        return None
+    info = {
+        "filename": doc["filename"],
+        "storage_path": doc["storage_path"],
+        "file_type": doc["file_type"],
+        "correlation_id": doc["correlation_id"],
+        "extra_metadata": json.loads(doc["extra_metadata"] or "{}"),
+    }
+    pages = [{"page": row["page"], "text": row["text"]} for row in rows]
+    return info, pages, rows[-1]["id"]
+
+
+def _stored_document_path(collection: str, document_id: str) -> Tuple[bool, Optional[str]]:
+    with doc_store_connection() as conn:
+        row = conn.execute(
+            "SELECT storage_path FROM documents WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        ).fetchone()
+    if row is None:
+        return False, None
+    return True, row["storage_path"]
+
+
+def locate_document(logical: str, document_id: str) -> Tuple[List[str], List[str], bool]:
+    """คืน (chunk ids, ไฟล์ที่อัปโหลด, มีเอกสารอยู่หรือไม่)
+
+    เอกสารที่ทุก chunk ซ้ำกับเอกสารอื่นไม่มี chunk ใน Chroma เลย จึงต้องดู document store
+    และ link ของ chunk ซ้ำด้วย ไม่อย่างนั้นลบ/แทนที่เอกสารนั้นไม่ได้
+    """
+    chunk_ids, storage_paths = find_document_chunks(resolve_collection(logical)[0], document_id)
+    stored, stored_path = _stored_document_path(logical, document_id)
+    if stored_path and stored_path not in storage_paths:
+        storage_paths.append(stored_path)
+    exists = bool(chunk_ids) or stored
+    if not exists and CHUNK_DEDUP_ENABLED:
+        try:
+            exists = _has_duplicate_links(logical, document_id)
+        except sqlite3.Error as exc:
+            logger.warning("chunk_duplicate_lookup_failed", extra={"fields": {"error": str(exc)}})
+    return chunk_ids, storage_paths, exists
+
+
+def _next_documents(collection: str, cursor: int, limit: int) -> List[Tuple[str, int]]:
+    # หน้าของเอกสารเดียวกันถูก insert ใน transaction เดียว id จึงเรียงติดกัน
+    with doc_store_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT document_id, MAX(id) AS last_id FROM document_pages
+            WHERE collection = ?
+            GROUP BY document_id
+            HAVING MIN(id) > ?
+            ORDER BY MIN(id)
+            LIMIT ?
+            """,
+            (collection, cursor, limit),
+        ).fetchall()
+    return [(row["document_id"], row["last_id"]) for row in rows]
+
+
+def _document_last_page_id(collection: str, document_id: str) -> Optional[int]:
+    with doc_store_connection() as conn:
+        row = conn.execute(
+            "SELECT MAX(id) FROM document_pages WHERE collection = ? AND document_id = ?",
+            (collection, document_id),
+        ).fetchone()
+    return row[0] if row else None
+
+
+def build_chunks(
+    document_id: str,
+    pages: List[Dict[str, object]],
+    info: Dict[str, Any],
+    model_name: Optional[str] = None,
+) -> Tuple[List[str], List[dict]]:
+    all_chunks: List[str] = []
+    metadata: List[dict] = []
+    extra_metadata = info.get("extra_metadata") or {}
+    for page in pages:
+        page_no = page.get("page", 1)
+        for idx, chunk in enumerate(chunk_text(page.get("text") or "", model_name=model_name)):
+            all_chunks.append(chunk)
+            meta_entry = {
+                "document_id": document_id,
+                "filename": info.get("filename"),
+                "storage_path": info.get("storage_path"),
+                "page": page_no,
+                "chunk": idx,
+                "page_key": make_page_key(document_id, page_no),
+                "correlation_id": info.get("correlation_id"),
+                "file_type": info.get("file_type"),
+            }
+            if extra_metadata:
+                meta_entry.update(extra_metadata)
+            metadata.append(meta_entry)
+    return all_chunks, metadata
+
+
+def write_chunks(
+    physical: str,
+    document_id: str,
+    chunks: List[str],
+    metadata: List[dict],
+    embeddings: np.ndarray,
+) -> Dict[str, Any]:
+    chunk_ids = [make_chunk_id(document_id, meta) for meta in metadata]
+    get_collection(physical).add(
+        ids=chunk_ids,
+        embeddings=embeddings.tolist(),
+        documents=chunks,
+        metadatas=metadata,
+    )
+    pages_indexed = upsert_page_vectors(physical, document_id, embeddings, chunks, metadata)
+    return {"chunks_added": len(chunk_ids), "pages_indexed": pages_indexed}
+
+
+def shadow_collection_name(logical: str, embed_model: str) -> str:
+    suffix = hashlib.sha1(embed_model.encode("utf-8")).hexdigest()[:8]
+    return f"{logical}{SHADOW_COLLECTION_MARKER}{suffix}"
+
+
+def _merge_overlapping_chunks(chunks: List[str], min_overlap: int = 8, max_overlap: int = 800) -> str:
+    merged = ""
+    for chunk in chunks:
+        if not merged:
+            merged = chunk
+            continue
+        overlap = 0
+        for size in range(min(len(chunk), len(merged), max_overlap), min_overlap - 1, -1):
+            if merged.endswith(chunk[:size]):
+                overlap = size
+                break
+        merged += chunk[overlap:] if overlap else "\n" + chunk
+    return merged
+
+
+def backfill_page_store(logical: str, physical: str) -> int:
+    """สร้างข้อความรายหน้าจาก chunk ใน Chroma สำหรับเอกสารที่ ingest ก่อนมี document store"""
+    with doc_store_connection() as conn:
+        known = {
+            row[0]
+            for row in conn.execute(
+                "SELECT document_id FROM documents WHERE collection = ?", (logical,)
+            ).fetchall()
+        }
+    collection = get_collection(physical)
+    missing: Dict[str, None] = {}
+    offset = 0
+    while True:
+        batch = collection.get(include=["metadatas"], limit=BACKFILL_SCAN_BATCH, offset=offset)
+        ids = batch.get("ids") or []
+        if not ids:
+            break
+        for meta in batch.get("metadatas") or []:
+            document_id = (meta or {}).get("document_id")
+            if document_id and document_id not in known:
+                missing.setdefault(document_id, None)
+        offset += len(ids)
+
+    for document_id in missing:
+        result = collection.get(
+            where={"document_id": document_id}, include=["documents", "metadatas"]
+        )
+        entries = sorted(
+            zip(result.get("metadatas") or [], result.get("documents") or []),
+            key=lambda item: (int(item[0].get("page", 1)), int(item[0].get("chunk", 0))),
+        )
+        if not entries:
+            continue
+        by_page: Dict[int, List[str]] = {}
+        for meta, text in entries:
+            by_page.setdefault(int(meta.get("page", 1)), []).append(text or "")
+        first_meta = entries[0][0]
+        info = {
+            "filename": first_meta.get("filename"),
+            "storage_path": first_meta.get("storage_path"),
+            "file_type": first_meta.get("file_type"),
+            "correlation_id": first_meta.get("correlation_id"),
+            "extra_metadata": {
+                key: value
+                for key, value in first_meta.items()
+                if key not in CHUNK_CORE_METADATA_KEYS
+            },
+        }
+        pages = [
+            {"page": page, "text": _merge_overlapping_chunks(texts)}
+            for page, texts in sorted(by_page.items())
+        ]
+        store_document_pages(logical, document_id, pages, info)
+    return len(missing)
+
+
+def _load_migration(migration_id: str) -> Optional[Dict[str, Any]]:
+    with doc_store_connection() as conn:
+        row = conn.execute("SELECT * FROM embed_migrations WHERE id = ?", (migration_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _list_migrations(status: Optional[str] = None) -> List[Dict[str, Any]]:
+    with doc_store_connection() as conn:
+        if status:
+            rows = conn.execute(
+                "SELECT * FROM embed_migrations WHERE status = ? ORDER BY created_at", (status,)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM embed_migrations ORDER BY created_at").fetchall()
+    return [dict(row) for row in rows]
+
+
+def _update_migration(migration_id: str, **fields: Any) -> None:
+    fields["updated_at"] = datetime.utcnow().isoformat(timespec="seconds")
+    assignments = ", ".join(f"{key} = ?" for key in fields)
+    with doc_store_connection() as conn:
+        conn.execute(
+            f"UPDATE embed_migrations SET {assignments} WHERE id = ?",
+            [*fields.values(), migration_id],
+        )
+        conn.commit()
+
+
+def _insert_migration(record: Dict[str, Any]) -> None:
+    columns = ", ".join(record)
+    placeholders = ", ".join("?" * len(record))
+    with doc_store_connection() as conn:
+        conn.execute(
+            f"INSERT INTO embed_migrations ({columns}) VALUES ({placeholders})",
+            list(record.values()),
+        )
+        conn.commit()
+
+
+def running_migration_for(logical: str) -> Optional[Dict[str, Any]]:
+    for migration in _list_migrations("running"):
+        if migration["collection"] == logical:
+            return migration
+    return None
+
+
+def drop_physical_collection(physical: str) -> None:
+    client = get_chroma_client()
+    for name in (physical, f"{physical}{PAGE_COLLECTION_SUFFIX}"):
+        _collections.pop(name, None)
+        try:
+            client.delete_collection(name=name)
+        except Exception:  # collection ยังไม่เคยถูกสร้าง
+            pass
+
+
+def _rename_fingerprint_namespace(source: str, target: str) -> None:
+    with dedup_connection() as conn:
+        conn.execute("DELETE FROM chunk_fingerprints WHERE collection = ?", (target,))
+        conn.execute("DELETE FROM chunk_fingerprint_bands WHERE collection = ?", (target,))
+        conn.execute("DELETE FROM chunk_duplicates WHERE collection = ?", (target,))
+        conn.execute(
+            "UPDATE chunk_fingerprints SET collection = ? WHERE collection = ?", (target, source)
+        )
+        conn.execute(
+            "UPDATE chunk_fingerprint_bands SET collection = ? WHERE collection = ?", (target, source)
+        )
+        conn.execute(
+            "UPDATE chunk_duplicates SET collection = ? WHERE collection = ?", (target, source)
+        )
+        conn.commit()
+
+
+def _drop_fingerprint_namespace(namespace: str) -> None:
+    with dedup_connection() as conn:
+        conn.execute("DELETE FROM chunk_fingerprints WHERE collection = ?", (namespace,))
+        conn.execute("DELETE FROM chunk_fingerprint_bands WHERE collection = ?", (namespace,))
+        conn.execute("DELETE FROM chunk_duplicates WHERE collection = ?", (namespace,))
+        conn.commit()
+
+
+async def migrate_document(
+    logical: str, target: str, embed_model: str, document_id: str, last_id: int
+) -> int:
+    loaded = await asyncio.to_thread(load_document, logical, document_id)
+    if loaded is None:
+        return 0
+    info, pages, _ = loaded
+    chunks, metadata = await asyncio.to_thread(build_chunks, document_id, pages, info, embed_model)
+    # fingerprint ของ collection ใหม่เก็บแยก namespace (ชื่อ physical) จนกว่าจะสลับ
+    chunks, metadata, fingerprints, links, _ = await suppress_near_duplicates(
+        target, document_id, chunks, metadata, replacing=True
+    )
+    embeddings: Optional[np.ndarray] = None
+    if chunks:
+        embeddings, _ = await embed_chunks(chunks, embed_model)
+
+    async with collection_write_lock(logical):
+        current_last = await asyncio.to_thread(_document_last_page_id, logical, document_id)
+        if current_last != last_id:
+            # เอกสารถูกลบหรือแทนที่ระหว่างประมวลผล เวอร์ชันใหม่จะถูกหยิบในรอบถัดไป
+            return 0
+        stale_ids, _ = await asyncio.to_thread(find_document_chunks, target, document_id)
+        await asyncio.to_thread(delete_document_vectors, target, document_id, stale_ids)
+        await forget_fingerprints(target, document_id)
+        if not chunks or embeddings is None:
+            return 0
+        await asyncio.to_thread(write_chunks, target, document_id, chunks, metadata, embeddings)
+        await record_fingerprints(target, document_id, fingerprints, links)
+    return len(chunks)
+
+
+def physical_collection_retired(physical: str) -> bool:
+    """True ถ้าไม่มี collection ไหนใช้ physical นี้อยู่ และไม่ใช่ต้นทาง/ปลายทางของการย้ายที่ยังวิ่ง"""
+    if any(active == physical for active, _ in _collection_state.values()):
+        return False
+    return not any(
+        physical in (migration["source_physical"], migration["target_physical"])
+        for migration in _list_migrations("running")
+    )
+
+
+async def drop_retired_collection(physical: str, delay: float) -> None:
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if not await asyncio.to_thread(physical_collection_retired, physical):
+        return
+    await asyncio.to_thread(drop_physical_collection, physical)
+    logger.info("retired_collection_dropped", extra={"fields": {"physical": physical}})
+
+
+async def drop_retired_migration_sources() -> None:
+    # กรณี service ถูกปิดก่อนครบ grace period collection เก่าจะค้างอยู่ เก็บกวาดตอนเริ่ม
+    for migration in await asyncio.to_thread(_list_migrations, "completed"):
+        source = migration["source_physical"]
+        if source not in await asyncio.to_thread(_chroma_collection_names):
+            continue
+        await drop_retired_collection(source, 0)
+
+
+async def _flip_collection(migration: Dict[str, Any]) -> None:
+    logical = migration["collection"]
+    target = migration["target_physical"]
+    await asyncio.to_thread(_save_collection_state, logical, target, migration["embed_model"])
+    if CHUNK_DEDUP_ENABLED:
+        await asyncio.to_thread(_rename_fingerprint_namespace, target, logical)
+    await asyncio.to_thread(_update_migration, migration["id"], status="completed")
+    EMBED_MIGRATION_COUNTER.labels(status="completed").inc()
+    _background_tasks.append(
+        asyncio.create_task(
+            drop_retired_collection(
+                migration["source_physical"], EMBED_MIGRATION_DROP_GRACE_SECONDS
+            )
+        )
+    )
+    logger.info(
+        "embed_migration_flipped",
+        extra={
+            "fields": {
+                "migration_id": migration["id"],
+                "collection": logical,
+                "physical": target,
+                "previous_physical": migration["source_physical"],
+                "embed_model": migration["embed_model"],
+            }
+        },
+    )
+
+
+async def run_embed_migration(migration_id: str) -> None:
+    migration = await asyncio.to_thread(_load_migration, migration_id)
+    if migration is None or migration["status"] != "running":
+        return
+    logical = migration["collection"]
+    target = migration["target_physical"]
+    embed_model = migration["embed_model"]
+    cursor = int(migration["cursor"])
+    documents_done = int(migration["documents_done"])
+    chunks_done = int(migration["chunks_done"])
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, get_embedder, embed_model)
+        if not migration["backfilled"]:
+            backfilled = await asyncio.to_thread(
+                backfill_page_store, logical, migration["source_physical"]
+            )
+            await asyncio.to_thread(_update_migration, migration_id, backfilled=1)
+            logger.info(
+                "embed_migration_backfilled",
+                extra={"fields": {"migration_id": migration_id, "documents": backfilled}},
+            )
+        while True:
+            batch = await asyncio.to_thread(
+                _next_documents, logical, cursor, max(EMBED_MIGRATION_BATCH_DOCS, 1)
+            )
+            if not batch:
+                async with collection_write_lock(logical):
+                    pending = await asyncio.to_thread(_next_documents, logical, cursor, 1)
+                    if not pending:
+                        await _flip_collection(migration)
+                        return
+                continue
+            for document_id, last_id in batch:
+                chunks_done += await migrate_document(
+                    logical, target, embed_model, document_id, last_id
+                )
+                documents_done += 1
+                cursor = last_id
+                await asyncio.to_thread(
+                    _update_migration,
+                    migration_id,
+                    cursor=cursor,
+                    documents_done=documents_done,
+                    chunks_done=chunks_done,
+                )
+            await asyncio.sleep(EMBED_MIGRATION_PAUSE_SECONDS)
+    except asyncio.CancelledError:
+        # ปิด service ระหว่างทาง: คงสถานะ running ไว้เพื่อทำต่อจาก cursor เมื่อเริ่มใหม่
+        raise
+    except Exception as exc:
+        logger.exception(
+            "embed_migration_failed",
+            extra={"fields": {"migration_id": migration_id, "error": str(exc)}},
+        )
+        EMBED_MIGRATION_COUNTER.labels(status="failed").inc()
+        await asyncio.to_thread(_update_migration, migration_id, status="failed", error=str(exc)[:500])
+    finally:
+        _migration_tasks.pop(migration_id, None)
+
+
+def launch_migration_task(migration_id: str) -> None:
+    if migration_id in _migration_tasks:
+        return
+    _migration_tasks[migration_id] = asyncio.create_task(run_embed_migration(migration_id))
+
+
+async def start_embed_migration(logical: str, embed_model: str) -> Dict[str, Any]:
+    source_physical, source_model = resolve_collection(logical)
+    if source_model == embed_model:
+        raise HTTPException(status_code=400, detail="collection นี้ใช้โมเดลดังกล่าวอยู่แล้ว")
+    if await asyncio.to_thread(running_migration_for, logical):
+        raise HTTPException(status_code=409, detail="มีการย้าย embedding ของ collection นี้อยู่แล้ว")
+    target = shadow_collection_name(logical, embed_model)
+    if target == source_physical:
+        target = f"{target}b"
+    # เคลียร์ collection เงาเก่าที่อาจค้างจากการย้ายครั้งก่อน
+    await asyncio.to_thread(drop_physical_collection, target)
+    if CHUNK_DEDUP_ENABLED:
+        await asyncio.to_thread(_drop_fingerprint_namespace, target)
+    now = datetime.utcnow().isoformat(timespec="seconds")
+    record = {
+        "id": uuid.uuid4().hex,
+        "collection": logical,
+        "source_physical": source_physical,
+        "target_physical": target,
+        "embed_model": embed_model,
+        "status": "running",
+        "created_at": now,
+        "updated_at": now,
+    }
+    await asyncio.to_thread(_insert_migration, record)
+    EMBED_MIGRATION_COUNTER.labels(status="started").inc()
+    launch_migration_task(record["id"])
+    logger.info("embed_migration_started", extra={"fields": record})
+    return await asyncio.to_thread(_load_migration, record["id"])
+
+
+async def resume_embed_migrations() -> None:
+    for migration in await asyncio.to_thread(_list_migrations, "running"):
+        launch_migration_task(migration["id"])
+    if not EMBED_MIGRATION_AUTO:
+        return
+    for logical, (_, embed_model) in list(_collection_state.items()):
+        if embed_model != EMBED_MODEL_NAME and not await asyncio.to_thread(
+            running_migration_for, logical
+        ):
+            await start_embed_migration(logical, EMBED_MODEL_NAME)
+
+
+def document_vector_targets(logical: str) -> List[str]:
+    """physical collection ทั้งหมดที่ต้องลบ/แทนที่เวกเตอร์ของเอกสาร (รวม collection เงาที่กำลังย้าย)"""
+    targets = [resolve_collection(logical)[0]]
+    migration = running_migration_for(logical)
+    if migration and migration["target_physical"] not in targets:
+        targets.append(migration["target_physical"])
+    return targets
+
+
+# ---------------------------------------------------------------------------
+# Collection snapshots (export/import)
+# ---------------------------------------------------------------------------
+
+SNAPSHOT_FORMAT = "doc_dude.collection_snapshot"
+SNAPSHOT_VERSION = 1
+# เมทริกซ์ fp16 บีบอัดแทบไม่ได้ เก็บแบบ stored เพื่อให้อ่านแบบ stream ได้เร็ว
+SNAPSHOT_STORED_SUFFIXES = {".bin"}
+
+
+class SnapshotSectionWriter:
+    """เขียนแถวของ section หนึ่งลงไฟล์ชั่วคราวแบบ columnar
+
+    ข้อความเก็บเป็น utf-8 blob ต่อกัน + offsets (uint64), เวกเตอร์เก็บเป็นเมทริกซ์ดิบ,
+    metadata เก็บเป็น JSON รายคอลัมน์ (ค่า null = แถวนั้นไม่มี key)
+    """
+
+    def __init__(self, root: Path, name: str) -> None:
+        self.root = root / name
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.count = 0
+        self._handles: Dict[str, Any] = {}
+        self._offsets: Dict[str, List[int]] = {}
+        self._matrices: Dict[str, Dict[str, Any]] = {}
+        self._metadata: Dict[str, List[Any]] = {}
+
+    def _handle(self, filename: str) -> Any:
+        handle = self._handles.get(filename)
+        if handle is None:
+            handle = self._handles[filename] = open(self.root / filename, "wb")
+        return handle
+
+    def add_rows(
+        self,
+        ids: List[str],
+        *,
+        texts: Optional[Dict[str, List[Optional[str]]]] = None,
+        matrices: Optional[Dict[str, np.ndarray]] = None,
+        metadatas: Optional[List[Optional[dict]]] = None,
+    ) -> None:
+        if not ids:
+            return
+        for column, values in {"ids": ids, **(texts or {})}.items():
+            handle = self._handle(f"{column}.utf8")
+            offsets = self._offsets.setdefault(column, [0])
+            for value in values:
+                raw = (value or "").encode("utf-8")
+                handle.write(raw)
+                offsets.append(offsets[-1] + len(raw))
+        for matrix_name, block in (matrices or {}).items():
+            spec = self._matrices.setdefault(
+                matrix_name, {"dtype": block.dtype.str, "dim": int(block.shape[1])}
+            )
+            block = np.ascontiguousarray(block, dtype=np.dtype(spec["dtype"]))
+            self._handle(f"{matrix_name}.bin").write(block.tobytes())
+        for row, meta in enumerate(metadatas or []):
+            for key, value in (meta or {}).items():
+                column = self._metadata.setdefault(key, [])
+                column.extend([None] * (self.count + row - len(column)))
+                column.append(value)
+        self.count += len(ids)
+        for column in self._metadata.values():
+            column.extend([None] * (self.count - len(column)))
+
+    def finish(self) -> Dict[str, Any]:
+        for handle in self._handles.values():
+            handle.close()
+        for column, offsets in self._offsets.items():
+            np.asarray(offsets, dtype="<u8").tofile(self.root / f"{column}.offsets")
+        if self._metadata:
+            (self.root / "metadata.json").write_text(
+                json.dumps(self._metadata, ensure_ascii=False), encoding="utf-8"
+            )
+        return {
+            "count": self.count,
+            "text_columns": sorted(self._offsets),
+            "matrices": self._matrices,
+            "metadata_keys": sorted(self._metadata),
+        }
+
+
+def iter_snapshot_section(
+    archive: zipfile.ZipFile, name: str, spec: Dict[str, Any], batch_size: int
+) -> Iterator[Dict[str, Any]]:
+    count = int(spec.get("count") or 0)
+    if not count:
+        return
+    offsets = {
+        column: np.frombuffer(archive.read(f"{name}/{column}.offsets"), dtype="<u8")
+        for column in spec["text_columns"]
+    }
+    metadata: Dict[str, List[Any]] = {}
+    if spec.get("metadata_keys"):
+        metadata = json.loads(archive.read(f"{name}/metadata.json"))
+    streams = {column: archive.open(f"{name}/{column}.utf8") for column in spec["text_columns"]}
+    matrix_streams = {matrix: archive.open(f"{name}/{matrix}.bin") for matrix in spec["matrices"]}
+    try:
+        for start in range(0, count, batch_size):
+            end = min(start + batch_size, count)
+            batch: Dict[str, Any] = {}
+            for column, stream in streams.items():
+                bounds = (offsets[column][start : end + 1] - offsets[column][start]).tolist()
+                blob = stream.read(bounds[-1])
+                batch[column] = [
+                    blob[bounds[i] : bounds[i + 1]].decode("utf-8") for i in range(end - start)
+                ]
+            for matrix, stream in matrix_streams.items():
+                dtype = np.dtype(spec["matrices"][matrix]["dtype"])
+                dim = int(spec["matrices"][matrix]["dim"])
+                raw = stream.read((end - start) * dim * dtype.itemsize)
+                batch[matrix] = np.frombuffer(raw, dtype=dtype).reshape(end - start, dim)
+            batch["metadatas"] = [
+                {key: values[i] for key, values in metadata.items() if values[i] is not None}
+                for i in range(start, end)
+            ]
+            yield batch
+    finally:
+        for stream in [*streams.values(), *matrix_streams.values()]:
+            stream.close()
+
+
+def snapshot_batch_size() -> int:
+    size = SNAPSHOT_BATCH_SIZE
+    max_batch_size = getattr(get_chroma_client(), "get_max_batch_size", None)
+    if callable(max_batch_size):
+        size = min(size, int(max_batch_size()))
+    return max(size, 1)
+
+
+def collection_exists(physical: str) -> bool:
+    try:
+        get_chroma_client().get_collection(name=physical)
+    except Exception:  # chroma แจ้งว่าไม่พบ collection ด้วย exception ต่างชนิดกันในแต่ละเวอร์ชัน
+        return False
+    return True
+
+
+def _export_chroma_section(
+    writer: SnapshotSectionWriter, collection: Any, batch_size: int
+) -> Dict[str, Any]:
+    ids = list(collection.get(include=[]).get("ids") or [])
+    for start in range(0, len(ids), batch_size):
+        batch = collection.get(
+            ids=ids[start : start + batch_size],
+            include=["embeddings", "documents", "metadatas"],
+        )
+        writer.add_rows(
+            list(batch["ids"]),
+            texts={"documents": list(batch.get("documents") or [])},
+            matrices={"vectors": np.asarray(batch["embeddings"], dtype="<f2")},
+            metadatas=list(batch.get("metadatas") or []),
+        )
+    return writer.finish()
+
+
+def _export_fingerprints(writer: SnapshotSectionWriter, logical: str, batch_size: int) -> Dict[str, Any]:
+    if CHUNK_DEDUP_ENABLED:
+        with dedup_connection() as conn:
+            cursor = conn.execute(
+                "SELECT chunk_id, document_id, signature FROM chunk_fingerprints WHERE collection = ?",
+                (logical,),
+            )
+            while rows := cursor.fetchmany(batch_size):
+                writer.add_rows(
+                    [row[0] for row in rows],
+                    texts={"document_id": [row[1] for row in rows]},
+                    matrices={
+                        "signatures": np.stack([np.frombuffer(row[2], dtype=np.uint32) for row in rows])
+                    },
+                )
+    return writer.finish()
+
+
+def _export_duplicate_links(
+    writer: SnapshotSectionWriter, logical: str, batch_size: int
+) -> Dict[str, Any]:
+    if CHUNK_DEDUP_ENABLED:
+        with dedup_connection() as conn:
+            cursor = conn.execute(
+                """
+                SELECT chunk_id, document_id, original_chunk_id, original_document_id
+                FROM chunk_duplicates WHERE collection = ?
+                """,
+                (logical,),
+            )
+            while rows := cursor.fetchmany(batch_size):
+                writer.add_rows(
+                    [row[0] for row in rows],
+                    texts={
+                        "document_id": [row[1] for row in rows],
+                        "original_chunk_id": [row[2] for row in rows],
+                        "original_document_id": [row[3] for row in rows],
+                    },
+                )
+    return writer.finish()
+
+
+def _export_document_store(
+    documents: SnapshotSectionWriter, pages: SnapshotSectionWriter, logical: str, batch_size: int
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    with doc_store_connection() as conn:
+        cursor = conn.execute("SELECT * FROM documents WHERE collection = ?", (logical,))
+        while rows := cursor.fetchmany(batch_size):
+            documents.add_rows(
+                [row["document_id"] for row in rows],
+                metadatas=[
+                    {key: row[key] for key in row.keys() if key not in {"collection", "document_id"}}
+                    for row in rows
+                ],
+            )
+        cursor = conn.execute(
+            "SELECT document_id, page, text FROM document_pages WHERE collection = ? ORDER BY id",
+            (logical,),
+        )
+        while rows := cursor.fetchmany(batch_size):
+            pages.add_rows(
+                [row["document_id"] for row in rows],
+                texts={"text": [row["text"] for row in rows]},
+                metadatas=[{"page": row["page"]} for row in rows],
+            )
+    return documents.finish(), pages.finish()
+
+
+def export_collection_snapshot(logical: str) -> Tuple[Path, Dict[str, Any]]:
+    """เขียน snapshot ของ collection (chunk + เวกเตอร์ระดับหน้า + fingerprint + ข้อความรายหน้า) เป็นไฟล์ zip"""
+    physical, embed_model = resolve_collection(logical)
+    batch_size = snapshot_batch_size()
+    workdir = Path(tempfile.mkdtemp(prefix="export_", dir=SNAPSHOT_DIR))
+    try:
+        sections = {
+            "chunks": _export_chroma_section(
+                SnapshotSectionWriter(workdir, "chunks"), get_collection(physical), batch_size
+            ),
+            "pages": _export_chroma_section(
+                SnapshotSectionWriter(workdir, "pages"), get_page_collection(physical), batch_size
+            ),
+            "fingerprints": _export_fingerprints(
+                SnapshotSectionWriter(workdir, "fingerprints"), logical, batch_size
+            ),
+            "duplicate_links": _export_duplicate_links(
+                SnapshotSectionWriter(workdir, "duplicate_links"), logical, batch_size
+            ),
+        }
+        sections["documents"], sections["document_pages"] = _export_document_store(
+            SnapshotSectionWriter(workdir, "documents"),
+            SnapshotSectionWriter(workdir, "document_pages"),
+            logical,
+            batch_size,
+        )
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "collection": logical,
+            "embed_model": embed_model,
+            "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "sections": sections,
+        }
+        (workdir / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        snapshot_path = SNAPSHOT_DIR / f"{logical}-{stamp}-{uuid.uuid4().hex[:6]}.ddsnap"
+        with zipfile.ZipFile(snapshot_path, "w", allowZip64=True) as archive:
+            for path in sorted(workdir.rglob("*")):
+                if not path.is_file():
+                    continue
+                compress_type = (
+                    zipfile.ZIP_STORED
+                    if path.suffix in SNAPSHOT_STORED_SUFFIXES
+                    else zipfile.ZIP_DEFLATED
+                )
+                archive.write(path, path.relative_to(workdir).as_posix(), compress_type=compress_type)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return snapshot_path, manifest
+
+
+def _read_snapshot_manifest(archive: zipfile.ZipFile) -> Dict[str, Any]:
+    try:
+        manifest = json.loads(archive.read("manifest.json"))
+    except (KeyError, json.JSONDecodeError) as exc:
+        raise HTTPException(status_code=400, detail="ไม่พบ manifest ใน snapshot") from exc
+    if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") != SNAPSHOT_VERSION:
+        raise HTTPException(status_code=400, detail="รูปแบบ snapshot ไม่รองรับ")
+    return manifest
+
+
+def _clear_document_store(logical: str) -> None:
+    with doc_store_connection() as conn:
+        conn.execute("DELETE FROM document_pages WHERE collection = ?", (logical,))
+        conn.execute("DELETE FROM documents WHERE collection = ?", (logical,))
+        conn.commit()
+
+
+def _import_documents(logical: str, batch: Dict[str, Any]) -> None:
+    with doc_store_connection() as conn:
+        conn.executemany(
+            "DELETE FROM document_pages WHERE collection = ? AND document_id = ?",
+            [(logical, document_id) for document_id in batch["ids"]],
+        )
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO documents
+            (collection, document_id, filename, storage_path, file_type, correlation_id,
+             extra_metadata, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    logical,
+                    document_id,
+                    meta.get("filename"),
+                    meta.get("storage_path"),
+                    meta.get("file_type"),
+                    meta.get("correlation_id"),
+                    meta.get("extra_metadata") or "{}",
+                    meta.get("updated_at") or datetime.utcnow().isoformat(timespec="seconds"),
+                )
+                for document_id, meta in zip(batch["ids"], batch["metadatas"])
+            ],
+        )
+        conn.commit()
+
+
+def _import_document_pages(logical: str, batch: Dict[str, Any]) -> None:
+    with doc_store_connection() as conn:
+        conn.executemany(
+            "INSERT INTO document_pages (collection, document_id, page, text) VALUES (?, ?, ?, ?)",
+            [
+                (logical, document_id, int(meta.get("page", 1)), text)
+                for document_id, text, meta in zip(batch["ids"], batch["text"], batch["metadatas"])
+            ],
+        )
+        conn.commit()
+
+
+def import_collection_snapshot(logical: str, source: BinaryIO, replace: bool) -> Dict[str, Any]:
+    """โหลด snapshot เข้า collection เป็น batch ใหญ่ (ผู้เรียกต้องถือ collection_write_lock)"""
+    try:
+        archive = zipfile.ZipFile(source)
+    except zipfile.BadZipFile as exc:
+        raise HTTPException(status_code=400, detail="ไฟล์ snapshot ไม่ถูกต้อง") from exc
+    with archive:
+        manifest = _read_snapshot_manifest(archive)
+        sections = manifest["sections"]
+        embed_model = manifest["embed_model"]
+        physical, current_model = resolve_collection(logical)
+        if replace:
+            drop_physical_collection(physical)
+            if physical != logical:
+                drop_physical_collection(logical)
+            if CHUNK_DEDUP_ENABLED:
+                _drop_fingerprint_namespace(logical)
+            _clear_document_store(logical)
+            physical = logical
+        elif logical in _collection_state and current_model != embed_model:
+            raise HTTPException(
+                status_code=409,
+                detail=f"collection ใช้โมเดล {current_model} แต่ snapshot ใช้ {embed_model} (ใช้ replace=true)",
+            )
+        _save_collection_state(logical, physical, embed_model)
+
+        batch_size = snapshot_batch_size()
+        loaded = {name: 0 for name in sections}
+        for name, target in (
+            ("chunks", get_collection(physical)),
+            ("pages", get_page_collection(physical)),
+        ):
+            for batch in iter_snapshot_section(archive, name, sections[name], batch_size):
+                target.upsert(
+                    ids=batch["ids"],
+                    embeddings=batch["vectors"].astype(np.float32).tolist(),
+                    documents=batch["documents"],
+                    metadatas=batch["metadatas"],
+                )
+                loaded[name] += len(batch["ids"])
+        if CHUNK_DEDUP_ENABLED:
+            for batch in iter_snapshot_section(
+                archive, "fingerprints", sections["fingerprints"], batch_size
+            ):
+                _store_fingerprint_rows(
+                    logical, list(zip(batch["ids"], batch["document_id"], batch["signatures"]))
+                )
+                loaded["fingerprints"] += len(batch["ids"])
+            # snapshot รุ่นก่อนไม่มี section นี้
+            for batch in iter_snapshot_section(
+                archive, "duplicate_links", sections.get("duplicate_links") or {}, batch_size
+            ):
+                _store_duplicate_links(
+                    logical,
+                    list(
+                        zip(
+                            batch["ids"],
+                            batch["document_id"],
+                            batch["original_chunk_id"],
+                            batch["original_document_id"],
+                        )
+                    ),
+                )
+                loaded["duplicate_links"] += len(batch["ids"])
+        for batch in iter_snapshot_section(archive, "documents", sections["documents"], batch_size):
+            _import_documents(logical, batch)
+            loaded["documents"] += len(batch["ids"])
+        for batch in iter_snapshot_section(
+            archive, "document_pages", sections["document_pages"], batch_size
+        ):
+            _import_document_pages(logical, batch)
+            loaded["document_pages"] += len(batch["ids"])
+    return {
+        "collection": logical,
+        "physical": physical,
+        "embed_model": embed_model,
+        "replaced": replace,
+        "loaded": loaded,
+        "snapshot_created_at": manifest.get("created_at"),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Local retrieval + hedged RAG queries
+# ---------------------------------------------------------------------------
+
+# (documents, metadatas, distances, candidate_pages, retrieval_mode)
+RetrievalResult = Tuple[List[str], List[dict], List[float], Optional[int], Optional[str]]
+
+# ระยะเวลาที่ Supermemory ใช้ตอบ (ms) ล่าสุด ใช้คำนวณ deadline ก่อนยิง Chroma คู่ขนาน
+_supermemory_latencies: Deque[float] = deque(maxlen=max(RAG_HEDGE_WINDOW, 1))
+
+
+# physical collection ที่ยังเติม page_key ให้ chunk รุ่นเก่าไม่เสร็จ (two-stage จะมองไม่เห็น chunk เหล่านั้น)
+_page_coverage_pending: set[str] = set()
+
+
+def local_index_enabled() -> bool:
+    return RAG_BACKEND == "chroma" or RAG_HEDGE_ACTIVE
+
+
+async def ensure_page_coverage(physical: str) -> None:
+    _page_coverage_pending.add(physical)
+    try:
+        counts = await asyncio.to_thread(backfill_page_coverage, physical)
+    except Exception as exc:
+        # ค้างสถานะ pending ไว้ ให้ two_stage ถอยไปใช้ flat ต่อจนกว่าจะ restart
+        logger.warning(
+            "page_coverage_backfill_failed",
+            extra={"fields": {"collection": physical, "error": str(exc)}},
+        )
+        return
+    _page_coverage_pending.discard(physical)
+    if counts["documents"]:
+        logger.info(
+            "page_coverage_backfilled", extra={"fields": {"collection": physical, **counts}}
+        )
+
+
+async def chroma_query(
+    question: str,
+    top_k: int,
+    collection_name: str,
+    retrieval_mode: str,
+    page_candidates: int,
+) -> RetrievalResult:
+    # ใช้ physical collection + โมเดลที่ resolve ครั้งเดียว เพื่อให้สลับ collection ได้แบบ atomic
+    physical, embed_model = resolve_collection(collection_name)
+    query_vector = await asyncio.to_thread(embed_query, question, embed_model)
+    if retrieval_mode == "two_stage" and physical not in _page_coverage_pending:
+        staged = await asyncio.to_thread(
+            two_stage_query, physical, query_vector, top_k, page_candidates
+        )
+        if staged is not None:
+            documents, metadatas, distances, candidate_pages = staged
+            return documents, metadatas, distances, candidate_pages, retrieval_mode
+        # ยังไม่มีเวกเตอร์ระดับหน้า ให้ค้นแบบ flat แทน
+    results = await asyncio.to_thread(
+        get_collection(physical).query,
+        query_embeddings=[query_vector],
+        n_results=top_k,
+        include=["documents", "metadatas", "distances"],
+    )
+    return (
+        results.get("documents", [[]])[0],
+        results.get("metadatas", [[]])[0],
+        results.get("distances", [[]])[0],
+        None,
+        "flat",
+    )
+
+
+async def timed_supermemory_query(question: str, top_k: int, collection: str) -> RetrievalResult:
+    started = time.perf_counter()
+    documents, metadatas, distances = await supermemory_query(question, top_k, collection)
+    # เก็บเฉพาะคำขอที่สำเร็จ: error เร็ว (401/connect refused) หรือ timeout จะทำให้ p95 เพี้ยน
+    _supermemory_latencies.append((time.perf_counter() - started) * 1000)
+    return documents, metadatas, distances, None, None
+
+
+def hedge_delay_ms() -> float:
+    if len(_supermemory_latencies) < RAG_HEDGE_MIN_SAMPLES:
+        return RAG_HEDGE_MAX_DELAY_MS
+    observed = float(np.percentile(np.fromiter(_supermemory_latencies, dtype=float), RAG_HEDGE_PERCENTILE))
+    return min(max(observed, RAG_HEDGE_MIN_DELAY_MS), RAG_HEDGE_MAX_DELAY_MS)
+
+
+def _discard_task_result(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+async def hedged_query(
+    question: str,
+    top_k: int,
+    collection_name: str,
+    retrieval_mode: str,
+    page_candidates: int,
+) -> Tuple[str, RetrievalResult, Dict[str, Any]]:
+    """ถาม Supermemory ก่อน ถ้าเกิน deadline (p95) หรือผิดพลาด ให้ยิง Chroma คู่ขนาน แล้วใช้คำตอบแรกที่ใช้ได้"""
+    delay_ms = hedge_delay_ms()
+    info: Dict[str, Any] = {"hedge_delay_ms": round(delay_ms, 2), "hedged": False}
+    primary = asyncio.create_task(timed_supermemory_query(question, top_k, collection_name))
+    # ปล่อยให้ Supermemory ทำงานจนจบแม้แพ้ เพื่อให้สถิติ latency ไม่เอนไปทางเร็ว
+    primary.add_done_callback(_discard_task_result)
+    done, _ = await asyncio.wait({primary}, timeout=delay_ms / 1000)
+    if primary in done and primary.exception() is None:
+        HEDGE_COUNTER.labels(outcome="primary").inc()
+        return "supermemory", primary.result(), info
+
+    info["hedged"] = True
+    hedge = asyncio.create_task(
+        chroma_query(question, top_k, collection_name, retrieval_mode, page_candidates)
+    )
+    hedge.add_done_callback(_discard_task_result)
+    pending = {hedge} if primary in done else {primary, hedge}
+    empty_local: Optional[RetrievalResult] = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if hedge in done and hedge.exception() is None:
+            result = hedge.result()
+            # Chroma ว่าง (เช่น เอกสารเก่าที่ยังไม่ได้ dual-write) ให้รอ Supermemory ต่อ
+            if result[0] or primary.done():
+                HEDGE_COUNTER.labels(outcome="hedge").inc()
+                return "chroma", result, info
+            empty_local = result
+        if primary in done and primary.exception() is None:
+            hedge.cancel()
+            HEDGE_COUNTER.labels(outcome="primary_late").inc()
+            return "supermemory", primary.result(), info
+    if empty_local is not None:
+        HEDGE_COUNTER.labels(outcome="hedge").inc()
+        return "chroma", empty_local, info
+    HEDGE_COUNTER.labels(outcome="failed").inc()
+    raise primary.exception()
+
+
+# ---------------------------------------------------------------------------
+# Helper utilities
+# ---------------------------------------------------------------------------
+
+SUPPORTED_IMAGE_TYPES = {"image/png", "image/jpeg", "image/jpg", "image/bmp", "image/webp"}
+SUPPORTED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".webp", ".pdf", ".docx"}
+
+
+def detect_file_type(filename: str, content_type: str | None) -> str:
+    ext = Path(filename or "").suffix.lower()
+    if content_type in SUPPORTED_IMAGE_TYPES or ext in {".png", ".jpg", ".jpeg", ".bmp", ".webp"}:
+        return "image"
+    if content_type == "application/pdf" or ext == ".pdf":
+        return "pdf"
+    if content_type in {"application/vnd.openxmlformats-officedocument.wordprocessingml.document"} or ext == ".docx":
+        return "docx"
+    raise HTTPException(status_code=415, detail="ไฟล์ที่อัปโหลดยังไม่รองรับ (รองรับ: png/jpg/webp/pdf/docx)")
+
+
+async def save_upload(filename: str, data: bytes) -> Path:
+    safe_name = f"{uuid.uuid4().hex}_{Path(filename).name}"
+    path = UPLOAD_DIR / safe_name
+    await asyncio.to_thread(path.write_bytes, data)
+    return path
+
+
+async def convert_pdf_to_images(data: bytes) -> List[np.ndarray]:
+    pages = await asyncio.to_thread(convert_from_bytes, data, dpi=220)
+    images = [cv2.cvtColor(np.array(page), cv2.COLOR_RGB2BGR) for page in pages]
+    return images
+
+
+def extract_docx_text(data: bytes) -> str:
+    document = Document(io.BytesIO(data))
+    lines = [para.text.strip() for para in document.paragraphs if para.text.strip()]
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# Post-ingest webhook outbox
+# ---------------------------------------------------------------------------
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox (status, next_attempt_at);
+"""
+
+_webhook_wakeup = asyncio.Event()
+
+
+@contextmanager
+def outbox_connection() -> Any:
+    conn = sqlite3.connect(WEBHOOK_OUTBOX_PATH, timeout=5)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_outbox() -> None:
+    with outbox_connection() as conn:
+        conn.executescript(OUTBOX_SCHEMA)
+        conn.commit()
+
+
+def _enqueue_webhook(payload: dict) -> None:
+    with outbox_connection() as conn:
+        conn.execute(
+            "INSERT INTO webhook_outbox (payload, next_attempt_at, created_at) VALUES (?, ?, ?)",
+            (
+                json.dumps(payload, ensure_ascii=False),
+                time.time(),
+                datetime.utcnow().isoformat(timespec="seconds"),
+            ),
+        )
+        conn.commit()
+
+
+def _due_webhooks(limit: int) -> List[Tuple[int, str, int]]:
+    with outbox_connection() as conn:
+        return conn.execute(
+            """
+            SELECT id, payload, attempts FROM webhook_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+            """,
+            (time.time(), limit),
+        ).fetchall()
+
+
+def _settle_webhooks(
+    delivered: List[int], failed: List[Tuple[int, int, str]]
+) -> Dict[str, int]:
+    """ลบรายการที่ส่งสำเร็จ, เลื่อนเวลาส่งใหม่ของรายการที่ล้มเหลว แล้วคืนจำนวนที่ค้างตามสถานะ"""
+    now = time.time()
+    retry_rows = []
+    for row_id, attempts, error in failed:
+        delay = min(WEBHOOK_RETRY_MAX_SECONDS, WEBHOOK_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+        status = "dead" if attempts >= WEBHOOK_MAX_ATTEMPTS else "pending"
+        next_attempt_at = now + random.uniform(0.5, 1.0) * delay
+        retry_rows.append((status, attempts, next_attempt_at, error[:500], row_id))
+    with outbox_connection() as conn:
+        conn.executemany(
+            "DELETE FROM webhook_outbox WHERE id = ?", [(row_id,) for row_id in delivered]
+        )
+        conn.executemany(
+            """
+            UPDATE webhook_outbox
+            SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+            """,
+            retry_rows,
+        )
+        conn.commit()
+        counts = dict(
+            conn.execute("SELECT status, COUNT(*) FROM webhook_outbox GROUP BY status").fetchall()
+        )
+    return {"pending": counts.get("pending", 0), "dead": counts.get("dead", 0)}
+
+
+async def deliver_webhook(payload: dict) -> None:
+    headers = {"Content-Type": "application/json"}
+    if SUPER_MEMORY_TOKEN:
+        headers["Authorization"] = f"Bearer {SUPER_MEMORY_TOKEN}"
+    # outbox ดูแลการ retry เอง จึงไม่ให้ client retry ซ้อน
+    response = await supermemory_request(
+        SUPER_MEMORY_WEBHOOK,
+        payload,
+        endpoint="webhook",
+        headers=headers,
+        timeout=10,
+        max_retries=0,
+    )
+    if response.status_code >= 400:
+        raise SupermemoryError(f"{response.status_code}: {response.text[:200]}")
+
+
+async def dispatch_webhooks() -> int:
+    rows = await asyncio.to_thread(_due_webhooks, max(WEBHOOK_BATCH_SIZE, 1))
+    results = await asyncio.gather(
+        *(deliver_webhook(json.loads(payload)) for _, payload, _ in rows), return_exceptions=True
+    )
+    delivered: List[int] = []
+    failed: List[Tuple[int, int, str]] = []
+    for (row_id, _, attempts), result in zip(rows, results):
+        if isinstance(result, BaseException):
+            failed.append((row_id, attempts + 1, str(result)))
+            result_label = "dead" if attempts + 1 >= WEBHOOK_MAX_ATTEMPTS else "retry"
+            WEBHOOK_DELIVERY_COUNTER.labels(result=result_label).inc()
+            logger.warning(
+                "supermemory_webhook_failed",
+                extra={
+                    "fields": {
+                        "outbox_id": row_id,
+                        "attempts": attempts + 1,
+                        "error": str(result),
+                    }
+                },
+            )
+        else:
+            delivered.append(row_id)
+            WEBHOOK_DELIVERY_COUNTER.labels(result="delivered").inc()
+    backlog = await asyncio.to_thread(_settle_webhooks, delivered, failed)
+    for status, count in backlog.items():
+        WEBHOOK_OUTBOX_BACKLOG.labels(status=status).set(count)
+    return len(rows)
+
+
+async def webhook_dispatcher() -> None:
+    while True:
+        try:
+            processed = await dispatch_webhooks()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pragma: no cover - ไม่ให้ loop ตาย
+            logger.warning("webhook_dispatch_failed", extra={"fields": {"error": str(exc)}})
+            processed = 0
+        if processed >= WEBHOOK_BATCH_SIZE:
+            continue
+        _webhook_wakeup.clear()
+        try:
+            await asyncio.wait_for(_webhook_wakeup.wait(), timeout=WEBHOOK_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def maybe_notify_supermemory(payload: dict) -> None:
+    """บันทึก webhook ลง outbox แล้วให้ dispatcher เบื้องหลังส่ง (ไม่รอผู้รับ)"""
+    if not SUPER_MEMORY_WEBHOOK:
+        return
+    try:
+        await asyncio.to_thread(_enqueue_webhook, payload)
+    except sqlite3.Error as exc:
+        logger.warning("webhook_enqueue_failed", extra={"fields": {"error": str(exc)}})
+        return
+    _webhook_wakeup.set()
+
+
+# ---------------------------------------------------------------------------
+# Readiness cache
+# ---------------------------------------------------------------------------
+
+_ready_state: Dict[str, Any] = {"snapshot": None, "checked_at": 0.0}
+_ready_lock = asyncio.Lock()
+
+
+async def probe_readiness() -> Dict[str, Any]:
+    """ตรวจ backend จริง (นับเอกสาร) แล้วคืนผลในรูปแบบที่ /ready ส่งออก"""
+    physical, embed_model = resolve_collection(CHROMA_COLLECTION)
+    snapshot: Dict[str, Any] = {
+        "ok": True,
+        "collection": CHROMA_COLLECTION,
+        "embed_model": embed_model,
+        "rag_backend": RAG_BACKEND,
+        "embed_migration": None,
+        "checked_at": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+    try:
+        if RAG_BACKEND == "chroma":
+            snapshot["documents"] = await asyncio.to_thread(get_collection(physical).count)
+            snapshot["embed_migration"] = await asyncio.to_thread(
+                running_migration_for, CHROMA_COLLECTION
+            )
+        else:
+            snapshot["documents"] = await supermemory_count(CHROMA_COLLECTION)
+    except Exception as exc:
+        snapshot.update({"ok": False, "error": str(exc)})
+    return snapshot
+
+
+async def refresh_readiness(seen_checked_at: Optional[float] = None) -> Tuple[Dict[str, Any], bool]:
+    async with _ready_lock:
+        if seen_checked_at is not None and _ready_state["checked_at"] != seen_checked_at:
+            # มีคำขออื่นรีเฟรชเสร็จระหว่างรอ lock แล้ว ใช้ผลนั้นแทนการยิง backend ซ้ำ
+            return _ready_state["snapshot"], False
+        snapshot = await probe_readiness()
+        _ready_state.update({"snapshot": snapshot, "checked_at": time.monotonic()})
+    if not snapshot["ok"]:
+        logger.warning("readiness_probe_failed", extra={"fields": {"error": snapshot.get("error")}})
+    return snapshot, True
+
+
+async def readiness_refresher() -> None:
+    while True:
+        try:
+            await refresh_readiness()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pragma: no cover - ไม่ให้ loop ตาย
+            logger.warning("readiness_refresh_failed", extra={"fields": {"error": str(exc)}})
+        await asyncio.sleep(READY_REFRESH_SECONDS)
+
+
+async def cached_readiness(fresh: bool = False) -> Tuple[Dict[str, Any], float, bool]:
+    """คืน (ผลตรวจ, อายุของผลเป็นวินาที, มาจาก cache หรือไม่)"""
+    snapshot = _ready_state["snapshot"]
+    checked_at = _ready_state["checked_at"]
+    cached = True
+    if fresh or snapshot is None or time.monotonic() - checked_at > READY_CACHE_TTL_SECONDS:
+        snapshot, probed = await refresh_readiness(None if fresh else checked_at)
+        cached = not probed
+    return snapshot, time.monotonic() - _ready_state["checked_at"], cached
+
+
+# ---------------------------------------------------------------------------
+# FastAPI routes
+# ---------------------------------------------------------------------------
+
+_background_tasks: List[asyncio.Task] = []
+
+
+@app.on_event("startup")
+async def startup_event():
     loop = asyncio.get_running_loop()
     await loop.run_in_executor(None, init_trace_db)
+    await trace_writer.start()
+    await loop.run_in_executor(None, init_embed_cache)
+    await loop.run_in_executor(None, init_dedup_db)
+    await loop.run_in_executor(None, init_doc_store)
+    await loop.run_in_executor(None, init_outbox)
     await select_rag_backend()
     logger.info(
         "startup",
@@ -765,9 +3977,32 @@ async def startup_event():
             }
         },
     )
-    if RAG_BACKEND == "chroma":
-        await loop.run_in_executor(None, get_embedder)
-        await loop.run_in_executor(None, get_collection, CHROMA_COLLECTION)
+    if local_index_enabled():
+        physical, embed_model = await loop.run_in_executor(
+            None, ensure_collection_state, CHROMA_COLLECTION
+        )
+        registered = await loop.run_in_executor(None, register_existing_collections)
+        if registered:
+            logger.info("collections_registered", extra={"fields": {"collections": registered}})
+        await loop.run_in_executor(None, get_embedder, embed_model)
+        await loop.run_in_executor(None, get_collection, physical)
+        await resume_embed_migrations()
+        await drop_retired_migration_sources()
+        for target in {physical, *(state[0] for state in _collection_state.values())}:
+            _page_coverage_pending.add(target)
+            _background_tasks.append(asyncio.create_task(ensure_page_coverage(target)))
+    _background_tasks.append(asyncio.create_task(readiness_refresher()))
+    _background_tasks.append(asyncio.create_task(trace_compactor()))
+    if SUPER_MEMORY_WEBHOOK:
+        _background_tasks.append(asyncio.create_task(webhook_dispatcher()))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in _background_tasks:
+        task.cancel()
+    await trace_writer.stop()
+    await close_supermemory_client()
 
 
 @app.get("/health")
@@ -782,22 +4017,16 @@ async def health():
 
 
 @app.get("/ready")
-async def ready():
-    try:
-        if RAG_BACKEND == "chroma":
-            collection = get_collection(CHROMA_COLLECTION)
-            count = collection.count()
-        else:
-            count = await supermemory_count(CHROMA_COLLECTION)
-        return {
-            "ok": True,
-            "collection": CHROMA_COLLECTION,
-            "documents": count,
-            "embed_model": EMBED_MODEL_NAME,
-            "rag_backend": RAG_BACKEND,
-        }
-    except Exception as exc:  # pragma: no cover
-        raise HTTPException(status_code=503, detail=str(exc)) from exc
+async def ready(fresh: bool = False):
+    snapshot, age, cached = await cached_readiness(fresh)
+    if not snapshot["ok"]:
+        raise HTTPException(status_code=503, detail=snapshot.get("error"))
+    return {
+        **snapshot,
+        "cached": cached,
+        "age_seconds": round(age, 3),
+        "hedge_delay_ms": round(hedge_delay_ms(), 2) if RAG_HEDGE_ACTIVE else None,
+    }
 
 
 @app.get("/startup")
@@ -819,22 +4048,128 @@ async def ocr_endpoint(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
 
-@app.post("/ingest")
-async def ingest(
+async def index_chunks_locally(
+    logical: str,
+    document_id: str,
+    chunks: List[str],
+    metadata: List[dict],
+    embed_model: str,
+    fingerprints: List[Tuple[str, np.ndarray]],
+    pages: List[Dict[str, object]],
+    document_info: Dict[str, Any],
+    *,
+    replacing: bool = False,
+    duplicate_links: Optional[List[DuplicateLink]] = None,
+) -> Dict[str, Any]:
+    embeddings: Optional[np.ndarray] = None
+    cache_stats: Dict[str, Any] = {}
+    if chunks:
+        embeddings, cache_stats = await embed_chunks(chunks, embed_model)
+    async with collection_write_lock(logical):
+        physical, active_model = await asyncio.to_thread(ensure_collection_state, logical)
+        if chunks and active_model != embed_model:
+            # collection ถูกสลับไปใช้โมเดลใหม่ระหว่างรอ lock
+            embeddings, cache_stats = await embed_chunks(chunks, active_model)
+        if replacing:
+            for physical_target in await asyncio.to_thread(document_vector_targets, logical):
+                stale_ids, _ = await asyncio.to_thread(
+                    find_document_chunks, physical_target, document_id
+                )
+                await asyncio.to_thread(
+                    delete_document_vectors, physical_target, document_id, stale_ids
+                )
+            await forget_fingerprints(logical, document_id)
+        result: Dict[str, Any] = {"chunks_added": 0}
+        if chunks and embeddings is not None:
+            result = await asyncio.to_thread(
+                write_chunks, physical, document_id, chunks, metadata, embeddings
+            )
+        result["embedding_cache"] = cache_stats
+        await record_fingerprints(logical, document_id, fingerprints, duplicate_links)
+        await asyncio.to_thread(store_document_pages, logical, document_id, pages, document_info)
+    return result
+
+
+async def reindex_duplicate_dependents(logical: str, document_id: str) -> int:
+    """สร้าง index ใหม่ให้เอกสารที่มี chunk ถูกตัดเพราะซ้ำกับ document_id
+
+    เรียกหลังลบ/แทนที่เอกสารต้นฉบับ (นอก collection_write_lock) เพื่อให้ chunk ที่ถูกตัด
+    กลับเข้า index หรือผูกกับต้นฉบับตัวใหม่ แทนที่จะหายไปเงียบ ๆ
+    """
+    if not CHUNK_DEDUP_ENABLED:
+        return 0
+    try:
+        dependents = await asyncio.to_thread(_duplicate_dependents, logical, document_id)
+    except sqlite3.Error as exc:
+        logger.warning("chunk_duplicate_lookup_failed", extra={"fields": {"error": str(exc)}})
+        return 0
+    reindexed = 0
+    for dependent in dependents:
+        try:
+            loaded = await asyncio.to_thread(load_document, logical, dependent)
+            if loaded is None:
+                logger.warning(
+                    "duplicate_dependent_missing_pages",
+                    extra={"fields": {"document_id": dependent, "original": document_id}},
+                )
+                continue
+            info, pages, _ = loaded
+            embed_model = resolve_collection(logical)[1]
+            chunks, metadata = await asyncio.to_thread(
+                build_chunks, dependent, pages, info, embed_model
+            )
+            chunks, metadata, fingerprints, links, _ = await suppress_near_duplicates(
+                logical, dependent, chunks, metadata, replacing=True
+            )
+            await index_chunks_locally(
+                logical,
+                dependent,
+                chunks,
+                metadata,
+                embed_model,
+                fingerprints,
+                pages,
+                info,
+                replacing=True,
+                duplicate_links=links,
+            )
+            reindexed += 1
+        except Exception as exc:
+            logger.warning(
+                "duplicate_dependent_reindex_failed",
+                extra={
+                    "fields": {"document_id": dependent, "original": document_id, "error": str(exc)}
+                },
+            )
+    return reindexed
+
+
+async def ingest_document(
     request: Request,
-    file: UploadFile = File(...),
-    collection: Optional[str] = Form(None),
-    metadata: Optional[str] = Form(None),
-    source: Optional[str] = Form(None),
-):
+    file: UploadFile,
+    collection: Optional[str],
+    metadata: Optional[str],
+    source: Optional[str],
+    *,
+    document_id: Optional[str] = None,
+) -> JSONResponse:
     raw = await file.read()
     if not raw:
         raise HTTPException(status_code=400, detail="ไฟล์ว่างเปล่า")
 
     target_collection = collection or CHROMA_COLLECTION
     file_type = detect_file_type(file.filename, file.content_type)
+    replacing = document_id is not None
+    previous_chunk_ids: List[str] = []
+    previous_paths: List[str] = []
+    if replacing:
+        previous_chunk_ids, previous_paths, exists = await asyncio.to_thread(
+            locate_document, target_collection, document_id
+        )
+        if not exists:
+            raise HTTPException(status_code=404, detail="ไม่พบเอกสารที่ต้องการแทนที่")
     saved_path = await save_upload(file.filename or "upload", raw)
-    doc_id = uuid.uuid4().hex
+    doc_id = document_id or uuid.uuid4().hex
     correlation_id = request.headers.get("X-Correlation-ID")
 
     extra_metadata: Dict[str, Any] = {}
@@ -871,57 +4206,97 @@ async def ingest(
     else:
         raise HTTPException(status_code=415, detail="ไฟล์ยังไม่รองรับ")
 
-    all_chunks: List[str] = []
-    metadata: List[dict] = []
-    for page in pages:
-        page_text: str = page["text"] or ""
-        chunks = chunk_text(page_text)
-        for idx, chunk in enumerate(chunks):
-            all_chunks.append(chunk)
-            meta_entry = {
-                "document_id": doc_id,
-                "filename": file.filename,
-                "storage_path": str(saved_path),
-                "page": page.get("page", 1),
-                "chunk": idx,
-                "correlation_id": correlation_id,
-                "file_type": file_type,
-            }
-            if extra_metadata:
-                meta_entry.update(extra_metadata)
-            metadata.append(meta_entry)
+    document_info: Dict[str, Any] = {
+        "filename": file.filename,
+        "storage_path": str(saved_path),
+        "file_type": file_type,
+        "correlation_id": correlation_id,
+        "extra_metadata": extra_metadata,
+    }
+    embed_model = resolve_collection(target_collection)[1]
+    # tokenize ทั้งไฟล์กิน CPU นาน จึงย้ายไป thread ไม่ให้บล็อก event loop
+    all_chunks, metadata = await asyncio.to_thread(
+        build_chunks, doc_id, pages, document_info, embed_model
+    )
 
     if not all_chunks:
         raise HTTPException(status_code=422, detail="ไม่พบข้อความจากไฟล์ที่อัปโหลด")
 
+    total_chunks = len(all_chunks)
+    (
+        all_chunks,
+        metadata,
+        fingerprints,
+        duplicate_links,
+        duplicates_skipped,
+    ) = await suppress_near_duplicates(
+        target_collection, doc_id, all_chunks, metadata, replacing=replacing
+    )
+
     backend_result: Dict[str, Any] = {}
     request_started = time.perf_counter()
     status_label = "success"
     try:
         if RAG_BACKEND == "supermemory":
-            backend_result = await supermemory_ingest(
-                document_id=doc_id,
-                collection=target_collection,
-                filename=file.filename,
-                file_type=file_type,
-                chunks=all_chunks,
-                metadata_entries=metadata,
-            )
+            backend_result = {"chunks_added": 0}
+            if all_chunks:
+                backend_result = await supermemory_ingest(
+                    document_id=doc_id,
+                    collection=target_collection,
+                    filename=file.filename,
+                    file_type=file_type,
+                    chunks=all_chunks,
+                    metadata_entries=metadata,
+                )
+                if backend_result.get("parts_failed"):
+                    status_label = "partial"
+            local_result: Optional[Dict[str, Any]] = None
+            if RAG_HEDGE_ACTIVE:
+                # dual-write ลง Chroma เพื่อให้ hedged query มีคำตอบสำรอง (ไม่ให้ ingest ล้มตาม)
+                try:
+                    local_result = await index_chunks_locally(
+                        target_collection,
+                        doc_id,
+                        all_chunks,
+                        metadata,
+                        embed_model,
+                        fingerprints,
+                        pages,
+                        document_info,
+                        duplicate_links=duplicate_links,
+                    )
+                except Exception as exc:
+                    logger.warning(
+                        "hedge_local_ingest_failed",
+                        extra={"fields": {"document_id": doc_id, "error": str(exc)}},
+                    )
+                backend_result["local_index"] = local_result
+            if local_result is None:
+                await record_fingerprints(target_collection, doc_id, fingerprints, duplicate_links)
+                await asyncio.to_thread(
+                    store_document_pages, target_collection, doc_id, pages, document_info
+                )
         else:
-            embedder = get_embedder()
-            loop = asyncio.get_running_loop()
-            embeddings = await loop.run_in_executor(
-                None, lambda: embedder.encode(all_chunks, convert_to_numpy=True)
+            backend_result = await index_chunks_locally(
+                target_collection,
+                doc_id,
+                all_chunks,
+                metadata,
+                embed_model,
+                fingerprints,
+                pages,
+                document_info,
+                replacing=replacing,
+                duplicate_links=duplicate_links,
+            )
+        if replacing:
+            backend_result["chunks_replaced"] = len(previous_chunk_ids)
+            backend_result["dependents_reindexed"] = await reindex_duplicate_dependents(
+                target_collection, doc_id
             )
-            collection_obj = get_collection(target_collection)
-            chunk_ids = [f"{doc_id}:{meta['page']}:{meta['chunk']}" for meta in metadata]
-            collection_obj.add(
-                ids=chunk_ids,
-                embeddings=embeddings.tolist(),
-                documents=all_chunks,
-                metadatas=metadata,
+            backend_result["files_removed"] = await asyncio.to_thread(
+                remove_stored_uploads, [p for p in previous_paths if p != str(saved_path)]
             )
-            backend_result = {"chunks_added": len(chunk_ids)}
     except SupermemoryError as exc:
         status_label = "failed"
         logger.exception(
@@ -939,12 +4314,15 @@ async def ingest(
     finally:
         duration_ms = (time.perf_counter() - request_started) * 1000
         TOOL_LATENCY.labels(operation="ingest", provider=RAG_BACKEND).observe(duration_ms / 1000)
-        REQUEST_COUNTER.labels(endpoint="/ingest", status=status_label).inc()
+        REQUEST_COUNTER.labels(
+            endpoint="/documents" if replacing else "/ingest", status=status_label
+        ).inc()
         await record_trace(
-            "ingest",
+            "replace" if replacing else "ingest",
             correlation_id,
             {
                 "chunks": len(all_chunks),
+                "duplicates_skipped": duplicates_skipped,
                 "collection": target_collection,
                 "filename": file.filename,
                 "backend": RAG_BACKEND,
@@ -958,6 +4336,8 @@ async def ingest(
         "ok": True,
         "document_id": doc_id,
         "chunks": len(all_chunks),
+        "chunks_total": total_chunks,
+        "duplicates_skipped": duplicates_skipped,
         "collection": target_collection,
         "filename": file.filename,
         "saved_path": str(saved_path),
@@ -966,6 +4346,22 @@ async def ingest(
     }
     if RAG_BACKEND == "supermemory":
         payload["supermemory_id"] = backend_result.get("id")
+        payload["supermemory_parts"] = backend_result.get("parts", [])
+        payload["partial"] = bool(backend_result.get("parts_failed"))
+        if payload["partial"]:
+            payload["ok"] = False
+            payload["status"] = "partial"
+            payload["retry_url"] = (
+                f"/documents/{doc_id}/supermemory/retry?collection={target_collection}"
+            )
+        if RAG_HEDGE_ACTIVE:
+            payload["local_index"] = backend_result.get("local_index")
+    else:
+        payload["embedding_cache"] = backend_result.get("embedding_cache")
+    if replacing:
+        payload["replaced"] = True
+        payload["chunks_replaced"] = backend_result.get("chunks_replaced", 0)
+        payload["dependents_reindexed"] = backend_result.get("dependents_reindexed", 0)
 
     await maybe_notify_supermemory(
         {
@@ -988,7 +4384,143 @@ async def ingest(
         },
     )
 
-    return JSONResponse(payload)
+    # 207: เอกสารเข้า Supermemory ไม่ครบทุก part ผู้เรียกต้องเรียก retry_url ต่อ
+    return JSONResponse(payload, status_code=207 if payload.get("partial") else 200)
+
+
+@app.post("/ingest")
+async def ingest(
+    request: Request,
+    file: UploadFile = File(...),
+    collection: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    source: Optional[str] = Form(None),
+):
+    return await ingest_document(request, file, collection, metadata, source)
+
+
+def _require_chroma_documents() -> None:
+    if RAG_BACKEND != "chroma":
+        raise HTTPException(
+            status_code=501, detail="การลบ/แทนที่เอกสารรองรับเฉพาะ backend chroma"
+        )
+
+
+@app.put("/documents/{document_id}")
+async def replace_document(
+    document_id: str,
+    request: Request,
+    file: UploadFile = File(...),
+    collection: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    source: Optional[str] = Form(None),
+):
+    _require_chroma_documents()
+    return await ingest_document(
+        request, file, collection, metadata, source, document_id=document_id
+    )
+
+
+@app.post("/documents/{document_id}/supermemory/retry")
+async def retry_document_supermemory(document_id: str, collection: Optional[str] = None):
+    if RAG_BACKEND != "supermemory":
+        raise HTTPException(status_code=501, detail="ใช้ได้เฉพาะ backend supermemory")
+    target_collection = collection or CHROMA_COLLECTION
+    started = time.perf_counter()
+    status_label = "success"
+    result: Dict[str, Any] = {}
+    try:
+        result = await retry_supermemory_ingest(target_collection, document_id)
+        if result["parts_failed"]:
+            status_label = "partial"
+    except HTTPException:
+        status_label = "not_found"
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        REQUEST_COUNTER.labels(endpoint="/documents/supermemory/retry", status=status_label).inc()
+        await record_trace(
+            "supermemory_retry",
+            get_correlation_id(),
+            {"document_id": document_id, "collection": target_collection},
+            {"status": status_label, "result": result},
+            duration_ms,
+            RAG_BACKEND,
+        )
+    payload = {
+        "ok": not result["parts_failed"],
+        "status": status_label,
+        "document_id": document_id,
+        "collection": target_collection,
+        **result,
+    }
+    return JSONResponse(payload, status_code=207 if result["parts_failed"] else 200)
+
+
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: str, collection: Optional[str] = None):
+    _require_chroma_documents()
+    target_collection = collection or CHROMA_COLLECTION
+    started = time.perf_counter()
+    status_label = "success"
+    chunk_ids: List[str] = []
+    files_removed = 0
+    dependents_reindexed = 0
+    try:
+        async with collection_write_lock(target_collection):
+            chunk_ids, storage_paths, exists = await asyncio.to_thread(
+                locate_document, target_collection, document_id
+            )
+            if not exists:
+                status_label = "not_found"
+                raise HTTPException(status_code=404, detail="ไม่พบเอกสาร")
+            for physical_target in await asyncio.to_thread(
+                document_vector_targets, target_collection
+            ):
+                stale_ids, _ = await asyncio.to_thread(
+                    find_document_chunks, physical_target, document_id
+                )
+                await asyncio.to_thread(
+                    delete_document_vectors, physical_target, document_id, stale_ids
+                )
+            await forget_fingerprints(target_collection, document_id)
+            await asyncio.to_thread(delete_document_pages, target_collection, document_id)
+        files_removed = await asyncio.to_thread(remove_stored_uploads, storage_paths)
+        dependents_reindexed = await reindex_duplicate_dependents(target_collection, document_id)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        status_label = "failed"
+        logger.exception(
+            "document_delete_failed",
+            extra={"fields": {"document_id": document_id, "error": str(exc)}},
+        )
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        REQUEST_COUNTER.labels(endpoint="/documents", status=status_label).inc()
+        await record_trace(
+            "delete",
+            get_correlation_id(),
+            {"document_id": document_id, "collection": target_collection},
+            {
+                "status": status_label,
+                "chunks_deleted": len(chunk_ids),
+                "files_removed": files_removed,
+                "dependents_reindexed": dependents_reindexed,
+            },
+            duration_ms,
+            RAG_BACKEND,
+        )
+
+    return {
+        "ok": True,
+        "document_id": document_id,
+        "collection": target_collection,
+        "chunks_deleted": len(chunk_ids),
+        "files_removed": files_removed,
+        "dependents_reindexed": dependents_reindexed,
+    }
 
 
 @app.post("/query")
@@ -998,6 +4530,14 @@ async def query(payload: dict):
         raise HTTPException(status_code=400, detail="ต้องระบุคำถาม q")
     top_k = int(payload.get("top_k", 4))
     collection_name = payload.get("collection") or CHROMA_COLLECTION
+    retrieval_mode = str(payload.get("retrieval_mode") or RETRIEVAL_MODE).strip().lower()
+    if retrieval_mode not in RETRIEVAL_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"retrieval_mode ไม่ถูกต้อง (รองรับ: {', '.join(sorted(RETRIEVAL_MODES))})",
+        )
+    page_candidates = int(payload.get("page_candidates") or RETRIEVAL_PAGE_CANDIDATES)
+    candidate_pages: Optional[int] = None
     documents: List[str] = []
     metadatas: List[dict] = []
     distances: List[float] = []
@@ -1005,23 +4545,22 @@ async def query(payload: dict):
     error_detail: Optional[str] = None
     backend_used = RAG_BACKEND
     fallback_used = False
+    hedge_info: Optional[Dict[str, Any]] = None
     started = time.perf_counter()
 
     try:
-        if RAG_BACKEND == "supermemory":
-            documents, metadatas, distances = await supermemory_query(
-                question, top_k, collection_name
+        if RAG_HEDGE_ACTIVE:
+            backend_used, result, hedge_info = await hedged_query(
+                question, top_k, collection_name, retrieval_mode, page_candidates
             )
+        elif RAG_BACKEND == "supermemory":
+            result = await supermemory_query(question, top_k, collection_name) + (None, None)
         else:
-            collection_obj = get_collection(collection_name)
-            results = collection_obj.query(
-                query_texts=[question],
-                n_results=top_k,
-                include=["documents", "metadatas", "distances"],
+            result = await chroma_query(
+                question, top_k, collection_name, retrieval_mode, page_candidates
             )
-            documents = results.get("documents", [[]])[0]
-            metadatas = results.get("metadatas", [[]])[0]
-            distances = results.get("distances", [[]])[0]
+        documents, metadatas, distances, candidate_pages, used_mode = result
+        retrieval_mode = used_mode or retrieval_mode
     except SupermemoryError as exc:
         status_label = "warning"
         error_detail = str(exc)
@@ -1049,7 +4588,12 @@ async def query(payload: dict):
         trace_payload: Dict[str, Any] = {
             "backend": backend_used,
             "status": status_label,
+            "retrieval_mode": retrieval_mode,
         }
+        if candidate_pages is not None:
+            trace_payload["candidate_pages"] = candidate_pages
+        if hedge_info is not None:
+            trace_payload.update(hedge_info)
         if status_label == "success":
             result_label = "hit" if documents else "miss"
             RAG_RESULTS_COUNTER.labels(
@@ -1095,7 +4639,12 @@ async def query(payload: dict):
         "count": len(documents),
         "rag_backend": backend_used,
         "fallback": fallback_used,
+        "retrieval_mode": retrieval_mode if backend_used == "chroma" else None,
     }
+    if candidate_pages is not None:
+        response["candidate_pages"] = candidate_pages
+    if hedge_info is not None:
+        response["hedge"] = hedge_info
     return JSONResponse(response)
 
 
@@ -1106,7 +4655,170 @@ async def list_collections():
         return {"collections": tags, "rag_backend": RAG_BACKEND}
     client = get_chroma_client()
     colls = client.list_collections()
-    return {"collections": [c.name for c in colls], "rag_backend": RAG_BACKEND}
+    physical_to_logical = {physical: logical for logical, (physical, _) in _collection_state.items()}
+    names: List[str] = []
+    for coll in colls:
+        if coll.name in physical_to_logical:
+            names.append(physical_to_logical[coll.name])
+        elif not (
+            coll.name.endswith(PAGE_COLLECTION_SUFFIX) or SHADOW_COLLECTION_MARKER in coll.name
+        ):
+            names.append(coll.name)
+    return {"collections": sorted(set(names)), "rag_backend": RAG_BACKEND}
+
+
+def _require_chroma_snapshots() -> None:
+    if not local_index_enabled():
+        raise HTTPException(status_code=501, detail="snapshot ของ collection รองรับเฉพาะ backend chroma")
+
+
+@app.get("/collections/{name}/export")
+async def export_collection(name: str):
+    _require_chroma_snapshots()
+    physical, _ = resolve_collection(name)
+    if not await asyncio.to_thread(collection_exists, physical):
+        raise HTTPException(status_code=404, detail="ไม่พบ collection")
+    started = time.perf_counter()
+    status_label = "success"
+    try:
+        snapshot_path, manifest = await asyncio.to_thread(export_collection_snapshot, name)
+    except Exception:
+        status_label = "failed"
+        logger.exception("collection_export_failed", extra={"fields": {"collection": name}})
+        raise
+    finally:
+        TOOL_LATENCY.labels(operation="snapshot_export", provider=RAG_BACKEND).observe(
+            time.perf_counter() - started
+        )
+        REQUEST_COUNTER.labels(endpoint="/collections/export", status=status_label).inc()
+    logger.info(
+        "collection_exported",
+        extra={
+            "fields": {
+                "collection": name,
+                "path": str(snapshot_path),
+                "bytes": snapshot_path.stat().st_size,
+                "chunks": manifest["sections"]["chunks"]["count"],
+            }
+        },
+    )
+    return FileResponse(
+        snapshot_path,
+        media_type="application/zip",
+        filename=snapshot_path.name,
+        background=BackgroundTask(snapshot_path.unlink, missing_ok=True),
+    )
+
+
+@app.post("/collections/{name}/import")
+async def import_collection(
+    name: str,
+    file: UploadFile = File(...),
+    replace: bool = Form(False),
+):
+    _require_chroma_snapshots()
+    if await asyncio.to_thread(running_migration_for, name):
+        raise HTTPException(status_code=409, detail="มีการย้าย embedding ของ collection นี้อยู่")
+    started = time.perf_counter()
+    status_label = "success"
+    try:
+        async with collection_write_lock(name):
+            summary = await asyncio.to_thread(import_collection_snapshot, name, file.file, replace)
+    except Exception:
+        status_label = "failed"
+        raise
+    finally:
+        TOOL_LATENCY.labels(operation="snapshot_import", provider=RAG_BACKEND).observe(
+            time.perf_counter() - started
+        )
+        REQUEST_COUNTER.labels(endpoint="/collections/import", status=status_label).inc()
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    logger.info("collection_imported", extra={"fields": summary})
+    if summary["embed_model"] != EMBED_MODEL_NAME and EMBED_MIGRATION_AUTO:
+        summary["embed_migration"] = await start_embed_migration(name, EMBED_MODEL_NAME)
+    return {"ok": True, **summary}
+
+
+def _require_chroma_migrations() -> None:
+    if not local_index_enabled():
+        raise HTTPException(status_code=501, detail="การย้าย embedding รองรับเฉพาะ backend chroma")
+
+
+@app.post("/embed-migrations")
+async def create_embed_migration(payload: dict):
+    _require_chroma_migrations()
+    logical = payload.get("collection") or CHROMA_COLLECTION
+    embed_model = payload.get("embed_model") or EMBED_MODEL_NAME
+    migration = await start_embed_migration(logical, embed_model)
+    return {"ok": True, "migration": migration}
+
+
+@app.get("/embed-migrations")
+async def list_embed_migrations():
+    migrations = await asyncio.to_thread(_list_migrations)
+    return {"migrations": migrations, "rag_backend": RAG_BACKEND}
+
+
+@app.delete("/embed-migrations/{migration_id}")
+async def cancel_embed_migration(migration_id: str):
+    migration = await asyncio.to_thread(_load_migration, migration_id)
+    if migration is None:
+        raise HTTPException(status_code=404, detail="ไม่พบงานย้าย embedding")
+    if migration["status"] != "running":
+        raise HTTPException(status_code=409, detail=f"งานนี้อยู่ในสถานะ {migration['status']}")
+    task = _migration_tasks.pop(migration_id, None)
+    if task is not None:
+        task.cancel()
+    async with collection_write_lock(migration["collection"]):
+        await asyncio.to_thread(_update_migration, migration_id, status="cancelled")
+        await asyncio.to_thread(drop_physical_collection, migration["target_physical"])
+        if CHUNK_DEDUP_ENABLED:
+            await asyncio.to_thread(_drop_fingerprint_namespace, migration["target_physical"])
+    EMBED_MIGRATION_COUNTER.labels(status="cancelled").inc()
+    return {"ok": True, "migration": await asyncio.to_thread(_load_migration, migration_id)}
+
+
+@app.get("/traces")
+async def list_traces(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    event_type: Optional[str] = None,
+    provider: Optional[str] = None,
+    request_id: Optional[str] = None,
+    limit: int = 100,
+    before_id: Optional[int] = None,
+):
+    filters = {"event_type": event_type, "provider": provider, "request_id": request_id}
+    limit = min(max(limit, 1), TRACE_QUERY_MAX_LIMIT)
+    traces = await asyncio.to_thread(
+        query_traces, filters, parse_trace_time(since), parse_trace_time(until), limit, before_id
+    )
+    return {
+        "traces": traces,
+        "count": len(traces),
+        "next_before_id": traces[-1]["id"] if len(traces) == limit else None,
+    }
+
+
+@app.get("/traces/stats")
+async def trace_stats(
+    windows: str = TRACE_STATS_WINDOWS,
+    until: Optional[str] = None,
+    event_type: Optional[str] = None,
+    provider: Optional[str] = None,
+):
+    """p50/p95/p99 ของ latency แยกตาม event_type และ provider ในแต่ละช่วงเวลาย้อนหลัง"""
+    filters = {"event_type": event_type, "provider": provider}
+    until_at = parse_trace_time(until)
+    end = datetime.fromisoformat(until_at) if until_at else datetime.utcnow()
+    results: Dict[str, Any] = {}
+    for label in [entry.strip() for entry in windows.split(",") if entry.strip()]:
+        since_at = (end - parse_trace_duration(label)).isoformat(timespec="milliseconds")
+        results[label] = {
+            "since": since_at,
+            **await asyncio.to_thread(trace_latency_stats, filters, since_at, until_at),
+        }
+    return {"until": end.isoformat(timespec="milliseconds"), "windows": results}
 
 
 @app.get("/metrics")
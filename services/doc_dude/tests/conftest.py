@@ -0,0 +1,132 @@
+"""fixture กลางของ doc_dude: ชี้ path ข้อมูลทั้งหมดไป temp dir ก่อน import main"""
+
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+SERVICE_DIR = Path(__file__).resolve().parents[1]
+_DATA_DIR = Path(tempfile.mkdtemp(prefix="doc_dude_test_"))
+
+for _name, _relative in {
+    "UPLOAD_DIR": "uploads",
+    "LOG_DIR": "logs",
+    "TRACE_DB_PATH": "telemetry/traces.db",
+    "EMBED_CACHE_PATH": "cache/embed_cache.db",
+    "CHUNK_DEDUP_DB_PATH": "cache/chunk_fingerprints.db",
+    "DOC_STORE_PATH": "uploads/document_store.db",
+    "SNAPSHOT_DIR": "snapshots",
+    "WEBHOOK_OUTBOX_PATH": "outbox/webhooks.db",
+}.items():
+    os.environ.setdefault(_name, str(_DATA_DIR / _relative))
+
+
+def _load_service():
+    # โหลดเป็นชื่อเฉพาะ กันชนกับ main.py ของ service อื่นใน session เดียวกัน
+    spec = importlib.util.spec_from_file_location("doc_dude_main", SERVICE_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception as exc:  # ต้องมีโมเดล OpenVINO ใน /models ถึง import ได้
+        sys.modules.pop(spec.name, None)
+        return None, exc
+    return module, None
+
+
+_service, _import_error = _load_service()
+
+
+@pytest.fixture(scope="session")
+def doc_main():
+    if _service is None:
+        pytest.skip(f"import doc_dude ไม่ได้: {_import_error}")
+    return _service
+
+
+class WhitespaceTokenizer:
+    """tokenizer จำลองแบบแยกคำด้วยช่องว่าง ไม่ต้องโหลดโมเดลจาก hub"""
+
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False):
+        offsets = []
+        start = None
+        for idx, char in enumerate(text + " "):
+            if char.isspace():
+                if start is not None:
+                    offsets.append((start, idx))
+                    start = None
+            elif start is None:
+                start = idx
+        encoded = {"input_ids": list(range(len(offsets)))}
+        if return_offsets_mapping:
+            encoded["offset_mapping"] = offsets
+        return encoded
+
+
+class MemoryCollection:
+    """collection ขนาดเล็กในหน่วยความจำ รองรับเฉพาะ API ของ Chroma ที่ test ใช้"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def get(self, ids=None, where=None, include=None, limit=None, offset=0):
+        items = [
+            (key, row)
+            for key, row in self.rows.items()
+            if (ids is None or key in ids)
+            and (not where or all(row["metadata"].get(k) == v for k, v in where.items()))
+        ]
+        if limit is not None:
+            items = items[offset : offset + limit]
+        return {
+            "ids": [key for key, _ in items],
+            "metadatas": [dict(row["metadata"]) for _, row in items],
+            "documents": [row["document"] for _, row in items],
+            "embeddings": [row["embedding"] for _, row in items],
+        }
+
+    def update(self, ids, metadatas):
+        for key, meta in zip(ids, metadatas):
+            self.rows[key]["metadata"] = dict(meta)
+
+    def delete(self, ids=None, where=None):
+        for key in self.get(ids=ids, where=where)["ids"]:
+            del self.rows[key]
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        for key, vector, meta, doc in zip(ids, embeddings, metadatas, documents):
+            self.rows[key] = {"metadata": meta, "document": doc, "embedding": vector}
+
+
+@pytest.fixture
+def chroma_memory(doc_main, monkeypatch):
+    """แทน Chroma ด้วย MemoryCollection ตามชื่อ physical collection"""
+    collections = {}
+
+    def collection(name):
+        return collections.setdefault(name, MemoryCollection())
+
+    def drop(physical):
+        for name in (physical, f"{physical}{doc_main.PAGE_COLLECTION_SUFFIX}"):
+            collections.pop(name, None)
+
+    monkeypatch.setattr(doc_main, "get_collection", collection)
+    monkeypatch.setattr(
+        doc_main,
+        "get_page_collection",
+        lambda name: collection(f"{name}{doc_main.PAGE_COLLECTION_SUFFIX}"),
+    )
+    monkeypatch.setattr(doc_main, "drop_physical_collection", drop)
+    return collections
+
+
+@pytest.fixture
+def whitespace_tokenizer(doc_main, monkeypatch):
+    tokenizer = WhitespaceTokenizer()
+    monkeypatch.setattr(doc_main, "get_chunk_tokenizer", lambda model_name=None: (tokenizer, 64))
+    return tokenizer
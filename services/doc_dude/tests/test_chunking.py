@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+
+def test_chunk_text_keeps_short_text_in_one_chunk(doc_main, whitespace_tokenizer):
+    chunks = list(doc_main.chunk_text("one two. three four.", max_tokens=10, overlap_tokens=0))
+    assert chunks == ["one two. three four."]
+
+
+def test_chunk_text_cuts_at_sentence_boundaries(doc_main, whitespace_tokenizer):
+    text = "a b c. d e f. g h i."
+    chunks = list(doc_main.chunk_text(text, max_tokens=6, overlap_tokens=0))
+    assert chunks == ["a b c. d e f.", "g h i."]
+
+
+def test_chunk_text_carries_overlap_sentences(doc_main, whitespace_tokenizer):
+    text = "a b. c d. e f. g h."
+    chunks = list(doc_main.chunk_text(text, max_tokens=4, overlap_tokens=2))
+    assert chunks == ["a b. c d.", "c d. e f.", "e f. g h."]
+
+
+def test_chunk_text_overlap_is_capped_at_half_budget(doc_main, whitespace_tokenizer):
+    text = "a b c. d e f. g h i."
+    chunks = list(doc_main.chunk_text(text, max_tokens=6, overlap_tokens=100))
+    # overlap ถูกจำกัดที่ 3 token จึงพาไปได้แค่ประโยคสุดท้าย
+    assert chunks == ["a b c. d e f.", "d e f. g h i."]
+
+
+def test_chunk_text_splits_oversized_sentence_by_tokens(doc_main, whitespace_tokenizer):
+    chunks = list(doc_main.chunk_text("w1 w2 w3 w4 w5", max_tokens=2, overlap_tokens=0))
+    assert chunks == ["w1 w2", "w3 w4", "w5"]
+
+
+def test_chunk_text_carries_token_tail_when_no_sentence_fits(doc_main, whitespace_tokenizer):
+    text = "a b c d e. f g h i j. k l m n o."
+    chunks = list(doc_main.chunk_text(text, max_tokens=8, overlap_tokens=2))
+    assert chunks == ["a b c d e.", "d e. f g h i j.", "i j. k l m n o."]
+
+
+def test_chunk_text_overlaps_oversized_windows(doc_main, whitespace_tokenizer):
+    chunks = list(doc_main.chunk_text("w1 w2 w3 w4 w5", max_tokens=3, overlap_tokens=1))
+    assert chunks == ["w1 w2 w3", "w3 w4 w5"]
+    chunks = list(doc_main.chunk_text("w1 w2 w3 w4 w5\nnext.", max_tokens=3, overlap_tokens=1))
+    assert chunks == ["w1 w2 w3", "w3 w4 w5", "w5\nnext."]
+
+
+def test_chunk_text_joins_lines_with_newline(doc_main, whitespace_tokenizer):
+    chunks = list(doc_main.chunk_text(["first line\n", "\n", "second line\n"], max_tokens=10))
+    assert chunks == ["first line\nsecond line"]
+
+
+def test_chunk_text_splits_thai_on_spaces(doc_main, whitespace_tokenizer):
+    chunks = list(doc_main.chunk_text("สวัสดี ครับ ทดสอบ", max_tokens=2, overlap_tokens=0))
+    assert chunks == ["สวัสดี ครับ", "ทดสอบ"]
+
+
+def test_chunk_tokenizer_skips_embedder_without_local_index(doc_main, monkeypatch):
+    class FakeTokenizer:
+        model_max_length = 1_000_000
+
+    loaded = []
+    monkeypatch.setattr(doc_main, "local_index_enabled", lambda: False)
+    monkeypatch.setattr(doc_main, "_chunk_tokenizers", {})
+    monkeypatch.setattr(doc_main, "_embedders", {})
+    monkeypatch.setattr(
+        doc_main, "get_embedder", lambda name=None: (_ for _ in ()).throw(AssertionError(name))
+    )
+    monkeypatch.setattr(
+        doc_main.AutoTokenizer,
+        "from_pretrained",
+        lambda name: loaded.append(name) or FakeTokenizer(),
+    )
+
+    tokenizer, limit = doc_main.get_chunk_tokenizer("some/model")
+    assert isinstance(tokenizer, FakeTokenizer)
+    assert limit == 512
+    assert doc_main.get_chunk_tokenizer("some/model")[0] is tokenizer
+    assert loaded == ["some/model"]
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import pytest
+
+
+@pytest.fixture
+def doc_store(doc_main, tmp_path, monkeypatch):
+    monkeypatch.setattr(doc_main, "DOC_STORE_PATH", tmp_path / "document_store.db")
+    monkeypatch.setattr(doc_main, "_collection_state", {})
+    doc_main.init_doc_store()
+    return doc_main
+
+
+def _insert_migration(doc_main, source, target, status):
+    doc_main._insert_migration(
+        {
+            "id": f"{source}->{target}",
+            "collection": "docs",
+            "source_physical": source,
+            "target_physical": target,
+            "embed_model": "model-b",
+            "status": status,
+            "created_at": "2026-01-01T00:00:00",
+            "updated_at": "2026-01-01T00:00:00",
+        }
+    )
+
+
+def test_register_existing_collections_skips_internal_names(doc_store, monkeypatch):
+    doc_main = doc_store
+    doc_main._save_collection_state("docs", "docs__emb_1234abcd", "model-b")
+    monkeypatch.setattr(
+        doc_main,
+        "_chroma_collection_names",
+        lambda: [
+            "docs",
+            "docs__emb_1234abcd",
+            "docs__emb_1234abcd__pages",
+            "manuals",
+            "manuals__pages",
+        ],
+    )
+
+    assert doc_main.register_existing_collections() == ["manuals"]
+    assert doc_main.resolve_collection("manuals") == ("manuals", doc_main.EMBED_MODEL_NAME)
+    assert doc_main.resolve_collection("docs") == ("docs__emb_1234abcd", "model-b")
+    assert doc_main.register_existing_collections() == []
+
+
+def test_physical_collection_retired_protects_active_and_running(doc_store):
+    doc_main = doc_store
+    doc_main._save_collection_state("docs", "docs__emb_b", "model-b")
+    _insert_migration(doc_main, "docs", "docs__emb_b", "completed")
+    _insert_migration(doc_main, "manuals", "manuals__emb_b", "running")
+
+    assert doc_main.physical_collection_retired("docs")
+    assert not doc_main.physical_collection_retired("docs__emb_b")
+    assert not doc_main.physical_collection_retired("manuals")
+    assert not doc_main.physical_collection_retired("manuals__emb_b")
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+
+import pytest
+
+BASE_TEXT = (
+    "The quarterly maintenance window starts at 02:00 and every service must drain "
+    "its queues before the database failover begins."
+)
+NEAR_TEXT = BASE_TEXT.replace("02:00", "03:00")
+OTHER_TEXT = "Invoices are issued on the first business day of each month in Thai baht."
+
+
+@pytest.fixture
+def dedup_db(doc_main, tmp_path, monkeypatch):
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_DB_PATH", tmp_path / "fingerprints.db")
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_ENABLED", True)
+    doc_main.init_dedup_db()
+    return tmp_path / "fingerprints.db"
+
+
+def _meta(page, chunk):
+    return {"page": page, "chunk": chunk}
+
+
+def test_minhash_similarity_tracks_text_overlap(doc_main):
+    base = doc_main.minhash_signature(BASE_TEXT)
+    assert doc_main.estimate_jaccard(base, doc_main.minhash_signature(BASE_TEXT)) == 1.0
+    assert doc_main.estimate_jaccard(base, doc_main.minhash_signature(NEAR_TEXT)) >= 0.85
+    assert doc_main.estimate_jaccard(base, doc_main.minhash_signature(OTHER_TEXT)) < 0.3
+
+
+def test_minhash_ignores_case_and_whitespace(doc_main):
+    noisy = "  " + BASE_TEXT.upper().replace(" ", "   \n")
+    assert doc_main.estimate_jaccard(
+        doc_main.minhash_signature(BASE_TEXT), doc_main.minhash_signature(noisy)
+    ) == 1.0
+
+
+def test_storing_fingerprint_twice_keeps_one_band_row_each(doc_main, dedup_db):
+    signature = doc_main.minhash_signature(BASE_TEXT)
+    for _ in range(3):
+        doc_main._store_fingerprint_rows("docs", [("a:1:0", "a", signature)])
+    with sqlite3.connect(dedup_db) as conn:
+        (count,) = conn.execute("SELECT COUNT(*) FROM chunk_fingerprint_bands").fetchone()
+    assert count == doc_main.MINHASH_BANDS
+
+
+def test_init_dedup_db_collapses_legacy_band_duplicates(doc_main, tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            """
+            CREATE TABLE chunk_fingerprint_bands (
+                collection TEXT NOT NULL, band INTEGER NOT NULL, bucket INTEGER NOT NULL,
+                chunk_id TEXT NOT NULL, document_id TEXT NOT NULL
+            )
+            """
+        )
+        conn.executemany(
+            "INSERT INTO chunk_fingerprint_bands VALUES ('docs', 0, 7, 'a:1:0', 'a')",
+            [()] * 4,
+        )
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_DB_PATH", path)
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_ENABLED", True)
+
+    doc_main.init_dedup_db()
+    doc_main.init_dedup_db()
+
+    with sqlite3.connect(path) as conn:
+        (count,) = conn.execute("SELECT COUNT(*) FROM chunk_fingerprint_bands").fetchone()
+    assert count == 1
+
+
+def test_find_duplicates_links_to_other_document(doc_main, dedup_db):
+    doc_main._store_fingerprints("docs", "a", [("a:1:0", doc_main.minhash_signature(BASE_TEXT))])
+
+    duplicates, fresh, links = doc_main._find_duplicates(
+        "docs", "b", [NEAR_TEXT, OTHER_TEXT], [_meta(1, 0), _meta(1, 1)]
+    )
+
+    assert duplicates == {0: "a:1:0"}
+    assert [chunk_id for chunk_id, _ in fresh] == ["b:1:1"]
+    assert links == [("b:1:0", "a:1:0", "a")]
+
+
+def test_find_duplicates_within_same_document_has_no_link(doc_main, dedup_db):
+    duplicates, fresh, links = doc_main._find_duplicates(
+        "docs", "b", [BASE_TEXT, NEAR_TEXT], [_meta(1, 0), _meta(2, 0)]
+    )
+    assert duplicates == {1: "b:1:0"}
+    assert [chunk_id for chunk_id, _ in fresh] == ["b:1:0"]
+    assert links == []
+
+
+def test_find_duplicates_skips_excluded_document(doc_main, dedup_db):
+    doc_main._store_fingerprints("docs", "a", [("a:1:0", doc_main.minhash_signature(BASE_TEXT))])
+    duplicates, _, _ = doc_main._find_duplicates(
+        "docs", "a", [NEAR_TEXT], [_meta(1, 0)], exclude_document="a"
+    )
+    assert duplicates == {}
+
+
+def test_delete_keeps_incoming_links_until_dependent_is_reindexed(doc_main, dedup_db):
+    doc_main._store_fingerprints("docs", "a", [("a:1:0", doc_main.minhash_signature(BASE_TEXT))])
+    doc_main._store_fingerprints("docs", "b", [], [("b:1:0", "a:1:0", "a")])
+    assert doc_main._duplicate_dependents("docs", "a") == ["b"]
+
+    doc_main._delete_fingerprints("docs", "a")
+    assert doc_main._duplicate_dependents("docs", "a") == ["b"]
+
+    doc_main._delete_fingerprints("docs", "b")
+    assert doc_main._duplicate_dependents("docs", "a") == []
+
+
+def test_reindex_dependents_restores_suppressed_chunk(
+    doc_main, dedup_db, whitespace_tokenizer, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(doc_main, "DOC_STORE_PATH", tmp_path / "document_store.db")
+    doc_main.init_doc_store()
+    info = {"filename": "b.txt", "file_type": "docx", "extra_metadata": {}}
+    doc_main.store_document_pages("docs", "b", [{"page": 1, "text": NEAR_TEXT}], info)
+    doc_main._store_fingerprints("docs", "b", [], [("b:1:0", "a:1:0", "a")])
+
+    indexed = []
+
+    async def fake_index(logical, document_id, chunks, metadata, *args, **kwargs):
+        indexed.append((document_id, chunks, kwargs["duplicate_links"]))
+        assert kwargs["replacing"]
+        doc_main._delete_fingerprints(logical, document_id)
+        doc_main._store_fingerprints(logical, document_id, args[1], kwargs["duplicate_links"])
+        return {"chunks_added": len(chunks)}
+
+    monkeypatch.setattr(doc_main, "index_chunks_locally", fake_index)
+
+    assert asyncio.run(doc_main.reindex_duplicate_dependents("docs", "a")) == 1
+    assert indexed == [("b", [NEAR_TEXT], [])]
+    assert doc_main._duplicate_dependents("docs", "a") == []
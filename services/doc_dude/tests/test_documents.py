@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+@pytest.fixture
+def stores(doc_main, chroma_memory, tmp_path, monkeypatch):
+    monkeypatch.setattr(doc_main, "RAG_BACKEND", "chroma")
+    monkeypatch.setattr(doc_main, "UPLOAD_DIR", tmp_path / "uploads")
+    monkeypatch.setattr(doc_main, "DOC_STORE_PATH", tmp_path / "document_store.db")
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_DB_PATH", tmp_path / "fingerprints.db")
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_ENABLED", True)
+    monkeypatch.setattr(doc_main, "_collection_state", {})
+    (tmp_path / "uploads").mkdir()
+    doc_main.init_doc_store()
+    doc_main.init_dedup_db()
+    return doc_main
+
+
+def _store_fully_duplicated(doc_main, tmp_path):
+    upload = tmp_path / "uploads" / "b.txt"
+    upload.write_text("same text")
+    info = {"filename": "b.txt", "storage_path": str(upload), "extra_metadata": {}}
+    doc_main.store_document_pages("docs", "b", [{"page": 1, "text": "same text"}], info)
+    doc_main._store_fingerprints("docs", "b", [], [("b:1:0", "a:1:0", "a")])
+    return upload
+
+
+def test_locate_document_without_chunks(stores, tmp_path):
+    doc_main = stores
+    upload = _store_fully_duplicated(doc_main, tmp_path)
+    assert doc_main.locate_document("docs", "b") == ([], [str(upload)], True)
+    assert doc_main.locate_document("docs", "missing") == ([], [], False)
+
+    doc_main.delete_document_pages("docs", "b")
+    assert doc_main.locate_document("docs", "b") == ([], [], True)
+
+
+def test_delete_fully_duplicated_document(stores, tmp_path):
+    doc_main = stores
+    upload = _store_fully_duplicated(doc_main, tmp_path)
+
+    result = asyncio.run(doc_main.delete_document("b", "docs"))
+
+    assert result["ok"] is True
+    assert not upload.exists()
+    assert doc_main.load_document("docs", "b") is None
+    assert doc_main._duplicate_dependents("docs", "a") == []
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(doc_main.delete_document("b", "docs"))
+    assert excinfo.value.status_code == 404
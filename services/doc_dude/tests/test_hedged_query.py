@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+
+import pytest
+
+
+@pytest.fixture
+def latencies(doc_main, monkeypatch):
+    window = deque(maxlen=50)
+    monkeypatch.setattr(doc_main, "_supermemory_latencies", window)
+    return window
+
+
+def test_successful_supermemory_query_feeds_hedge_window(doc_main, latencies, monkeypatch):
+    async def fake_query(question, top_k, collection):
+        return ["doc"], [{}], [0.1]
+
+    monkeypatch.setattr(doc_main, "supermemory_query", fake_query)
+    result = asyncio.run(doc_main.timed_supermemory_query("q", 3, "docs"))
+    assert result[0] == ["doc"]
+    assert len(latencies) == 1
+
+
+def test_failed_supermemory_query_is_not_recorded(doc_main, latencies, monkeypatch):
+    async def failing_query(question, top_k, collection):
+        raise doc_main.SupermemoryError("unauthorized")
+
+    monkeypatch.setattr(doc_main, "supermemory_query", failing_query)
+    with pytest.raises(doc_main.SupermemoryError):
+        asyncio.run(doc_main.timed_supermemory_query("q", 3, "docs"))
+    assert len(latencies) == 0
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+def test_backfill_page_coverage_adds_page_keys_and_vectors(doc_main, chroma_memory):
+    chunks = doc_main.get_collection("docs")
+    chunks.upsert(
+        ids=["old:1:0", "old:2:0", "new:1:0"],
+        embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]],
+        metadatas=[
+            {"document_id": "old", "page": 1, "chunk": 0},
+            {"document_id": "old", "page": 2, "chunk": 0},
+            {"document_id": "new", "page": 1, "chunk": 0, "page_key": "new:1"},
+        ],
+        documents=["first page", "second page", "already covered"],
+    )
+
+    assert doc_main.backfill_page_coverage("docs") == {"documents": 1, "chunks": 2}
+    assert chunks.rows["old:2:0"]["metadata"]["page_key"] == "old:2"
+    pages = doc_main.get_page_collection("docs")
+    assert sorted(pages.rows) == ["old:1", "old:2"]
+    assert np.allclose(pages.rows["old:1"]["embedding"], [1.0, 0.0])
+
+    assert doc_main.backfill_page_coverage("docs") == {"documents": 0, "chunks": 0}
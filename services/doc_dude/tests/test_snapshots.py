@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import io
+import sqlite3
+import zipfile
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def snapshot_env(doc_main, chroma_memory, tmp_path, monkeypatch):
+    monkeypatch.setattr(doc_main, "SNAPSHOT_DIR", tmp_path / "snapshots")
+    monkeypatch.setattr(doc_main, "DOC_STORE_PATH", tmp_path / "document_store.db")
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_DB_PATH", tmp_path / "fingerprints.db")
+    monkeypatch.setattr(doc_main, "CHUNK_DEDUP_ENABLED", True)
+    monkeypatch.setattr(doc_main, "_collection_state", {})
+    # batch เล็กเพื่อให้ข้ามขอบ batch ทั้งตอน export และ import
+    monkeypatch.setattr(doc_main, "snapshot_batch_size", lambda: 2)
+    (tmp_path / "snapshots").mkdir()
+    doc_main.init_doc_store()
+    doc_main.init_dedup_db()
+    return chroma_memory
+
+
+def test_section_writer_round_trip(doc_main, tmp_path):
+    writer = doc_main.SnapshotSectionWriter(tmp_path, "chunks")
+    vectors = np.arange(12, dtype=np.float32).reshape(4, 3) / 10
+    writer.add_rows(
+        ["a", "b"],
+        texts={"documents": ["สวัสดี", None]},
+        matrices={"vectors": vectors[:2].astype("<f2")},
+        metadatas=[{"page": 1}, None],
+    )
+    writer.add_rows(
+        ["c", "d"],
+        texts={"documents": ["", "tail"]},
+        matrices={"vectors": vectors[2:].astype("<f2")},
+        metadatas=[{"page": 2, "source": "line"}, {"page": 3}],
+    )
+    spec = writer.finish()
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for path in sorted((tmp_path / "chunks").iterdir()):
+            archive.write(path, f"chunks/{path.name}")
+    with zipfile.ZipFile(buffer) as archive:
+        batches = list(doc_main.iter_snapshot_section(archive, "chunks", spec, 3))
+
+    assert [len(batch["ids"]) for batch in batches] == [3, 1]
+    assert sum((batch["ids"] for batch in batches), []) == ["a", "b", "c", "d"]
+    assert sum((batch["documents"] for batch in batches), []) == ["สวัสดี", "", "", "tail"]
+    assert sum((batch["metadatas"] for batch in batches), []) == [
+        {"page": 1},
+        {},
+        {"page": 2, "source": "line"},
+        {"page": 3},
+    ]
+    restored = np.concatenate([batch["vectors"] for batch in batches]).astype(np.float32)
+    assert np.allclose(restored, vectors, atol=1e-3)
+
+
+def test_collection_snapshot_round_trip(doc_main, snapshot_env):
+    chunks = doc_main.get_collection("docs")
+    chunks.upsert(
+        ids=["a:1:0", "a:1:1", "b:1:0"],
+        embeddings=[[0.5, 0.25], [0.125, 1.0], [1.0, 0.0]],
+        metadatas=[
+            {"document_id": "a", "page": 1, "chunk": 0, "page_key": "a:1"},
+            {"document_id": "a", "page": 1, "chunk": 1, "page_key": "a:1"},
+            {"document_id": "b", "page": 1, "chunk": 0, "page_key": "b:1"},
+        ],
+        documents=["alpha", "beta", "gamma"],
+    )
+    doc_main.get_page_collection("docs").upsert(
+        ids=["a:1", "b:1"],
+        embeddings=[[0.5, 0.5], [1.0, 0.0]],
+        metadatas=[{"document_id": "a", "page": 1}, {"document_id": "b", "page": 1}],
+        documents=["alpha", "gamma"],
+    )
+    signature = doc_main.minhash_signature("alpha beta gamma delta epsilon zeta eta theta")
+    doc_main._store_fingerprints("docs", "a", [("a:1:0", signature)])
+    doc_main._store_fingerprints("docs", "b", [], [("b:1:1", "a:1:0", "a")])
+    info = {"filename": "a.pdf", "file_type": "pdf", "extra_metadata": {"source": "line"}}
+    doc_main.store_document_pages("docs", "a", [{"page": 1, "text": "alpha beta"}], info)
+
+    path, manifest = doc_main.export_collection_snapshot("docs")
+    with open(path, "rb") as handle:
+        result = doc_main.import_collection_snapshot("restored", handle, replace=False)
+
+    assert result["embed_model"] == manifest["embed_model"]
+    restored = snapshot_env["restored"].rows
+    assert sorted(restored) == ["a:1:0", "a:1:1", "b:1:0"]
+    assert restored["a:1:1"]["document"] == "beta"
+    assert restored["a:1:1"]["metadata"] == {
+        "document_id": "a",
+        "page": 1,
+        "chunk": 1,
+        "page_key": "a:1",
+    }
+    assert np.allclose(restored["a:1:0"]["embedding"], [0.5, 0.25])
+    assert sorted(snapshot_env["restored__pages"].rows) == ["a:1", "b:1"]
+
+    with sqlite3.connect(doc_main.CHUNK_DEDUP_DB_PATH) as conn:
+        stored = conn.execute(
+            "SELECT signature FROM chunk_fingerprints WHERE collection = 'restored'"
+        ).fetchone()[0]
+    assert np.array_equal(np.frombuffer(stored, dtype=np.uint32), signature)
+    assert doc_main._duplicate_dependents("restored", "a") == ["b"]
+
+    loaded_info, pages, _ = doc_main.load_document("restored", "a")
+    assert pages == [{"page": 1, "text": "alpha beta"}]
+    assert loaded_info["filename"] == "a.pdf"
+    assert loaded_info["extra_metadata"] == {"source": "line"}
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+
+def test_plan_groups_chunks_under_limit(doc_main):
+    chunks = ["a" * 4, "b" * 4, "c" * 4, "d" * 4]
+    # 4 + 2 + 4 = 10 พอดี part ละสอง chunk (รวมตัวคั่น "\n\n")
+    assert doc_main.plan_supermemory_parts(chunks, 10) == [[0, 1], [2, 3]]
+
+
+def test_plan_puts_oversized_chunk_in_own_part(doc_main):
+    chunks = ["short", "x" * 50, "tail"]
+    assert doc_main.plan_supermemory_parts(chunks, 20) == [[0], [1], [2]]
+
+
+def test_plan_keeps_order_and_covers_every_chunk(doc_main):
+    chunks = [str(i) * (i % 7 + 1) for i in range(40)]
+    parts = doc_main.plan_supermemory_parts(chunks, 25)
+    assert [idx for part in parts for idx in part] == list(range(40))
+    for part in parts:
+        size = sum(len(chunks[i]) for i in part) + 2 * (len(part) - 1)
+        assert len(part) == 1 or size <= 25
+
+
+def test_plan_empty(doc_main):
+    assert doc_main.plan_supermemory_parts([], 10) == []
+
+
+@pytest.fixture
+def supermemory_env(doc_main, tmp_path, monkeypatch):
+    monkeypatch.setattr(doc_main, "DOC_STORE_PATH", tmp_path / "document_store.db")
+    monkeypatch.setattr(doc_main, "SUPER_MEMORY_PART_MAX_CHARS", 40)
+    doc_main.init_doc_store()
+    sent = []
+    failing = set()
+
+    async def fake_post(path, payload):
+        sent.append(payload["customId"])
+        if payload["customId"] in failing:
+            raise doc_main.SupermemoryError("boom")
+        return {"id": f"sm-{payload['customId']}"}
+
+    monkeypatch.setattr(doc_main, "supermemory_post", fake_post)
+    return sent, failing
+
+
+def _ingest(doc_main):
+    chunks = ["first chunk text", "second chunk text", "third chunk text"]
+    metadata = [{"page": 1, "chunk": i} for i in range(len(chunks))]
+    return asyncio.run(
+        doc_main.supermemory_ingest("doc1", "docs", "a.pdf", "pdf", chunks, metadata)
+    )
+
+
+def test_partial_ingest_can_be_retried_for_failed_parts_only(doc_main, supermemory_env):
+    sent, failing = supermemory_env
+    failing.add("doc1-p001")
+
+    result = _ingest(doc_main)
+    assert result["parts_failed"] == 1
+    assert [part["status"] for part in result["parts"]] == ["ok", "failed", "ok"]
+
+    failing.clear()
+    sent.clear()
+    retried = asyncio.run(doc_main.retry_supermemory_ingest("docs", "doc1"))
+
+    assert sent == ["doc1-p001"]
+    assert retried["parts_retried"] == 1
+    assert retried["parts_failed"] == 0
+    assert [part["status"] for part in retried["parts"]] == ["ok", "ok", "ok"]
+    rows = doc_main._load_supermemory_parts("docs", "doc1")
+    assert all(row["payload"] is None for row in rows)
+    assert [row["attempts"] for row in rows] == [1, 2, 1]
+
+    sent.clear()
+    again = asyncio.run(doc_main.retry_supermemory_ingest("docs", "doc1"))
+    assert sent == []
+    assert again["parts_retried"] == 0
+
+
+def test_ingest_raises_when_every_part_fails(doc_main, supermemory_env):
+    _, failing = supermemory_env
+    failing.update({"doc1-p000", "doc1-p001", "doc1-p002"})
+    with pytest.raises(doc_main.SupermemoryError):
+        _ingest(doc_main)
+    rows = doc_main._load_supermemory_parts("docs", "doc1")
+    assert [row["status"] for row in rows] == ["failed"] * 3
+
+
+def test_retry_unknown_document_is_404(doc_main, supermemory_env):
+    with pytest.raises(doc_main.HTTPException) as excinfo:
+        asyncio.run(doc_main.retry_supermemory_ingest("docs", "missing"))
+    assert excinfo.value.status_code == 404
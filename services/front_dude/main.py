@@ -8,6 +8,10 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import bisect
+import gzip
+import hashlib
+import heapq
 import hmac
 import json
 import logging
@@ -16,20 +20,39 @@ import re
 import sqlite3
 import time
 import uuid
-from contextlib import contextmanager
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 from contextvars import ContextVar
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Type
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+from urllib.parse import urlsplit
 
 import httpx
 from fastapi import FastAPI, File, Form, HTTPException, Request, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from prometheus_client import CONTENT_TYPE_LATEST, Counter as PromCounter, Histogram, generate_latest
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter as PromCounter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
 from starlette.middleware.base import BaseHTTPMiddleware
 
 # ---------------------------------------------------------------------------
@@ -37,6 +60,8 @@ from starlette.middleware.base import BaseHTTPMiddleware
 # ---------------------------------------------------------------------------
 
 request_id_ctx: ContextVar[str | None] = ContextVar("request_id", default=None)
+# lane ของคำขอปัจจุบัน ใช้จัดลำดับคิวของเครื่องมือ (webhook > chat > search > upload)
+request_lane_ctx: ContextVar[str] = ContextVar("request_lane", default="chat")
 
 
 class JSONLogFormatter(logging.Formatter):
@@ -74,6 +99,7 @@ DEFAULT_FEATURE_CONFIG: Dict[str, bool] = {
     "tool_registry_validation": True,
     "structured_logging_enabled": True,
     "eval_trace_enabled": True,
+    "request_coalescing_enabled": True,
 }
 
 feature_config_lock = asyncio.Lock()
@@ -112,6 +138,32 @@ DEFAULT_MODEL_CONFIG: Dict[str, Any] = {
         "flash_attention": True,
         "memory_limit": "10G",
     },
+    "retrieval": {
+        # ตัดสินใจก่อนยิง doc.query ว่าข้อความนี้ต้องค้นฐานความรู้หรือไม่ (False = ค้นทุกครั้ง)
+        "classifier_enabled": True,
+        "skip_for_code": True,
+        "smalltalk_max_chars": 40,
+        "smalltalk_residual_chars": 6,
+        "smalltalk_keywords": [
+            "สวัสดี",
+            "หวัดดี",
+            "ขอบคุณ",
+            "ขอบใจ",
+            "แต๊งกิ้ว",
+            "ลาก่อน",
+            "บาย",
+            "โอเค",
+            "hello",
+            "hi",
+            "thanks",
+            "thank you",
+            "bye",
+            "ok",
+        ],
+        "skip_patterns": [r"^[\d\s\.\+\-\*/x×÷=\(\)]+\??$"],
+        "force_keywords": ["เอกสาร", "ไฟล์", "คู่มือ", "นโยบาย", "ระเบียบ", "ประกาศ", "อ้างอิง", "pdf"],
+        "min_chars": 2,
+    },
     "context": {
         "thai_code_context": (
             "คุณเป็น AI ที่เก่งทั้งภาษาไทยและการเขียนโปรแกรม\n"
@@ -377,17 +429,101 @@ DEFAULT_COLLECTION = os.getenv("CHROMA_COLLECTION", "doc_dude_knowledge")
 CORS_ALLOWLIST = [origin.strip() for origin in os.getenv("CORS_ALLOWLIST", "http://localhost:3000").split(",") if origin.strip()]
 RATE_LIMIT_PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", "60"))
 RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "30"))
-STREAM_DELAY = float(os.getenv("STREAM_DELAY_SECONDS", "0.05"))
+# ส่ง SSE comment กันไม่ให้ proxy (nginx/cloudflared) ตัด connection ระหว่างรอ retrieval/LLM
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "5"))
 TRACE_DB_PATH = Path(os.getenv("FRONT_TRACE_DB_PATH", "/data/telemetry/front_traces.db"))
 TRACE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+TRACE_QUEUE_MAX = int(os.getenv("TRACE_QUEUE_MAX", "10000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "200"))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "1.0"))
+TRACE_STATS_WINDOWS = os.getenv("TRACE_STATS_WINDOWS", "15m,1h,24h")
+# raw trace ที่เก่ากว่า retention จะถูก rollup รายนาที + archive เป็นไฟล์รายวันแล้วลบออก (<= 0 = เก็บตลอด)
+TRACE_RETENTION_DAYS = float(os.getenv("TRACE_RETENTION_DAYS", "14"))
+TRACE_RETENTION_BY_EVENT = {
+    name.strip(): float(days)
+    for name, _, days in (
+        entry.partition("=") for entry in os.getenv("TRACE_RETENTION_BY_EVENT", "").split(",")
+    )
+    if name.strip() and days.strip()
+}
+TRACE_ARCHIVE_DIR = Path(os.getenv("TRACE_ARCHIVE_DIR", str(TRACE_DB_PATH.parent / "archive")))
+TRACE_COMPACT_INTERVAL_SECONDS = float(os.getenv("TRACE_COMPACT_INTERVAL_SECONDS", "3600"))
+TRACE_VACUUM_PAGES = int(os.getenv("TRACE_VACUUM_PAGES", "2000"))
+# แปลงไฟล์ trace เดิมเป็น auto_vacuum=INCREMENTAL ต้อง VACUUM ทั้งไฟล์ (ล็อก DB ระหว่างทำ) จึงต้องเปิดเอง
+TRACE_VACUUM_CONVERT = os.getenv("TRACE_VACUUM_CONVERT", "0").strip().lower() in {"1", "true", "on"}
+TRACE_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
 TOOL_DEFAULT_TIMEOUT = float(os.getenv("TOOL_DEFAULT_TIMEOUT", "120"))
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://ollama:11434").rstrip("/")
 OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4"))
+# จัดการโมเดลที่ค้างใน Ollama: โมเดลที่ถูก route บ่อยได้ keep_alive ยาว ที่เหลือปล่อยให้ unload เร็ว
+OLLAMA_RESIDENCY_ENABLED = os.getenv("OLLAMA_RESIDENCY_ENABLED", "1").strip().lower() not in {"0", "false", "off"}
+OLLAMA_KEEP_ALIVE_HOT = os.getenv("OLLAMA_KEEP_ALIVE_HOT", "30m")
+OLLAMA_KEEP_ALIVE_COLD = os.getenv("OLLAMA_KEEP_ALIVE_COLD", "2m")
+OLLAMA_RESIDENCY_WINDOW_SECONDS = float(os.getenv("OLLAMA_RESIDENCY_WINDOW_SECONDS", "3600"))
+OLLAMA_RESIDENCY_REFRESH_SECONDS = float(os.getenv("OLLAMA_RESIDENCY_REFRESH_SECONDS", "60"))
+# load_duration ที่นานกว่านี้นับเป็น cold load (โมเดลไม่ได้อยู่ในหน่วยความจำ)
+OLLAMA_COLD_LOAD_SECONDS = float(os.getenv("OLLAMA_COLD_LOAD_SECONDS", "0.5"))
+# บทสนทนาต่อผู้ใช้/ session เก็บในหน่วยความจำของ process (หายเมื่อ restart)
+CONVERSATION_TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", "1800"))
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "5000"))
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "").strip()
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "").strip()
 LINE_BASE_URL = os.getenv("LINE_BASE_URL", "https://api.line.me").rstrip("/")
 LINE_TIMEOUT = float(os.getenv("LINE_HTTP_TIMEOUT", "30"))
 LINE_REPLY_URL = f"{LINE_BASE_URL}/v2/bot/message/reply"
+# /agents/health ตอบจาก cache ที่ task เบื้องหลังรีเฟรช โดยแต่ละ agent มีเวลาให้ตอบไม่เกิน deadline
+AGENT_HEALTH_REFRESH_SECONDS = float(os.getenv("AGENT_HEALTH_REFRESH_SECONDS", "15"))
+AGENT_HEALTH_TIMEOUT_SECONDS = float(os.getenv("AGENT_HEALTH_TIMEOUT_SECONDS", "3"))
+AGENT_HEALTH_STALE_SECONDS = float(os.getenv("AGENT_HEALTH_STALE_SECONDS", "60"))
+# circuit breaker ต่อเครื่องมือ: เปิดเมื่อสัดส่วน error/ช้าเกินใน window ล่าสุดถึงเกณฑ์
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "30"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+# hedged retry สำหรับเครื่องมือ idempotent: ยิงซ้ำเมื่อคำขอแรกช้ากว่า p95 ล่าสุด
+TOOL_HEDGE_WINDOW = int(os.getenv("TOOL_HEDGE_WINDOW", "200"))
+TOOL_HEDGE_MIN_SAMPLES = int(os.getenv("TOOL_HEDGE_MIN_SAMPLES", "20"))
+TOOL_HEDGE_MIN_DELAY_MS = float(os.getenv("TOOL_HEDGE_MIN_DELAY_MS", "200"))
+TOOL_HEDGE_MAX_DELAY_MS = float(os.getenv("TOOL_HEDGE_MAX_DELAY_MS", "5000"))
+# priority lanes: คิวรอ slot ของเครื่องมือจัดตาม lane และถูกตัดทิ้ง (shed) เมื่อคิวเต็ม/รอนานเกิน
+LANE_PRIORITIES = {"webhook": 0, "chat": 1, "search": 2, "upload": 3}
+LANE_QUEUE_TIMEOUTS = {
+    name.strip(): float(value)
+    for name, _, value in (
+        entry.partition("=") for entry in os.getenv("LANE_QUEUE_TIMEOUTS", "webhook=3,chat=10,search=5,upload=60").split(",")
+    )
+    if name.strip() and value.strip()
+}
+LANE_QUEUE_MAX = {
+    name.strip(): int(value)
+    for name, _, value in (
+        entry.partition("=") for entry in os.getenv("LANE_QUEUE_MAX", "webhook=100,chat=50,search=50,upload=10").split(",")
+    )
+    if name.strip() and value.strip()
+}
+# override เพดาน concurrency ราย intent เช่น "doc.query=16,doc.ingest=2"
+TOOL_CONCURRENCY = {
+    name.strip(): int(value)
+    for name, _, value in (
+        entry.partition("=") for entry in os.getenv("TOOL_CONCURRENCY", "").split(",")
+    )
+    if name.strip() and value.strip()
+}
+# connection pool ต่อ upstream (แยกตาม hostname) ใช้ร่วมกันทั้ง process
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "50"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+# override เพดาน connection ราย upstream เช่น "ollama=8,doc_dude=32"
+UPSTREAM_LIMITS = {
+    name.strip(): int(limit)
+    for name, _, limit in (
+        entry.partition("=") for entry in os.getenv("UPSTREAM_LIMITS", "").split(",")
+    )
+    if name.strip() and limit.strip()
+}
 
 
 def _resolve_liff_upload_url() -> str:
@@ -475,6 +611,105 @@ TOOL_CALL_COUNTER = PromCounter(
     "สถิติการเรียกใช้เครื่องมือ",
     ["intent", "status"],
 )
+TRACE_WRITTEN_COUNTER = PromCounter(
+    "front_dude_traces_written_total",
+    "จำนวน trace ที่เขียนลง SQLite แล้ว",
+)
+TRACE_DROPPED_COUNTER = PromCounter(
+    "front_dude_traces_dropped_total",
+    "จำนวน trace ที่ถูกทิ้ง (คิวเต็ม/เขียนไม่สำเร็จ)",
+    ["reason"],
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "front_dude_upstream_in_flight",
+    "จำนวนคำขอที่กำลังใช้ connection pool ของแต่ละ upstream",
+    ["upstream"],
+)
+UPSTREAM_POOL_LIMIT = Gauge(
+    "front_dude_upstream_pool_limit",
+    "เพดาน connection ของ pool แต่ละ upstream (ใช้คู่กับ in_flight ดูความอิ่มตัว)",
+    ["upstream"],
+)
+UPSTREAM_POOL_WAIT = Histogram(
+    "front_dude_upstream_pool_wait_seconds",
+    "เวลาที่คำขอรอ connection ว่างใน pool",
+    ["upstream"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+UPSTREAM_CONNECT_LATENCY = Histogram(
+    "front_dude_upstream_connect_seconds",
+    "เวลาเปิด connection ใหม่ (TCP + TLS) ไปยัง upstream",
+    ["upstream"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+COALESCED_COUNTER = PromCounter(
+    "front_dude_coalesced_waiters_total",
+    "จำนวนคำขอที่ไม่ได้ยิง upstream เองแต่รอผลจากคำขอเหมือนกันที่กำลังทำงานอยู่",
+    ["intent"],
+)
+BREAKER_STATE = Gauge(
+    "front_dude_breaker_state",
+    "สถานะ circuit breaker ต่อเครื่องมือ (0=closed, 1=half_open, 2=open)",
+    ["intent"],
+)
+BREAKER_TRANSITION_COUNTER = PromCounter(
+    "front_dude_breaker_transitions_total",
+    "จำนวนครั้งที่ circuit breaker เปลี่ยนสถานะ",
+    ["intent", "state"],
+)
+BREAKER_REJECTED_COUNTER = PromCounter(
+    "front_dude_breaker_rejected_total",
+    "จำนวนคำขอที่ถูกปฏิเสธทันทีเพราะ circuit เปิดอยู่",
+    ["intent"],
+)
+TOOL_HEDGE_COUNTER = PromCounter(
+    "front_dude_tool_hedge_total",
+    "ผลของ hedged retry ต่อเครื่องมือ",
+    ["intent", "outcome"],
+)
+LANE_QUEUE_DEPTH = Gauge(
+    "front_dude_lane_queue_depth",
+    "จำนวนคำขอที่รอ slot ของเครื่องมือในแต่ละ lane",
+    ["intent", "lane"],
+)
+LANE_WAIT = Histogram(
+    "front_dude_lane_wait_seconds",
+    "เวลาที่คำขอรอ slot ของเครื่องมือในแต่ละ lane",
+    ["intent", "lane"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+LANE_SHED_COUNTER = PromCounter(
+    "front_dude_lane_shed_total",
+    "จำนวนคำขอที่ถูกตัดทิ้งก่อนถึง upstream (queue_full=429, deadline=503)",
+    ["intent", "lane", "reason"],
+)
+RETRIEVAL_DECISION_COUNTER = PromCounter(
+    "front_dude_retrieval_decisions_total",
+    "ผลการตัดสินใจว่าจะค้นฐานความรู้ก่อนตอบหรือไม่ (decision=retrieve/skip)",
+    ["decision", "reason"],
+)
+OLLAMA_LOAD_LATENCY = Histogram(
+    "front_dude_ollama_load_seconds",
+    "load_duration ที่ Ollama รายงานต่อคำขอ (รวมกรณีโมเดลอยู่ในหน่วยความจำแล้ว)",
+    ["model"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0),
+)
+OLLAMA_COLD_LOAD_COUNTER = PromCounter(
+    "front_dude_ollama_cold_loads_total",
+    "จำนวนครั้งที่ Ollama ต้องโหลดโมเดลใหม่ (trigger=request คือผู้ใช้ต้องรอ, preload คือโหลดล่วงหน้า)",
+    ["model", "trigger"],
+)
+OLLAMA_RESIDENT_GAUGE = Gauge(
+    "front_dude_ollama_model_resident",
+    "โมเดลที่อยู่ในหน่วยความจำของ Ollama ตาม /api/ps ล่าสุด (1=resident)",
+    ["model"],
+)
+LLM_TTFT = Histogram(
+    "front_dude_llm_ttft_seconds",
+    "เวลาตั้งแต่ส่งคำขอจน Ollama ส่ง token แรกกลับมา",
+    ["model"],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0),
+)
 
 
 @dataclass
@@ -487,6 +722,16 @@ class ToolDefinition:
     feature_flag: Optional[str] = None
     timeout: float = TOOL_DEFAULT_TIMEOUT
     category: Optional[str] = None
+    connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT
+    breaker_failure_rate: float = BREAKER_FAILURE_RATE
+    breaker_min_calls: int = BREAKER_MIN_CALLS
+    # คำขอที่ช้ากว่านี้นับเป็น failure ของ breaker (None = ไม่นับ latency)
+    breaker_slow_seconds: Optional[float] = BREAKER_SLOW_CALL_SECONDS
+    breaker_open_seconds: float = BREAKER_OPEN_SECONDS
+    # ใช้กับเครื่องมือ idempotent เท่านั้น (query/GET)
+    hedge: bool = False
+    # จำนวนคำขอที่ยิง upstream พร้อมกันได้ (None = ไม่จำกัด, ไม่ผ่านคิว lane)
+    max_concurrency: Optional[int] = None
 
 
 class ToolRegistry:
@@ -509,6 +754,9 @@ class ToolRegistry:
     def list_by_category(self, category: str) -> List[ToolDefinition]:
         return [tool for tool in self._tools.values() if tool.category == category]
 
+    def all(self) -> List[ToolDefinition]:
+        return list(self._tools.values())
+
 
 tool_registry = ToolRegistry()
 HEALTH_INTENT_CATEGORY = "health"
@@ -525,6 +773,21 @@ CREATE TABLE IF NOT EXISTS traces (
     response TEXT,
     latency_ms REAL
 );
+CREATE INDEX IF NOT EXISTS idx_traces_created_at ON traces (created_at);
+CREATE INDEX IF NOT EXISTS idx_traces_event_created ON traces (event_type, created_at);
+CREATE INDEX IF NOT EXISTS idx_traces_intent_created ON traces (intent, created_at);
+CREATE INDEX IF NOT EXISTS idx_traces_request_id ON traces (request_id);
+CREATE TABLE IF NOT EXISTS trace_rollups (
+    minute TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    intent TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    latency_sum_ms REAL NOT NULL,
+    latency_max_ms REAL NOT NULL,
+    histogram TEXT NOT NULL,
+    PRIMARY KEY (minute, event_type, intent, status)
+);
 """
 
 
@@ -539,21 +802,121 @@ def trace_connection() -> Any:
 
 def init_trace_db() -> None:
     with trace_connection() as conn:
-        conn.execute(TRACE_SCHEMA)
+        # มีผลทันทีกับไฟล์ใหม่ ไฟล์เดิมจะถูกแปลงใน trace_compactor เมื่อเปิด TRACE_VACUUM_CONVERT
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(TRACE_SCHEMA)
         conn.commit()
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if not incremental and not TRACE_VACUUM_CONVERT:
+        logger.warning(
+            "trace_db_not_incremental",
+            extra={"fields": {"path": str(TRACE_DB_PATH), "hint": "TRACE_VACUUM_CONVERT=1"}},
+        )
 
 
-def _write_front_trace(record: tuple) -> None:
-    with trace_connection() as conn:
-        conn.execute(
-            """
-            INSERT INTO traces
-            (created_at, event_type, request_id, intent, payload, response, latency_ms)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            record,
-        )
-        conn.commit()
+TRACE_INSERT_SQL = """
+INSERT INTO traces
+(created_at, event_type, request_id, intent, payload, response, latency_ms)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+_TRACE_STOP = object()
+
+
+class TraceWriter:
+    """เขียน trace แบบ batch ผ่านคิวในหน่วยความจำ
+
+    ใช้ connection เดียว (WAL) ตลอดอายุ process และ commit ด้วย executemany
+    เมื่อครบ batch หรือครบเวลา ถ้าคิวเต็มจะทิ้ง trace และนับไว้ใน metric
+    """
+
+    def __init__(self, path: Path, insert_sql: str) -> None:
+        self._path = path
+        self._insert_sql = insert_sql
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(TRACE_QUEUE_MAX, 1))
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _open(self) -> None:
+        # connection ถูกใช้จาก thread pool ทีละ batch จึงปิด check_same_thread ได้
+        conn = sqlite3.connect(self._path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn = conn
+
+    async def start(self) -> None:
+        if self._task is None:
+            await asyncio.to_thread(self._open)
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, record: tuple) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            TRACE_DROPPED_COUNTER.labels(reason="queue_full").inc()
+
+    async def stop(self) -> None:
+        """ส่งสัญญาณหยุด แล้วรอให้ flush trace ที่ค้างในคิวจนหมดก่อนปิด connection"""
+        if self._task is None:
+            return
+        await self._queue.put(_TRACE_STOP)
+        await self._task
+        self._task = None
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    def _write_batch(self, batch: List[tuple]) -> None:
+        try:
+            self._conn.executemany(self._insert_sql, batch)
+            self._conn.commit()
+        except sqlite3.Error as exc:
+            TRACE_DROPPED_COUNTER.labels(reason="write_error").inc(len(batch))
+            logger.warning(
+                "trace_batch_failed",
+                extra={"fields": {"rows": len(batch), "error": str(exc)}},
+            )
+            return
+        TRACE_WRITTEN_COUNTER.inc(len(batch))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is _TRACE_STOP:
+                break
+            batch = [record]
+            deadline = loop.time() + TRACE_FLUSH_SECONDS
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    record = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if record is _TRACE_STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as exc:
+                # writer ต้องไม่ตาย ไม่อย่างนั้นคิวจะเต็มและ trace ถัดไปถูกทิ้งทั้งหมด
+                TRACE_DROPPED_COUNTER.labels(reason="write_error").inc(len(batch))
+                logger.exception(
+                    "trace_writer_failed",
+                    extra={"fields": {"rows": len(batch), "error": str(exc)}},
+                )
+
+
+trace_writer = TraceWriter(TRACE_DB_PATH, TRACE_INSERT_SQL)
 
 
 async def record_trace(
@@ -566,16 +929,826 @@ async def record_trace(
 ) -> None:
     if not is_feature_enabled("eval_trace_enabled"):
         return
-    record = (
-        datetime.utcnow().isoformat(timespec="milliseconds"),
-        event_type,
-        request_id,
-        intent,
-        json.dumps(payload, ensure_ascii=False),
-        json.dumps(response_payload, ensure_ascii=False),
-        float(latency_ms),
+    trace_writer.submit(
+        (
+            datetime.utcnow().isoformat(timespec="milliseconds"),
+            event_type,
+            request_id,
+            intent,
+            json.dumps(payload, ensure_ascii=False),
+            json.dumps(response_payload, ensure_ascii=False),
+            float(latency_ms),
+        )
     )
-    await asyncio.to_thread(_write_front_trace, record)
+
+
+# มิติที่ใช้แยกสถิติ latency ใน /traces/stats
+TRACE_STATS_DIMENSIONS = ("event_type", "intent")
+TRACE_ROLLUP_DIMENSION = "intent"
+TRACE_QUERY_MAX_LIMIT = 1000
+TRACE_DURATION_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+TRACE_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_trace_duration(value: str) -> timedelta:
+    match = TRACE_DURATION_PATTERN.match(value.strip().lower())
+    if not match:
+        raise HTTPException(status_code=400, detail=f"ช่วงเวลาไม่ถูกต้อง: {value} (เช่น 15m, 1h, 7d)")
+    return timedelta(seconds=float(match.group(1)) * TRACE_DURATION_UNITS[match.group(2)])
+
+
+def parse_trace_time(value: Optional[str]) -> Optional[str]:
+    """รับเวลาแบบ ISO-8601 หรือแบบย้อนหลัง (เช่น 1h) แล้วแปลงเป็นรูปแบบเดียวกับ created_at (UTC)"""
+    if not value:
+        return None
+    if TRACE_DURATION_PATTERN.match(value.strip().lower()):
+        moment = datetime.utcnow() - parse_trace_duration(value)
+    else:
+        try:
+            moment = datetime.fromisoformat(value.strip())
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=f"รูปแบบเวลาไม่ถูกต้อง: {value}") from exc
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.isoformat(timespec="milliseconds")
+
+
+def latency_percentiles(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    last = len(ordered) - 1
+
+    def pick(quantile: float) -> float:
+        rank = quantile * last
+        low = int(rank)
+        high = min(low + 1, last)
+        return round(ordered[low] + (ordered[high] - ordered[low]) * (rank - low), 2)
+
+    return {
+        "count": len(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 2),
+    }
+
+
+def _trace_row(row: sqlite3.Row) -> Dict[str, Any]:
+    record = dict(row)
+    for key in ("payload", "response"):
+        try:
+            record[key] = json.loads(record[key]) if record[key] else None
+        except ValueError:
+            pass
+    return record
+
+
+def _trace_conditions(
+    filters: Dict[str, Optional[str]], since: Optional[str], until: Optional[str]
+) -> Tuple[str, List[Any]]:
+    clauses: List[str] = []
+    params: List[Any] = []
+    for column, value in filters.items():
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if since:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until:
+        clauses.append("created_at < ?")
+        params.append(until)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def query_traces(
+    filters: Dict[str, Optional[str]],
+    since: Optional[str],
+    until: Optional[str],
+    limit: int,
+    before_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    where, params = _trace_conditions(filters, since, until)
+    if before_id is not None:
+        where += (" AND " if where else " WHERE ") + "id < ?"
+        params.append(before_id)
+    with trace_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(
+            f"SELECT * FROM traces{where} ORDER BY id DESC LIMIT ?", [*params, limit]
+        ).fetchall()
+    return [_trace_row(row) for row in rows]
+
+
+def trace_latency_stats(
+    filters: Dict[str, Optional[str]], since: str, until: Optional[str]
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    where, params = _trace_conditions(filters, since, until)
+    columns = ", ".join(TRACE_STATS_DIMENSIONS)
+    with trace_connection() as conn:
+        rows = conn.execute(
+            f"SELECT {columns}, latency_ms FROM traces{where}"
+            f"{' AND' if where else ' WHERE'} latency_ms IS NOT NULL",
+            params,
+        ).fetchall()
+        rollups = _trace_rollup_rows(conn, filters, since, until)
+    stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for position, dimension in enumerate(TRACE_STATS_DIMENSIONS):
+        groups: Dict[str, List[float]] = {}
+        for row in rows:
+            groups.setdefault(row[position] or "unknown", []).append(float(row[-1]))
+        rolled: Dict[str, List[Tuple[float, int]]] = {}
+        for row in rollups:
+            rolled.setdefault(row[position] or "unknown", []).extend(_rollup_samples(row))
+        stats[f"by_{dimension}"] = {
+            key: (
+                weighted_latency_percentiles(
+                    [(value, 1) for value in groups.get(key, [])] + rolled[key]
+                )
+                if rolled.get(key)
+                else latency_percentiles(groups[key])
+            )
+            for key in sorted({*groups, *(key for key, samples in rolled.items() if samples)})
+        }
+    return stats
+
+
+def _trace_rollup_rows(
+    conn: sqlite3.Connection, filters: Dict[str, Optional[str]], since: str, until: Optional[str]
+) -> List[tuple]:
+    """แถวของ trace_rollups ในช่วงเวลา (นาทีที่ถูก compact ไปแล้วจะไม่มี raw trace เหลือ)"""
+    columns = (*TRACE_STATS_DIMENSIONS, "latency_max_ms", "histogram")
+    if any(value for key, value in filters.items() if key not in TRACE_STATS_DIMENSIONS):
+        return []
+    clauses = ["minute >= ?"]
+    params: List[Any] = [since[:16]]
+    if until:
+        clauses.append("minute < ?")
+        params.append(until)
+    for column, value in filters.items():
+        if value:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    return conn.execute(
+        f"SELECT {', '.join(columns)} FROM trace_rollups WHERE {' AND '.join(clauses)}", params
+    ).fetchall()
+
+
+def _rollup_samples(row: tuple) -> List[Tuple[float, int]]:
+    # ใช้ขอบบนของ bucket เป็นตัวแทน (bucket สุดท้ายและค่าที่เกิน max ใช้ latency_max_ms)
+    latency_max = float(row[-2])
+    bounds = [*TRACE_ROLLUP_BUCKETS_MS, latency_max]
+    return [
+        (min(float(bound), latency_max), int(count))
+        for bound, count in zip(bounds, json.loads(row[-1]))
+        if count
+    ]
+
+
+def weighted_latency_percentiles(samples: List[Tuple[float, int]]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    total = sum(weight for _, weight in ordered)
+
+    def pick(quantile: float) -> float:
+        target = quantile * total
+        seen = 0
+        for value, weight in ordered:
+            seen += weight
+            if seen >= target:
+                return round(value, 2)
+        return round(ordered[-1][0], 2)
+
+    return {
+        "count": total,
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1][0], 2),
+    }
+
+
+# ขอบบนของ bucket (ms) ใน histogram ของ trace_rollups; bucket สุดท้ายคือค่าที่เกินขอบบนสุด
+TRACE_ROLLUP_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def trace_retention_days(event_type: str) -> float:
+    return TRACE_RETENTION_BY_EVENT.get(event_type, TRACE_RETENTION_DAYS)
+
+
+def _trace_cutoff(event_type: str, now: datetime) -> Optional[str]:
+    days = trace_retention_days(event_type)
+    if days <= 0:
+        return None
+    # ปัดลงเป็นต้นนาที เพื่อให้แต่ละนาทีถูก rollup ครั้งเดียวครบทั้งนาที
+    cutoff = (now - timedelta(days=days)).replace(second=0, microsecond=0)
+    return cutoff.isoformat(timespec="milliseconds")
+
+
+def _rollup_trace_rows(rows: List[sqlite3.Row]) -> List[tuple]:
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    for row in rows:
+        try:
+            status = (json.loads(row["response"] or "{}") or {}).get("status") or "unknown"
+        except (ValueError, AttributeError):
+            status = "unknown"
+        key = (
+            row["created_at"][:16],
+            row["event_type"],
+            row[TRACE_ROLLUP_DIMENSION] or "",
+            str(status),
+        )
+        group = groups.setdefault(
+            key,
+            {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(TRACE_ROLLUP_BUCKETS_MS) + 1)},
+        )
+        latency = float(row["latency_ms"] or 0.0)
+        group["count"] += 1
+        group["sum"] += latency
+        group["max"] = max(group["max"], latency)
+        group["buckets"][bisect.bisect_left(TRACE_ROLLUP_BUCKETS_MS, latency)] += 1
+    return [
+        (*key, group["count"], round(group["sum"], 3), group["max"], json.dumps(group["buckets"]))
+        for key, group in groups.items()
+    ]
+
+
+def _archive_trace_rows(event_type: str, day: str, rows: List[sqlite3.Row]) -> Path:
+    # ชื่อไฟล์ผูกกับช่วง id ของแถว ถ้า commit ล้มแล้วรอบถัดไปหยิบแถวชุดเดิม จะเขียนทับไฟล์เดิมแทนการต่อซ้ำ
+    safe_event = re.sub(r"[^A-Za-z0-9_.-]", "_", event_type)
+    path = TRACE_ARCHIVE_DIR / (
+        f"{TRACE_DB_PATH.stem}-{day}-{safe_event}-{rows[0]['id']}-{rows[-1]['id']}.jsonl.gz"
+    )
+    partial = path.with_name(f".{path.name}.tmp")
+    with gzip.open(partial, "wt", encoding="utf-8") as handle:
+        for row in rows:
+            handle.write(json.dumps(dict(row), ensure_ascii=False) + "\n")
+    os.replace(partial, path)
+    return path
+
+
+def _compact_trace_day(event_type: str, cutoff: str) -> int:
+    """rollup + archive + ลบ raw trace ของ event_type นี้ทีละวัน (วันเก่าสุดที่เลย cutoff) คืนจำนวนแถวที่ลบ"""
+    with trace_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM traces WHERE event_type = ? AND created_at < ?",
+            (event_type, cutoff),
+        ).fetchone()[0]
+        if oldest is None:
+            return 0
+        day = oldest[:10]
+        next_day = datetime.fromisoformat(day) + timedelta(days=1)
+        upper = min(next_day.isoformat(timespec="milliseconds"), cutoff)
+        rows = conn.execute(
+            """
+            SELECT * FROM traces WHERE event_type = ? AND created_at >= ? AND created_at < ?
+            ORDER BY id
+            """,
+            (event_type, oldest, upper),
+        ).fetchall()
+        _archive_trace_rows(event_type, day, rows)
+        conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO trace_rollups
+            (minute, event_type, {TRACE_ROLLUP_DIMENSION}, status, count, latency_sum_ms,
+             latency_max_ms, histogram)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            _rollup_trace_rows(rows),
+        )
+        conn.execute(
+            "DELETE FROM traces WHERE event_type = ? AND created_at >= ? AND created_at < ?",
+            (event_type, oldest, upper),
+        )
+        conn.commit()
+    return len(rows)
+
+
+def _trace_event_types() -> List[str]:
+    with trace_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT DISTINCT event_type FROM traces").fetchall()]
+
+
+def _convert_trace_auto_vacuum() -> bool:
+    with trace_connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    return True
+
+
+def _incremental_vacuum() -> None:
+    with trace_connection() as conn:
+        conn.execute(f"PRAGMA incremental_vacuum({max(TRACE_VACUUM_PAGES, 1)})")
+        conn.commit()
+
+
+async def compact_traces() -> Dict[str, int]:
+    now = datetime.utcnow()
+    compacted: Dict[str, int] = {}
+    for event_type in await asyncio.to_thread(_trace_event_types):
+        cutoff = _trace_cutoff(event_type, now)
+        if cutoff is None:
+            continue
+        while True:
+            removed = await asyncio.to_thread(_compact_trace_day, event_type, cutoff)
+            if not removed:
+                break
+            compacted[event_type] = compacted.get(event_type, 0) + removed
+    if compacted:
+        await asyncio.to_thread(_incremental_vacuum)
+        logger.info("traces_compacted", extra={"fields": {"rows": compacted}})
+    return compacted
+
+
+async def trace_compactor() -> None:
+    if TRACE_VACUUM_CONVERT:
+        try:
+            if await asyncio.to_thread(_convert_trace_auto_vacuum):
+                logger.info("trace_db_converted", extra={"fields": {"auto_vacuum": "incremental"}})
+        except sqlite3.Error as exc:
+            logger.warning("trace_db_convert_failed", extra={"fields": {"error": str(exc)}})
+    while True:
+        try:
+            await compact_traces()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pragma: no cover - ไม่ให้ loop ตาย
+            logger.warning("trace_compaction_failed", extra={"fields": {"error": str(exc)}})
+        await asyncio.sleep(TRACE_COMPACT_INTERVAL_SECONDS)
+
+
+
+# ---------------------------------------------------------------------------
+# Upstream HTTP clients
+# ---------------------------------------------------------------------------
+
+_upstream_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def upstream_name(url: str) -> str:
+    return urlsplit(url).hostname or "unknown"
+
+
+def get_upstream_client(url: str) -> httpx.AsyncClient:
+    name = upstream_name(url)
+    client = _upstream_clients.get(name)
+    if client is None:
+        max_connections = UPSTREAM_LIMITS.get(name, UPSTREAM_MAX_CONNECTIONS)
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(TOOL_DEFAULT_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=min(UPSTREAM_MAX_KEEPALIVE, max_connections),
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _upstream_clients[name] = client
+        UPSTREAM_POOL_LIMIT.labels(upstream=name).set(max_connections)
+    return client
+
+
+def init_upstream_clients() -> None:
+    for url in [tool.url for tool in tool_registry.all()] + [OLLAMA_BASE_URL, LINE_BASE_URL]:
+        get_upstream_client(url)
+
+
+async def close_upstream_clients() -> None:
+    clients = list(_upstream_clients.values())
+    _upstream_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+class UpstreamTrace:
+    """httpcore trace hook: แยกเวลารอ pool ออกจากเวลาเปิด connection ใหม่"""
+
+    _CONNECT_EVENTS = ("connection.connect_tcp", "connection.start_tls")
+
+    def __init__(self, upstream: str) -> None:
+        self.upstream = upstream
+        self.started = time.perf_counter()
+        self.connect_seconds = 0.0
+        self._connect_started = 0.0
+        self._sent = False
+
+    async def __call__(self, event_name: str, info: Dict[str, Any]) -> None:
+        now = time.perf_counter()
+        step, _, phase = event_name.rpartition(".")
+        if step in self._CONNECT_EVENTS:
+            if phase == "started":
+                self._connect_started = now
+            elif phase == "complete":
+                self.connect_seconds += now - self._connect_started
+        elif step.endswith("send_request_headers") and phase == "started" and not self._sent:
+            self._sent = True
+            waited = now - self.started - self.connect_seconds
+            UPSTREAM_POOL_WAIT.labels(upstream=self.upstream).observe(max(waited, 0.0))
+            if self.connect_seconds:
+                UPSTREAM_CONNECT_LATENCY.labels(upstream=self.upstream).observe(self.connect_seconds)
+
+
+def _upstream_timeout(timeout: float, connect_timeout: Optional[float]) -> httpx.Timeout:
+    connect = UPSTREAM_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+    return httpx.Timeout(timeout, connect=min(connect, timeout))
+
+
+async def upstream_request(
+    method: str,
+    url: str,
+    *,
+    timeout: float,
+    connect_timeout: Optional[float] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    name = upstream_name(url)
+    client = get_upstream_client(url)
+    in_flight = UPSTREAM_IN_FLIGHT.labels(upstream=name)
+    in_flight.inc()
+    try:
+        return await client.request(
+            method,
+            url,
+            timeout=_upstream_timeout(timeout, connect_timeout),
+            extensions={"trace": UpstreamTrace(name)},
+            **kwargs,
+        )
+    finally:
+        in_flight.dec()
+
+
+@asynccontextmanager
+async def upstream_stream(
+    method: str,
+    url: str,
+    *,
+    timeout: float,
+    connect_timeout: Optional[float] = None,
+    **kwargs: Any,
+) -> AsyncIterator[httpx.Response]:
+    name = upstream_name(url)
+    client = get_upstream_client(url)
+    in_flight = UPSTREAM_IN_FLIGHT.labels(upstream=name)
+    in_flight.inc()
+    try:
+        async with client.stream(
+            method,
+            url,
+            timeout=_upstream_timeout(timeout, connect_timeout),
+            extensions={"trace": UpstreamTrace(name)},
+            **kwargs,
+        ) as response:
+            yield response
+    finally:
+        in_flight.dec()
+
+
+
+# ---------------------------------------------------------------------------
+# Request coalescing (single-flight)
+# ---------------------------------------------------------------------------
+
+
+def single_flight_key(intent: str, payload: Any) -> str:
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return f"{intent}:{hashlib.sha256(encoded.encode('utf-8')).hexdigest()}"
+
+
+class _SharedStream:
+    """stream จาก upstream หนึ่งเส้นที่กระจาย item ให้ผู้ติดตามหลายราย"""
+
+    def __init__(self) -> None:
+        self.items: List[Any] = []
+        self.outcome: Optional[Tuple[str, Any]] = None
+        self.queues: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def _publish(self, event: Tuple[str, Any]) -> None:
+        for queue in self.queues:
+            queue.put_nowait(event)
+
+    async def pump(self, source: AsyncIterator[Any]) -> None:
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._publish(("item", item))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            self.outcome = ("error", exc)
+        else:
+            self.outcome = ("done", None)
+        self._publish(self.outcome)
+
+    def subscribe(self) -> asyncio.Queue:
+        # ผู้ที่เข้ามาทีหลังได้ item ที่ผ่านไปแล้วทั้งหมดก่อน แล้วจึงรับต่อแบบ real-time
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self.items:
+            queue.put_nowait(("item", item))
+        if self.outcome is not None:
+            queue.put_nowait(self.outcome)
+        self.queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.queues.remove(queue)
+        if not self.queues and self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+class SingleFlight:
+    """ให้คำขอที่ key เดียวกันและเกิดพร้อมกันใช้ upstream call เดียวร่วมกัน
+
+    call จริงรันใน task แยก ผู้รอที่ถูกยกเลิกจึงไม่ทำให้รายอื่นล้ม และ call จะถูกยกเลิก
+    เมื่อไม่เหลือผู้รอแล้วเท่านั้น ผลลัพธ์ถูกแชร์ตรง ๆ (ไม่ copy) ผู้เรียกต้องถือว่าเป็น read-only
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._waiters: Dict[str, int] = {}
+        self._streams: Dict[str, _SharedStream] = {}
+
+    def _forget(self, key: str, call: asyncio.Future) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+            self._waiters.pop(key, None)
+
+    async def do(self, key: str, label: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(factory())
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            COALESCED_COUNTER.labels(intent=label).inc()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if self._calls.get(key) is call:
+                self._waiters[key] -= 1
+                if self._waiters[key] <= 0 and not call.done():
+                    call.cancel()
+
+    async def stream(
+        self, key: str, label: str, factory: Callable[[], AsyncIterator[Any]]
+    ) -> AsyncIterator[Any]:
+        """แบบเดียวกับ do() แต่สำหรับ stream: คำขอที่ซ้ำกันระหว่างที่ stream ยังวิ่งจะได้ item ชุดเดียวกัน"""
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = _SharedStream()
+            shared.task = asyncio.ensure_future(shared.pump(factory()))
+            self._streams[key] = shared
+            shared.task.add_done_callback(lambda _: self._forget_stream(key, shared))
+        else:
+            COALESCED_COUNTER.labels(intent=label).inc()
+        queue = shared.subscribe()
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "item":
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            shared.unsubscribe(queue)
+
+    def _forget_stream(self, key: str, shared: _SharedStream) -> None:
+        if self._streams.get(key) is shared:
+            del self._streams[key]
+
+    def in_flight(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+
+single_flight = SingleFlight()
+
+
+# ---------------------------------------------------------------------------
+# Ollama model residency
+# ---------------------------------------------------------------------------
+
+
+class ModelResidency:
+    """เลือกโมเดลที่ควรค้างใน Ollama จากความถี่การ route ล่าสุด ไม่เกิน memory.max_loaded_models"""
+
+    def __init__(self) -> None:
+        self._routes: Deque[Tuple[float, str]] = deque()
+        self._counts: Dict[str, int] = {}
+        self.resident: List[str] = []
+        self.checked_at: Optional[str] = None
+
+    def note_route(self, model: str) -> None:
+        now = time.monotonic()
+        self._routes.append((now, model))
+        self._counts[model] = self._counts.get(model, 0) + 1
+        while self._routes and now - self._routes[0][0] > OLLAMA_RESIDENCY_WINDOW_SECONDS:
+            _, expired = self._routes.popleft()
+            self._counts[expired] -= 1
+            if not self._counts[expired]:
+                del self._counts[expired]
+
+    def route_counts(self) -> Dict[str, int]:
+        return dict(self._counts)
+
+    @staticmethod
+    def routed_models() -> List[str]:
+        routing = get_model_config_snapshot()["routing"]
+        keys = ("default_model", "thai_conversation", "mixed_tasks", "coding_tasks")
+        return list(dict.fromkeys(routing[key] for key in keys if routing.get(key)))
+
+    @staticmethod
+    def max_loaded() -> int:
+        return max(int(get_model_config_snapshot()["memory"].get("max_loaded_models", 1) or 1), 1)
+
+    def hot_models(self) -> List[str]:
+        counts = self.route_counts()
+        candidates = list(dict.fromkeys(self.routed_models() + list(counts)))
+        # ถ้าความถี่เท่ากัน ให้ลำดับใน routing config (default_model ก่อน) เป็นตัวตัดสิน
+        ranked = sorted(candidates, key=lambda model: (-counts.get(model, 0), candidates.index(model)))
+        return ranked[: self.max_loaded()]
+
+    def keep_alive_for(self, model: str) -> str:
+        return OLLAMA_KEEP_ALIVE_HOT if model in self.hot_models() else OLLAMA_KEEP_ALIVE_COLD
+
+    def prepare(self, model: str, payload: Dict[str, Any]) -> None:
+        """นับการ route แล้วแนบ keep_alive ให้ payload ของ /api/generate"""
+        if not OLLAMA_RESIDENCY_ENABLED:
+            return
+        self.note_route(model)
+        payload["keep_alive"] = self.keep_alive_for(model)
+
+    def observe_response(self, model: str, data: Dict[str, Any], trigger: str = "request") -> None:
+        load_ns = data.get("load_duration")
+        if not isinstance(load_ns, (int, float)) or load_ns <= 0:
+            return
+        load_seconds = load_ns / 1e9
+        OLLAMA_LOAD_LATENCY.labels(model=model).observe(load_seconds)
+        if load_seconds >= OLLAMA_COLD_LOAD_SECONDS:
+            OLLAMA_COLD_LOAD_COUNTER.labels(model=model, trigger=trigger).inc()
+            logger.info(
+                "ollama_cold_load",
+                extra={
+                    "fields": {"model": model, "trigger": trigger, "load_seconds": round(load_seconds, 3)}
+                },
+            )
+
+    async def load(self, model: str, keep_alive: str) -> None:
+        # prompt ว่าง = ให้ Ollama โหลด/ต่ออายุโมเดลเท่านั้น, keep_alive "0" = unload
+        response = await upstream_request(
+            "POST",
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={"model": model, "keep_alive": keep_alive, "stream": False},
+            timeout=OLLAMA_TIMEOUT,
+        )
+        response.raise_for_status()
+        self.observe_response(model, response.json(), trigger="preload")
+
+    async def fetch_resident(self) -> List[str]:
+        response = await upstream_request("GET", f"{OLLAMA_BASE_URL}/api/ps", timeout=10)
+        response.raise_for_status()
+        models = [entry.get("name") or entry.get("model") for entry in response.json().get("models", [])]
+        resident = [name for name in models if name]
+        for name in set(self.resident) - set(resident):
+            OLLAMA_RESIDENT_GAUGE.labels(model=name).set(0)
+        for name in resident:
+            OLLAMA_RESIDENT_GAUGE.labels(model=name).set(1)
+        self.resident = resident
+        self.checked_at = datetime.utcnow().isoformat(timespec="seconds")
+        return resident
+
+    async def reconcile(self) -> None:
+        hot = self.hot_models()
+        resident = await self.fetch_resident()
+        # unload โมเดลที่ไม่ hot ก่อน เพื่อให้มีที่พอสำหรับโมเดล hot ที่ยังไม่ถูกโหลด
+        missing = [model for model in hot if model not in resident]
+        overflow = len(resident) + len(missing) - self.max_loaded()
+        for model in [name for name in resident if name not in hot][: max(overflow, 0)]:
+            await self.load(model, "0")
+        for model in missing:
+            await self.load(model, OLLAMA_KEEP_ALIVE_HOT)
+        if missing or overflow > 0:
+            await self.fetch_resident()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": OLLAMA_RESIDENCY_ENABLED,
+            "max_loaded_models": self.max_loaded(),
+            "hot": self.hot_models(),
+            "resident": self.resident,
+            "route_counts": self.route_counts(),
+            "checked_at": self.checked_at,
+            "keep_alive": {"hot": OLLAMA_KEEP_ALIVE_HOT, "cold": OLLAMA_KEEP_ALIVE_COLD},
+        }
+
+
+model_residency = ModelResidency()
+
+
+async def residency_manager() -> None:
+    while True:
+        try:
+            await model_residency.reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pragma: no cover - ไม่ให้ loop ตาย
+            logger.warning("ollama_residency_failed", extra={"fields": {"error": str(exc)}})
+        await asyncio.sleep(OLLAMA_RESIDENCY_REFRESH_SECONDS)
+
+
+# ---------------------------------------------------------------------------
+# Conversation memory
+# ---------------------------------------------------------------------------
+
+
+@dataclass
+class ConversationState:
+    model: Optional[str] = None
+    # token context ที่ Ollama คืนมาในเทิร์นก่อน ใช้ต่อบทสนทนาโดยไม่ต้อง prefill ประวัติใหม่
+    context: Optional[List[int]] = None
+    context_turns: int = 0
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    updated_at: float = 0.0
+
+
+class ConversationStore:
+    def __init__(self, ttl_seconds: float, max_sessions: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max(max_sessions, 1)
+        self._sessions: "OrderedDict[str, ConversationState]" = OrderedDict()
+
+    def get(self, session_id: Optional[str]) -> Optional[ConversationState]:
+        if not session_id:
+            return None
+        state = self._sessions.get(session_id)
+        if state is None:
+            return None
+        if time.monotonic() - state.updated_at > self.ttl_seconds:
+            del self._sessions[session_id]
+            return None
+        return state
+
+    def record_turn(
+        self,
+        session_id: Optional[str],
+        model: str,
+        question: str,
+        answer: str,
+        context: Optional[List[int]],
+        max_history: int,
+    ) -> None:
+        if not session_id or max_history <= 0:
+            return
+        state = self.get(session_id) or ConversationState()
+        state.messages.extend(
+            [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        )
+        del state.messages[:-max_history]
+        if context:
+            # เทิร์นนี้ต่อจาก context เดิมก็ต่อเมื่อมี context และเป็นโมเดลเดียวกัน (ดู conversation_inputs)
+            continued = state.context is not None and state.model == model
+            state.context = context
+            state.context_turns = state.context_turns + 1 if continued else 1
+        else:
+            state.context = None
+            state.context_turns = 0
+        # context ของ Ollama โตทุกเทิร์น เมื่อยาวเกิน max_history ให้เริ่มใหม่จากประวัติที่ตัดแล้ว
+        if state.context_turns * 2 > max_history:
+            state.context = None
+            state.context_turns = 0
+        state.model = model
+        state.updated_at = time.monotonic()
+        self._sessions[session_id] = state
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def clear(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+conversations = ConversationStore(CONVERSATION_TTL_SECONDS, CONVERSATION_MAX_SESSIONS)
+
+
+def conversation_inputs(
+    session_id: Optional[str], model: str
+) -> Tuple[List[Dict[str, str]], Optional[List[int]]]:
+    """คืน (ประวัติแบบข้อความ, context ของ Ollama) อย่างใดอย่างหนึ่งสำหรับเทิร์นถัดไป"""
+    state = conversations.get(session_id)
+    if state is None:
+        return [], None
+    if state.context and state.model == model:
+        return [], state.context
+    return list(state.messages), None
+
+
+def max_history_messages() -> int:
+    return int(get_model_config_snapshot()["context"].get("max_history_messages", 0) or 0)
 
 
 # ---------------------------------------------------------------------------
@@ -587,6 +1760,7 @@ class ChatRequest(BaseModel):
     message: str = Field(..., description="ข้อความจากผู้ใช้")
     mode: str = Field("chat", description="chat หรือ doc")
     top_k: int = Field(4, ge=1, le=10)
+    session_id: Optional[str] = Field(None, max_length=128, description="id ของบทสนทนา (web session)")
 
 
 class SearchRequest(BaseModel):
@@ -606,6 +1780,7 @@ class FeatureConfigUpdate(BaseModel):
     tool_registry_validation: Optional[bool] = None
     structured_logging_enabled: Optional[bool] = None
     eval_trace_enabled: Optional[bool] = None
+    request_coalescing_enabled: Optional[bool] = None
 
 
 class MultiModelConfigUpdate(BaseModel):
@@ -630,6 +1805,17 @@ class MemoryConfigUpdate(BaseModel):
     memory_limit: Optional[str] = None
 
 
+class RetrievalConfigUpdate(BaseModel):
+    classifier_enabled: Optional[bool] = None
+    skip_for_code: Optional[bool] = None
+    smalltalk_max_chars: Optional[int] = Field(None, ge=0)
+    smalltalk_residual_chars: Optional[int] = Field(None, ge=0)
+    smalltalk_keywords: Optional[List[str]] = None
+    skip_patterns: Optional[List[str]] = None
+    force_keywords: Optional[List[str]] = None
+    min_chars: Optional[int] = Field(None, ge=0)
+
+
 class ContextConfigUpdate(BaseModel):
     thai_code_context: Optional[str] = None
     max_history_messages: Optional[int] = Field(None, ge=0, le=100)
@@ -639,6 +1825,7 @@ class ModelConfigUpdate(BaseModel):
     multi_model: Optional[MultiModelConfigUpdate] = None
     routing: Optional[RoutingConfigUpdate] = None
     memory: Optional[MemoryConfigUpdate] = None
+    retrieval: Optional[RetrievalConfigUpdate] = None
     context: Optional[ContextConfigUpdate] = None
 
 
@@ -651,8 +1838,12 @@ def register_default_tools() -> None:
             url=f"{DOC_DUDE_URL}/query",
             schema=DocQueryPayload,
             feature_flag="FEATURE_DOC_QUERY",
+            hedge=True,
+            max_concurrency=16,
         )
     )
+    # OCR/ingest ไฟล์ใหญ่ช้าเป็นปกติ จึงให้ breaker ดูเฉพาะ error
+    upload_tool_limits: Dict[str, Any] = {"breaker_slow_seconds": None, "max_concurrency": 2}
     tool_registry.register(
         ToolDefinition(
             intent="doc.ingest",
@@ -660,6 +1851,7 @@ def register_default_tools() -> None:
             method="UPLOAD",
             url=f"{DOC_DUDE_URL}/ingest",
             feature_flag="FEATURE_DOC_INGEST",
+            **upload_tool_limits,
         )
     )
     tool_registry.register(
@@ -669,6 +1861,7 @@ def register_default_tools() -> None:
             method="UPLOAD",
             url=f"{DOC_DUDE_URL}/ocr",
             feature_flag="FEATURE_DOC_OCR",
+            **upload_tool_limits,
         )
     )
     tool_registry.register(
@@ -761,6 +1954,48 @@ def _is_thai_heavy(text: str, threshold: float) -> bool:
     return ratio >= max(0.0, min(threshold, 1.0))
 
 
+SMALLTALK_STRIP_PATTERN = re.compile(r"[\s!?.,~ๆ]+|ครับ|ค่ะ|คะ|นะ|จ้า|จ้ะ|ค้าบ")
+
+
+def _classify_retrieval(
+    message: str,
+    retrieval_cfg: Dict[str, Any],
+    *,
+    has_code: bool,
+    thai_heavy: bool,
+) -> Tuple[bool, str]:
+    if not retrieval_cfg.get("classifier_enabled", True):
+        return True, "classifier_disabled"
+    lowered = message.strip().lower()
+    if any(keyword.lower() in lowered for keyword in retrieval_cfg.get("force_keywords", [])):
+        return True, "force_keyword"
+    if has_code and not thai_heavy and retrieval_cfg.get("skip_for_code", True):
+        return False, "code_only"
+    core = SMALLTALK_STRIP_PATTERN.sub("", lowered)
+    if len(core) < int(retrieval_cfg.get("min_chars", 0)):
+        return False, "too_short"
+    if len(lowered) <= int(retrieval_cfg.get("smalltalk_max_chars", 0)):
+        residual = lowered
+        matched = 0
+        for keyword in retrieval_cfg.get("smalltalk_keywords", []):
+            keyword = keyword.lower()
+            # คำภาษาอังกฤษต้องตรงทั้งคำ ("hi" ไม่ควรจับ "this")
+            pattern = rf"\b{re.escape(keyword)}\b" if keyword.isascii() else re.escape(keyword)
+            residual, count = re.subn(pattern, " ", residual)
+            matched += count
+        # ทักทายแล้วตามด้วยคำถามจริง (เช่น "สวัสดีครับ อยากทราบ...") ยังต้องค้นอยู่
+        residual_limit = int(retrieval_cfg.get("smalltalk_residual_chars", 0))
+        if matched and len(SMALLTALK_STRIP_PATTERN.sub("", residual)) <= residual_limit:
+            return False, "smalltalk"
+    for pattern in retrieval_cfg.get("skip_patterns", []):
+        try:
+            if re.search(pattern, lowered):
+                return False, "skip_pattern"
+        except re.error:
+            logger.warning("invalid_skip_pattern", extra={"fields": {"pattern": pattern}})
+    return True, "default"
+
+
 def select_model_for_message(message: str) -> Dict[str, Any]:
     snapshot = get_model_config_snapshot()
     routing = snapshot["routing"]
@@ -793,12 +2028,17 @@ def select_model_for_message(message: str) -> Dict[str, Any]:
     if has_code and thai_heavy:
         context_applied = context_cfg.get("thai_code_context")
 
+    needs_retrieval, retrieval_reason = _classify_retrieval(
+        message, snapshot.get("retrieval", {}), has_code=has_code, thai_heavy=thai_heavy
+    )
+
     return {
         "model": chosen,
         "reason": reason,
         "has_code": has_code,
         "thai_heavy": thai_heavy,
         "context": context_applied,
+        "retrieval": {"needed": needs_retrieval, "reason": retrieval_reason},
     }
 
 
@@ -834,20 +2074,23 @@ def verify_line_signature(signature: str, body: bytes) -> bool:
     return hmac.compare_digest(expected, signature)
 
 
-async def generate_llm_answer(
+def _build_llm_payload(
     model: str,
     question: str,
     *,
     context_text: Optional[str] = None,
     system_prompt: Optional[str] = None,
-) -> str:
+    stream: bool = False,
+    history: Optional[List[Dict[str, str]]] = None,
+    ollama_context: Optional[List[int]] = None,
+) -> Dict[str, Any]:
     if not model:
         raise RuntimeError("ยังไม่ได้ตั้งค่าโมเดลสำหรับการตอบสนทนา")
 
-    current_time_str = datetime.now(LOCAL_TZINFO).strftime("%d %b %Y %H:%M")
+    # system prompt ต้องคงที่ระหว่างเทิร์น (ไม่ใส่เวลา) เพื่อให้ Ollama ใช้ prefix cache เดิมได้
     base_system_prompt = (
         "คุณคือผู้ช่วยที่พูดไทยเป็นหลัก ใช้น้ำเสียงสุภาพและจริงใจ. "
-        f"เวลาปัจจุบันของคุณคือ {current_time_str} (เขตเวลา {LOCAL_TZ}). "
+        f"เขตเวลาของผู้ใช้คือ {LOCAL_TZ}. "
         "หากผู้ใช้ทักทาย ให้ทักทายตอบ. หากไม่ได้ให้ข้อมูลพอ ให้ตอบตามความรู้ทั่วไปอย่างตรงไปตรงมาพร้อมแนะนำให้เพิ่มข้อมูลในระบบถ้าจำเป็น."
     )
     if system_prompt:
@@ -855,37 +2098,164 @@ async def generate_llm_answer(
 
     payload: Dict[str, Any] = {
         "model": model,
-        "prompt": question,
-        "stream": False,
+        "stream": stream,
+        "system": base_system_prompt,
     }
-
+    if ollama_context:
+        payload["context"] = ollama_context
+
+    sections: List[str] = []
+    if history:
+        lines = [
+            f"{'ผู้ใช้' if item['role'] == 'user' else 'ผู้ช่วย'}: {item['content']}"
+            for item in history
+        ]
+        sections.append("บทสนทนาก่อนหน้า:\n" + "\n".join(lines))
+    current_time_str = datetime.now(LOCAL_TZINFO).strftime("%d %b %Y %H:%M")
+    sections.append(f"เวลาปัจจุบัน: {current_time_str}")
     if context_text:
-        prompt = (
+        sections.append(
             "บริบท:\n"
             f"{context_text}\n\n"
             "ตอบคำถามต่อไปนี้โดยใช้ข้อมูลข้างต้น หากไม่พบคำตอบ ให้ตอบตามความรู้ทั่วไปให้สุภาพและเป็นภาษาไทย:\n"
             f"{question}"
         )
-        payload["prompt"] = prompt
     else:
-        payload["prompt"] = (
-            "ตอบคำถามต่อไปนี้เป็นภาษาไทยอย่างสุภาพ หากเป็นการทักทายให้ทักทายกลับ:"\
+        sections.append(
+            "ตอบคำถามต่อไปนี้เป็นภาษาไทยอย่างสุภาพ หากเป็นการทักทายให้ทักทายกลับ:"
             f"\n{question}"
         )
+    payload["prompt"] = "\n\n".join(sections)
+    return payload
 
-    payload["system"] = base_system_prompt
 
-    async with httpx.AsyncClient(timeout=OLLAMA_TIMEOUT) as client:
-        response = await client.post(f"{OLLAMA_BASE_URL}/api/generate", json=payload)
+async def generate_llm_answer(
+    model: str,
+    question: str,
+    *,
+    context_text: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    session_id: Optional[str] = None,
+) -> str:
+    history, ollama_context = conversation_inputs(session_id, model)
+    payload = _build_llm_payload(
+        model,
+        question,
+        context_text=context_text,
+        system_prompt=system_prompt,
+        history=history,
+        ollama_context=ollama_context,
+    )
+    model_residency.prepare(model, payload)
+
+    async def call() -> Tuple[str, Optional[List[int]]]:
+        async with lane_slot("llm.generate", OLLAMA_MAX_CONCURRENCY):
+            response = await upstream_request(
+                "POST",
+                f"{OLLAMA_BASE_URL}/api/generate",
+                json=payload,
+                timeout=OLLAMA_TIMEOUT,
+            )
         response.raise_for_status()
-    data = response.json()
-    text = data.get("response")
-    if not isinstance(text, str) or not text.strip():
-        raise RuntimeError("โมเดลไม่ส่งข้อความกลับมา")
-    return text.strip()
+        data = response.json()
+        model_residency.observe_response(model, data)
+        text = data.get("response")
+        if not isinstance(text, str) or not text.strip():
+            raise RuntimeError("โมเดลไม่ส่งข้อความกลับมา")
+        return text.strip(), data.get("context")
+
+    if is_feature_enabled("request_coalescing_enabled"):
+        text, new_context = await single_flight.do(
+            single_flight_key("llm.generate", payload), "llm.generate", call
+        )
+    else:
+        text, new_context = await call()
+    conversations.record_turn(
+        session_id, model, question, text, new_context, max_history_messages()
+    )
+    return text
+
+
+async def stream_llm_answer(
+    model: str,
+    question: str,
+    *,
+    context_text: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    session_id: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """ส่ง delta ของคำตอบทีละชิ้นตามที่ Ollama สตรีมกลับมา (NDJSON หนึ่งบรรทัดต่อ chunk)"""
+    history, ollama_context = conversation_inputs(session_id, model)
+    payload = _build_llm_payload(
+        model,
+        question,
+        context_text=context_text,
+        system_prompt=system_prompt,
+        stream=True,
+        history=history,
+        ollama_context=ollama_context,
+    )
+    model_residency.prepare(model, payload)
+
+    async def upstream() -> AsyncIterator[Tuple[str, Any]]:
+        started = time.perf_counter()
+        first_token = True
+        async with lane_slot("llm.generate", OLLAMA_MAX_CONCURRENCY), upstream_stream(
+            "POST",
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json=payload,
+            timeout=OLLAMA_TIMEOUT,
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(str(chunk["error"]))
+                delta = chunk.get("response")
+                if isinstance(delta, str) and delta:
+                    if first_token:
+                        first_token = False
+                        LLM_TTFT.labels(model=model).observe(time.perf_counter() - started)
+                    yield "delta", delta
+                if chunk.get("done"):
+                    model_residency.observe_response(model, chunk)
+                    if not first_token:
+                        yield "done", chunk.get("context")
+                    break
+        if first_token:
+            raise RuntimeError("โมเดลไม่ส่งข้อความกลับมา")
+
+    # คำขอซ้ำพร้อมกันอ่าน stream เส้นเดียวกัน แต่บันทึกบทสนทนาแยกตาม session ของตัวเอง
+    if is_feature_enabled("request_coalescing_enabled"):
+        source = single_flight.stream(single_flight_key("llm.stream", payload), "llm.stream", upstream)
+    else:
+        source = upstream()
+    deltas: List[str] = []
+    new_context: Optional[List[int]] = None
+    async for kind, value in source:
+        if kind == "delta":
+            deltas.append(value)
+            yield value
+        else:
+            new_context = value
+    conversations.record_turn(
+        session_id, model, question, "".join(deltas).strip(), new_context, max_history_messages()
+    )
+
+
+async def fetch_sources(route_info: Dict[str, Any], intent_payload: Dict[str, Any]) -> List[dict]:
+    retrieval = route_info.get("retrieval") or {"needed": True, "reason": "default"}
+    decision = "retrieve" if retrieval["needed"] else "skip"
+    RETRIEVAL_DECISION_COUNTER.labels(decision=decision, reason=retrieval["reason"]).inc()
+    if not retrieval["needed"]:
+        return []
+    doc_result = await execute_tool("doc.query", intent_payload)
+    return doc_result.get("sources", [])
 
 
-async def build_chat_response(message: str) -> Dict[str, Any]:
+async def build_chat_response(message: str, session_id: Optional[str] = None) -> Dict[str, Any]:
     intent_payload = {
         "q": message,
         "top_k": 4,
@@ -896,10 +2266,8 @@ async def build_chat_response(message: str) -> Dict[str, Any]:
     context_applied = route_info.get("context")
     status = "success"
     started = time.perf_counter()
-    doc_result: Dict[str, Any] = {}
     try:
-        doc_result = await execute_tool("doc.query", intent_payload)
-        sources = doc_result.get("sources", [])
+        sources = await fetch_sources(route_info, intent_payload)
         context_text = _summarize_sources_for_prompt(sources)
         try:
             answer = await generate_llm_answer(
@@ -907,6 +2275,7 @@ async def build_chat_response(message: str) -> Dict[str, Any]:
                 message,
                 context_text=context_text,
                 system_prompt=context_applied,
+                session_id=session_id,
             )
         except Exception as llm_error:
             logger.warning(
@@ -932,7 +2301,12 @@ async def build_chat_response(message: str) -> Dict[str, Any]:
                 "/chat",
                 get_correlation_id(),
                 intent_payload,
-                {"status": status, "model": selected_model, "reason": route_info.get("reason")},
+                {
+                    "status": status,
+                    "model": selected_model,
+                    "reason": route_info.get("reason"),
+                    "retrieval": route_info.get("retrieval"),
+                },
                 duration_ms,
             )
         except Exception:
@@ -969,14 +2343,19 @@ async def send_line_reply(
         "replyToken": reply_token,
         "messages": messages_payload,
     }
-    async with httpx.AsyncClient(timeout=LINE_TIMEOUT) as client:
-        response = await client.post(LINE_REPLY_URL, headers=headers, json=payload)
-        if response.status_code >= 300:
-            logger.error(
-                "line_reply_failed",
-                extra={"fields": {"status": response.status_code, "body": response.text}},
-            )
-            raise HTTPException(status_code=500, detail="LINE reply failed")
+    response = await upstream_request(
+        "POST",
+        LINE_REPLY_URL,
+        headers=headers,
+        json=payload,
+        timeout=LINE_TIMEOUT,
+    )
+    if response.status_code >= 300:
+        logger.error(
+            "line_reply_failed",
+            extra={"fields": {"status": response.status_code, "body": response.text}},
+        )
+        raise HTTPException(status_code=500, detail="LINE reply failed")
 
 
 async def post_json(
@@ -984,6 +2363,7 @@ async def post_json(
     payload: Dict[str, Any],
     *,
     timeout: float = 120,
+    connect_timeout: Optional[float] = None,
     headers: Optional[Dict[str, str]] = None,
 ) -> dict:
     base_headers = {"Content-Type": "application/json"}
@@ -992,10 +2372,16 @@ async def post_json(
     cid = get_correlation_id()
     if cid:
         base_headers.setdefault("X-Correlation-ID", cid)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        response = await client.post(url, json=payload, headers=base_headers)
-        response.raise_for_status()
-        return response.json()
+    response = await upstream_request(
+        "POST",
+        url,
+        json=payload,
+        headers=base_headers,
+        timeout=timeout,
+        connect_timeout=connect_timeout,
+    )
+    response.raise_for_status()
+    return response.json()
 
 
 async def post_file(
@@ -1004,6 +2390,7 @@ async def post_file(
     *,
     fields: Optional[Dict[str, Any]] = None,
     timeout: float = 180,
+    connect_timeout: Optional[float] = None,
 ) -> dict:
     cid = get_correlation_id()
     headers: Dict[str, str] = {}
@@ -1012,23 +2399,360 @@ async def post_file(
     data = fields or {}
     contents = await file.read()
     files = {"file": (file.filename, contents, file.content_type or "application/octet-stream")}
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        response = await client.post(url, data=data, files=files, headers=headers)
-        response.raise_for_status()
-        return response.json()
+    response = await upstream_request(
+        "POST",
+        url,
+        data=data,
+        files=files,
+        headers=headers,
+        timeout=timeout,
+        connect_timeout=connect_timeout,
+    )
+    response.raise_for_status()
+    return response.json()
 
 
-async def get_json(url: str, *, timeout: float = 10) -> dict:
+async def get_json(
+    url: str,
+    *,
+    timeout: float = 10,
+    connect_timeout: Optional[float] = None,
+) -> dict:
     headers: Dict[str, str] = {}
     cid = get_correlation_id()
     if cid:
         headers["X-Correlation-ID"] = cid
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        response = await client.get(url, headers=headers)
-        response.raise_for_status()
-        if response.headers.get("content-type", "").startswith("application/json"):
-            return response.json()
-        return {"raw": response.text, "status": response.status_code}
+    response = await upstream_request(
+        "GET",
+        url,
+        headers=headers,
+        timeout=timeout,
+        connect_timeout=connect_timeout,
+    )
+    response.raise_for_status()
+    if response.headers.get("content-type", "").startswith("application/json"):
+        return response.json()
+    return {"raw": response.text, "status": response.status_code}
+
+
+async def _call_tool(
+    tool: ToolDefinition,
+    payload: Dict[str, Any],
+    *,
+    file: Optional[UploadFile] = None,
+    form_fields: Optional[Dict[str, Any]] = None,
+) -> dict:
+    if tool.method == "POST_JSON":
+        return await post_json(
+            tool.url,
+            payload,
+            timeout=tool.timeout,
+            connect_timeout=tool.connect_timeout,
+        )
+    if tool.method == "UPLOAD":
+        if file is None:
+            raise ValueError("ต้องระบุไฟล์สำหรับเครื่องมือนี้")
+        return await post_file(
+            tool.url,
+            file,
+            fields=form_fields,
+            timeout=tool.timeout,
+            connect_timeout=tool.connect_timeout,
+        )
+    if tool.method in {"GET", "GET_JSON"}:
+        return await get_json(
+            tool.url,
+            timeout=tool.timeout,
+            connect_timeout=tool.connect_timeout,
+        )
+    raise ValueError(f"เครื่องมือ {tool.intent} ยังไม่รองรับ method {tool.method}")
+
+
+# ---------------------------------------------------------------------------
+# Priority lanes
+# ---------------------------------------------------------------------------
+
+
+class LaneShedError(RuntimeError):
+    def __init__(self, message: str, status_code: int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LaneLimiter:
+    """จำกัดจำนวนคำขอพร้อมกันต่อ intent; คำขอที่ต้องรอจะได้ slot ตามลำดับ lane แล้วตามลำดับมาก่อน"""
+
+    def __init__(self, intent: str, limit: int) -> None:
+        self.intent = intent
+        self.limit = max(limit, 1)
+        self.active = 0
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._depth: Dict[str, int] = {}
+
+    def release(self) -> None:
+        while self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                # ส่ง slot ต่อให้ผู้รอโดยตรง active จึงไม่ลดลง
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def try_acquire(self, lane: str) -> bool:
+        """จอง slot เฉพาะเมื่อว่างทันทีและไม่มีใครรอคิว (ไม่ต่อคิว ไม่ถูก shed)"""
+        if self.active >= self.limit or self._queue:
+            return False
+        self.active += 1
+        LANE_WAIT.labels(intent=self.intent, lane=lane).observe(0)
+        return True
+
+    async def acquire(self, lane: str) -> None:
+        if self.active < self.limit and not self._queue:
+            self.active += 1
+            LANE_WAIT.labels(intent=self.intent, lane=lane).observe(0)
+            return
+        if self._depth.get(lane, 0) >= LANE_QUEUE_MAX.get(lane, 50):
+            LANE_SHED_COUNTER.labels(intent=self.intent, lane=lane, reason="queue_full").inc()
+            raise LaneShedError(f"คิวของ {self.intent} เต็ม ลองใหม่อีกครั้ง", 429)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (LANE_PRIORITIES.get(lane, len(LANE_PRIORITIES)), self._seq, waiter))
+        self._depth[lane] = self._depth.get(lane, 0) + 1
+        depth_gauge = LANE_QUEUE_DEPTH.labels(intent=self.intent, lane=lane)
+        depth_gauge.inc()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, LANE_QUEUE_TIMEOUTS.get(lane, 10.0))
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            LANE_SHED_COUNTER.labels(intent=self.intent, lane=lane, reason="deadline").inc()
+            raise LaneShedError(f"{self.intent} ไม่ว่างภายในเวลาที่กำหนด", 503) from None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            self._depth[lane] -= 1
+            depth_gauge.dec()
+            LANE_WAIT.labels(intent=self.intent, lane=lane).observe(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def slot(self, lane: str) -> AsyncIterator[None]:
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_lane_limiters: Dict[str, LaneLimiter] = {}
+
+
+def lane_limiter(intent: str, default_limit: Optional[int]) -> Optional[LaneLimiter]:
+    limit = TOOL_CONCURRENCY.get(intent, default_limit)
+    if not limit:
+        return None
+    limiter = _lane_limiters.get(intent)
+    if limiter is None:
+        limiter = LaneLimiter(intent, limit)
+        _lane_limiters[intent] = limiter
+    return limiter
+
+
+@asynccontextmanager
+async def lane_slot(intent: str, default_limit: Optional[int]) -> AsyncIterator[None]:
+    limiter = lane_limiter(intent, default_limit)
+    if limiter is None:
+        yield
+        return
+    async with limiter.slot(request_lane_ctx.get()):
+        yield
+
+
+# ---------------------------------------------------------------------------
+# Circuit breakers + hedged tool calls
+# ---------------------------------------------------------------------------
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    # 4xx คือคำขอผิดเอง ไม่ใช่สัญญาณว่า upstream ป่วย
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """closed → open เมื่อ failure rate ใน window ถึงเกณฑ์, open → half_open หลัง breaker_open_seconds
+    แล้วปล่อย probe ทีละหนึ่งคำขอ: สำเร็จกลับเป็น closed, ล้มเหลวเปิดใหม่"""
+
+    STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, tool: ToolDefinition) -> None:
+        self.tool = tool
+        self.state = "closed"
+        self.outcomes: Deque[bool] = deque(maxlen=max(BREAKER_WINDOW, 1))
+        self.latencies_ms: Deque[float] = deque(maxlen=max(TOOL_HEDGE_WINDOW, 1))
+        self.opened_at = 0.0
+        self.probing = False
+        BREAKER_STATE.labels(intent=tool.intent).set(0)
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        if state == "closed":
+            self.outcomes.clear()
+        BREAKER_STATE.labels(intent=self.tool.intent).set(self.STATE_VALUES[state])
+        BREAKER_TRANSITION_COUNTER.labels(intent=self.tool.intent, state=state).inc()
+        logger.warning(
+            "circuit_breaker_transition",
+            extra={"fields": {"intent": self.tool.intent, "state": state}},
+        )
+
+    def before_call(self) -> bool:
+        """คืน True ถ้าคำขอนี้เป็น probe ของสถานะ half_open"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.tool.breaker_open_seconds:
+                BREAKER_REJECTED_COUNTER.labels(intent=self.tool.intent).inc()
+                raise CircuitOpenError(f"เครื่องมือ {self.tool.intent} ถูกพักชั่วคราว (circuit open)")
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probing:
+                BREAKER_REJECTED_COUNTER.labels(intent=self.tool.intent).inc()
+                raise CircuitOpenError(f"เครื่องมือ {self.tool.intent} กำลังทดสอบการฟื้นตัว (half-open)")
+            self.probing = True
+            return True
+        return False
+
+    def record(self, probe: bool, failed: bool, seconds: float) -> None:
+        slow = self.tool.breaker_slow_seconds
+        if not failed:
+            self.latencies_ms.append(seconds * 1000)
+        failed = failed or (slow is not None and seconds > slow)
+        if probe:
+            self.probing = False
+            self._transition("open" if failed else "closed")
+            return
+        if self.state != "closed":
+            return
+        self.outcomes.append(failed)
+        if len(self.outcomes) >= max(self.tool.breaker_min_calls, 1):
+            if sum(self.outcomes) / len(self.outcomes) >= self.tool.breaker_failure_rate:
+                self._transition("open")
+
+    def release_probe(self) -> None:
+        self.probing = False
+
+    def hedge_delay_ms(self) -> float:
+        if len(self.latencies_ms) < TOOL_HEDGE_MIN_SAMPLES:
+            return TOOL_HEDGE_MAX_DELAY_MS
+        observed = latency_percentiles(list(self.latencies_ms))["p95"]
+        return min(max(observed, TOOL_HEDGE_MIN_DELAY_MS), TOOL_HEDGE_MAX_DELAY_MS)
+
+    def snapshot(self) -> Dict[str, Any]:
+        failures = sum(self.outcomes)
+        snapshot: Dict[str, Any] = {
+            "state": self.state,
+            "window_calls": len(self.outcomes),
+            "failure_rate": round(failures / len(self.outcomes), 3) if self.outcomes else 0.0,
+        }
+        if self.state == "open":
+            remaining = self.tool.breaker_open_seconds - (time.monotonic() - self.opened_at)
+            snapshot["retry_in_seconds"] = round(max(remaining, 0.0), 1)
+        if self.tool.hedge:
+            snapshot["hedge_delay_ms"] = round(self.hedge_delay_ms(), 2)
+        return snapshot
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def breaker_for(tool: ToolDefinition) -> CircuitBreaker:
+    breaker = _breakers.get(tool.intent)
+    if breaker is None:
+        breaker = CircuitBreaker(tool)
+        _breakers[tool.intent] = breaker
+    return breaker
+
+
+def breaker_snapshot() -> Dict[str, Dict[str, Any]]:
+    return {intent: breaker.snapshot() for intent, breaker in _breakers.items()}
+
+
+def _discard_task_result(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+async def hedged_tool_call(tool: ToolDefinition, payload: Dict[str, Any], delay_ms: float) -> dict:
+    """ยิงคำขอแรก ถ้าเกิน delay (p95) ยังไม่จบ ให้ยิงซ้ำคู่ขนานแล้วใช้คำตอบแรกที่สำเร็จ"""
+    primary = asyncio.create_task(_call_tool(tool, payload))
+    primary.add_done_callback(_discard_task_result)
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay_ms / 1000)
+        if primary in done:
+            return primary.result()
+        # hedge ต้องได้ slot ของตัวเอง ไม่อย่างนั้นตอน upstream ช้า (ซึ่งมักคือ overload) จะยิงเป็นสองเท่า
+        limiter = lane_limiter(tool.intent, tool.max_concurrency)
+        if limiter is not None and not limiter.try_acquire(request_lane_ctx.get()):
+            TOOL_HEDGE_COUNTER.labels(intent=tool.intent, outcome="skipped").inc()
+            return await primary
+        hedge = asyncio.create_task(_call_tool(tool, payload))
+        hedge.add_done_callback(_discard_task_result)
+        if limiter is not None:
+            hedge.add_done_callback(lambda _: limiter.release())
+        tasks.append(hedge)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    outcome = "hedge" if task is hedge else "primary_late"
+                    TOOL_HEDGE_COUNTER.labels(intent=tool.intent, outcome=outcome).inc()
+                    return task.result()
+        TOOL_HEDGE_COUNTER.labels(intent=tool.intent, outcome="failed").inc()
+        return primary.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def _guarded_call(
+    tool: ToolDefinition,
+    payload: Dict[str, Any],
+    *,
+    file: Optional[UploadFile] = None,
+    form_fields: Optional[Dict[str, Any]] = None,
+) -> dict:
+    breaker = breaker_for(tool)
+    async with lane_slot(tool.intent, tool.max_concurrency):
+        probe = breaker.before_call()
+        started = time.perf_counter()
+        try:
+            if tool.hedge and not probe and tool.method != "UPLOAD":
+                result = await hedged_tool_call(tool, payload, breaker.hedge_delay_ms())
+            else:
+                result = await _call_tool(tool, payload, file=file, form_fields=form_fields)
+        except asyncio.CancelledError:
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception as exc:
+            breaker.record(probe, _is_upstream_failure(exc), time.perf_counter() - started)
+            raise
+        breaker.record(probe, False, time.perf_counter() - started)
+    return result
 
 
 async def execute_tool(
@@ -1053,25 +2777,16 @@ async def execute_tool(
     status = "success"
     response_summary: Dict[str, Any] = {}
     try:
-        if tool.method == "POST_JSON":
-            result = await post_json(
-                tool.url,
-                validated_payload,
-                timeout=tool.timeout,
-            )
-        elif tool.method == "UPLOAD":
-            if file is None:
-                raise ValueError("ต้องระบุไฟล์สำหรับเครื่องมือนี้")
-            result = await post_file(
-                tool.url,
-                file,
-                fields=form_fields,
-                timeout=tool.timeout,
+        if tool.method != "UPLOAD" and is_feature_enabled("request_coalescing_enabled"):
+            result = await single_flight.do(
+                single_flight_key(intent, validated_payload),
+                intent,
+                lambda: _guarded_call(tool, validated_payload),
             )
-        elif tool.method in {"GET", "GET_JSON"}:
-            result = await get_json(tool.url, timeout=tool.timeout)
         else:
-            raise ValueError(f"เครื่องมือ {intent} ยังไม่รองรับ method {tool.method}")
+            result = await _guarded_call(
+                tool, validated_payload, file=file, form_fields=form_fields
+            )
 
         if isinstance(result, dict):
             response_summary = {
@@ -1103,6 +2818,46 @@ def format_sse(event: str, payload: dict) -> str:
     return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
 
+SSE_HEARTBEAT = ": keep-alive\n\n"
+
+
+async def _await_once(awaitable: Any) -> AsyncIterator[Any]:
+    yield await awaitable
+
+
+async def with_heartbeats(source: AsyncIterator[Any], interval: float) -> AsyncIterator[Any]:
+    """ส่งต่อข้อมูลจาก source และ yield None ทุก interval วินาทีที่ยังไม่มีข้อมูลใหม่
+
+    source ถูกอ่านใน task แยกเพียง task เดียว (context manager ของ httpx จึงเปิด/ปิดใน task เดิม)
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async for item in source:
+                queue.put_nowait(("item", item))
+        except Exception as exc:
+            queue.put_nowait(("error", exc))
+        else:
+            queue.put_nowait(("done", None))
+
+    producer = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                kind, value = await asyncio.wait_for(queue.get(), timeout=interval)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if kind == "error":
+                raise value
+            if kind == "done":
+                return
+            yield value
+    finally:
+        producer.cancel()
+
+
 def build_answer(question: str, sources: List[dict], mode: str) -> str:
     if not sources:
         return "ยังไม่พบข้อมูลที่เกี่ยวข้องในฐานความรู้ ลองเพิ่มข้อมูลหรือเปลี่ยนคำถามดูนะครับ"
@@ -1118,11 +2873,75 @@ def build_answer(question: str, sources: List[dict], mode: str) -> str:
     return intro + "\n" + "\n".join(snippets)
 
 
-def stream_tokens(answer: str) -> List[str]:
-    tokens = answer.split()
-    if not tokens:
-        return [answer]
-    return tokens
+# ---------------------------------------------------------------------------
+# Agent health cache
+# ---------------------------------------------------------------------------
+
+_agent_health: Dict[str, Dict[str, Any]] = {}
+_agent_health_state: Dict[str, float] = {"refreshed_at": 0.0, "started_at": float("-inf")}
+_agent_health_lock = asyncio.Lock()
+
+
+async def check_agent(tool: ToolDefinition) -> Dict[str, Any]:
+    started = time.perf_counter()
+    try:
+        data = await asyncio.wait_for(execute_tool(tool.intent), AGENT_HEALTH_TIMEOUT_SECONDS)
+        result: Dict[str, Any] = {"ok": True, "data": data}
+    except asyncio.TimeoutError:
+        result = {"ok": False, "error": f"ไม่ตอบภายใน {AGENT_HEALTH_TIMEOUT_SECONDS:g} วินาที"}
+    except Exception as exc:
+        result = {"ok": False, "error": str(exc)}
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    result["checked_at"] = datetime.utcnow().isoformat(timespec="seconds")
+    result["_checked_monotonic"] = time.monotonic()
+    return result
+
+
+async def refresh_agent_health(
+    seen_refreshed_at: Optional[float] = None, requested_at: Optional[float] = None
+) -> bool:
+    """รีเฟรชสถานะ agent ทีละรอบ คืน False ถ้าใช้ผลรอบที่เพิ่งเสร็จระหว่างรอ lock แทน
+
+    seen_refreshed_at: ผลที่ผู้เรียกเห็นล่าสุด (มีรอบใหม่กว่าก็ใช้ได้)
+    requested_at: เวลาที่ผู้เรียกขอผลสด (ใช้ได้เฉพาะรอบที่เริ่มหลังเวลานี้)
+    """
+    async with _agent_health_lock:
+        if seen_refreshed_at is not None and _agent_health_state["refreshed_at"] != seen_refreshed_at:
+            # มีคำขออื่นรีเฟรชเสร็จระหว่างรอ lock แล้ว ไม่ต้องยิง agent ซ้ำ
+            return False
+        if requested_at is not None and _agent_health_state["started_at"] >= requested_at:
+            # ?fresh=true ที่มาพร้อมกันใช้รอบเดียวกัน ไม่ไล่ยิง agent ที่กำลังป่วยซ้ำทีละคำขอ
+            return False
+        _agent_health_state["started_at"] = time.monotonic()
+        tools = tool_registry.list_by_category(HEALTH_INTENT_CATEGORY)
+        results = await asyncio.gather(*(check_agent(tool) for tool in tools))
+        for tool, result in zip(tools, results):
+            _agent_health[tool.intent] = result
+        _agent_health_state["refreshed_at"] = time.monotonic()
+    return True
+
+
+async def agent_health_refresher() -> None:
+    while True:
+        try:
+            await refresh_agent_health()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pragma: no cover - ไม่ให้ loop ตาย
+            logger.warning("agent_health_refresh_failed", extra={"fields": {"error": str(exc)}})
+        await asyncio.sleep(AGENT_HEALTH_REFRESH_SECONDS)
+
+
+def agent_health_snapshot() -> Dict[str, Dict[str, Any]]:
+    now = time.monotonic()
+    snapshot: Dict[str, Dict[str, Any]] = {}
+    for intent, result in _agent_health.items():
+        age = now - result["_checked_monotonic"]
+        entry = {key: value for key, value in result.items() if not key.startswith("_")}
+        entry["age_seconds"] = round(age, 3)
+        entry["stale"] = age > AGENT_HEALTH_STALE_SECONDS
+        snapshot[intent] = entry
+    return snapshot
 
 
 # ---------------------------------------------------------------------------
@@ -1130,10 +2949,19 @@ def stream_tokens(answer: str) -> List[str]:
 # ---------------------------------------------------------------------------
 
 
+_background_tasks: List[asyncio.Task] = []
+
+
 @app.on_event("startup")
 async def startup_event():
     loop = asyncio.get_running_loop()
     await loop.run_in_executor(None, init_trace_db)
+    await trace_writer.start()
+    init_upstream_clients()
+    _background_tasks.append(asyncio.create_task(trace_compactor()))
+    _background_tasks.append(asyncio.create_task(agent_health_refresher()))
+    if OLLAMA_RESIDENCY_ENABLED:
+        _background_tasks.append(asyncio.create_task(residency_manager()))
     logger.info(
         "startup",
         extra={
@@ -1145,6 +2973,14 @@ async def startup_event():
     )
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in _background_tasks:
+        task.cancel()
+    await close_upstream_clients()
+    await trace_writer.stop()
+
+
 @app.get("/health")
 async def health():
     return {"ok": True}
@@ -1190,8 +3026,19 @@ async def preview_routing(payload: ChatRequest):
     return {"ok": True, "routing": routing}
 
 
+@app.get("/router/residency")
+async def router_residency():
+    return {"ok": True, "residency": model_residency.snapshot()}
+
+
+@app.delete("/chat/sessions/{session_id}")
+async def clear_chat_session(session_id: str):
+    return {"ok": True, "cleared": conversations.clear(session_id)}
+
+
 @app.post("/webhook/line")
 async def line_webhook_entry(request: Request):
+    request_lane_ctx.set("webhook")
     body = await request.body()
     signature = request.headers.get("x-line-signature", "")
     if not signature or not verify_line_signature(signature, body):
@@ -1230,7 +3077,9 @@ async def line_webhook_entry(request: Request):
             continue
 
         try:
-            result = await build_chat_response(user_text)
+            source = event.get("source") or {}
+            session_id = f"line:{source['userId']}" if source.get("userId") else None
+            result = await build_chat_response(user_text, session_id=session_id)
             answer = result.get("answer") or ""
         except Exception as exc:
             logger.exception("line_chat_failed", extra={"fields": {"error": str(exc)}})
@@ -1241,18 +3090,17 @@ async def line_webhook_entry(request: Request):
 
 
 @app.get("/agents/health")
-async def agents_health():
-    tools = tool_registry.list_by_category(HEALTH_INTENT_CATEGORY)
-    results: Dict[str, Dict[str, Any]] = {}
-    overall_ok = True
+async def agents_health(fresh: bool = False):
     started = time.perf_counter()
-    for tool in tools:
-        try:
-            data = await execute_tool(tool.intent)
-            results[tool.intent] = {"ok": True, "data": data}
-        except Exception as exc:
-            overall_ok = False
-            results[tool.intent] = {"ok": False, "error": str(exc)}
+    cached = True
+    if fresh:
+        cached = not await refresh_agent_health(requested_at=time.monotonic())
+    elif not _agent_health:
+        cached = not await refresh_agent_health(_agent_health_state["refreshed_at"])
+    results = agent_health_snapshot()
+    overall_ok = bool(results) and all(
+        entry["ok"] and not entry["stale"] for entry in results.values()
+    )
     duration_ms = (time.perf_counter() - started) * 1000
     status_label = "success" if overall_ok else "failed"
     REQUEST_COUNTER.labels(endpoint="/agents/health", status=status_label).inc()
@@ -1260,15 +3108,21 @@ async def agents_health():
         "endpoint",
         "/agents/health",
         get_correlation_id(),
-        {"monitored": [tool.intent for tool in tools]},
-        {"status": status_label},
+        {"monitored": list(results), "fresh": fresh},
+        {"status": status_label, "cached": cached},
         duration_ms,
     )
-    return {"ok": overall_ok, "agents": results}
+    return {
+        "ok": overall_ok,
+        "cached": cached,
+        "agents": results,
+        "breakers": breaker_snapshot(),
+    }
 
 
 @app.post("/chat")
 async def chat_stream(req: ChatRequest):
+    request_lane_ctx.set("chat")
     intent_payload = {
         "q": req.message,
         "top_k": req.top_k,
@@ -1282,22 +3136,6 @@ async def chat_stream(req: ChatRequest):
         status = "success"
         context_applied = route_info.get("context")
         try:
-            doc_result = await execute_tool("doc.query", intent_payload)
-            sources = doc_result.get("sources", [])
-            context_text = _summarize_sources_for_prompt(sources)
-            try:
-                answer = await generate_llm_answer(
-                    selected_model,
-                    req.message,
-                    context_text=context_text,
-                    system_prompt=context_applied,
-                )
-            except Exception as llm_error:
-                logger.warning(
-                    "llm_generation_failed",
-                    extra={"fields": {"error": str(llm_error), "model": selected_model}},
-                )
-                answer = build_answer(req.message, sources, req.mode)
             yield format_sse(
                 "routing",
                 {
@@ -1306,21 +3144,78 @@ async def chat_stream(req: ChatRequest):
                     "has_code": route_info.get("has_code"),
                     "thai_heavy": route_info.get("thai_heavy"),
                     "context": context_applied,
-                    "source_count": len(sources),
+                    "retrieval": route_info.get("retrieval"),
                 },
             )
-            for token in stream_tokens(answer):
-                yield format_sse("token", {"value": token})
-                await asyncio.sleep(STREAM_DELAY)
+            sources: List[dict] = []
+            async for item in with_heartbeats(
+                _await_once(fetch_sources(route_info, intent_payload)),
+                SSE_HEARTBEAT_SECONDS,
+            ):
+                if item is None:
+                    yield SSE_HEARTBEAT
+                else:
+                    sources = item
+            yield format_sse(
+                "sources",
+                {
+                    "count": len(sources),
+                    "items": sources,
+                    "skipped": not route_info["retrieval"]["needed"],
+                },
+            )
+            context_text = _summarize_sources_for_prompt(sources)
+            deltas: List[str] = []
+            truncated = False
+            try:
+                async for delta in with_heartbeats(
+                    stream_llm_answer(
+                        selected_model,
+                        req.message,
+                        context_text=context_text,
+                        system_prompt=context_applied,
+                        session_id=req.session_id,
+                    ),
+                    SSE_HEARTBEAT_SECONDS,
+                ):
+                    if delta is None:
+                        yield SSE_HEARTBEAT
+                        continue
+                    deltas.append(delta)
+                    yield format_sse("token", {"value": delta})
+            except Exception as llm_error:
+                logger.warning(
+                    "llm_generation_failed",
+                    extra={
+                        "fields": {
+                            "error": str(llm_error),
+                            "model": selected_model,
+                            "partial": bool(deltas),
+                        }
+                    },
+                )
+                if deltas:
+                    # stream ขาดกลางทาง: ส่ง token ไปแล้วเปลี่ยนเป็น fallback ไม่ได้ ให้ client รู้ว่าคำตอบไม่ครบ
+                    truncated = True
+                    status = "partial"
+                else:
+                    fallback = build_answer(req.message, sources, req.mode)
+                    deltas.append(fallback)
+                    yield format_sse("token", {"value": fallback})
+            answer = "".join(deltas).strip()
+            # sources ถูกส่งไปแล้วใน event "sources" จึงอ้างอิงแค่จำนวน ไม่ส่งซ้ำ
             yield format_sse(
                 "complete",
                 {
                     "answer": answer,
-                    "sources": sources,
+                    "source_count": len(sources),
+                    "sources_event": "sources",
                     "question": req.message,
                     "model": selected_model,
                     "routing_reason": route_info.get("reason"),
+                    "retrieval": route_info.get("retrieval"),
                     "context": context_applied,
+                    "truncated": truncated,
                 },
             )
         except httpx.HTTPStatusError as exc:
@@ -1330,6 +3225,9 @@ async def chat_stream(req: ChatRequest):
             else:
                 detail = exc.response.text
             yield format_sse("error", {"detail": detail})
+        except LaneShedError as exc:
+            status = "shed"
+            yield format_sse("error", {"detail": str(exc), "status": exc.status_code})
         except RuntimeError as exc:
             status = "failed"
             yield format_sse("error", {"detail": str(exc)})
@@ -1345,15 +3243,25 @@ async def chat_stream(req: ChatRequest):
                 "/chat",
                 get_correlation_id(),
                 intent_payload,
-                {"status": status, "model": selected_model, "reason": route_info.get("reason")},
+                {
+                    "status": status,
+                    "model": selected_model,
+                    "reason": route_info.get("reason"),
+                    "retrieval": route_info.get("retrieval"),
+                },
                 duration_ms,
             )
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post("/search")
 async def search(req: SearchRequest):
+    request_lane_ctx.set("search")
     payload = {
         "q": req.query,
         "top_k": req.top_k,
@@ -1372,6 +3280,11 @@ async def search(req: SearchRequest):
             else exc.response.text
         )
         raise HTTPException(status_code=exc.response.status_code, detail=detail) from exc
+    except LaneShedError as exc:
+        status = "shed"
+        raise HTTPException(
+            status_code=exc.status_code, detail=str(exc), headers={"Retry-After": "1"}
+        ) from exc
     except RuntimeError as exc:
         status = "failed"
         raise HTTPException(status_code=503, detail=str(exc)) from exc
@@ -1399,6 +3312,7 @@ async def knowledge_upload(
     note: Optional[str] = Form(None),
     source: Optional[str] = Form(None),
 ):
+    request_lane_ctx.set("upload")
     target_collection = collection or DEFAULT_COLLECTION
     payload_meta = {
         "collection": target_collection,
@@ -1432,6 +3346,11 @@ async def knowledge_upload(
             else exc.response.text
         )
         raise HTTPException(status_code=exc.response.status_code, detail=detail) from exc
+    except LaneShedError as exc:
+        status = "shed"
+        raise HTTPException(
+            status_code=exc.status_code, detail=str(exc), headers={"Retry-After": "1"}
+        ) from exc
     except RuntimeError as exc:
         status = "failed"
         raise HTTPException(status_code=503, detail=str(exc)) from exc
@@ -1454,6 +3373,7 @@ async def knowledge_upload(
 
 @app.post("/vision/analyze")
 async def proxy_ocr(file: UploadFile = File(...)):
+    request_lane_ctx.set("upload")
     status = "success"
     started = time.perf_counter()
     try:
@@ -1467,6 +3387,11 @@ async def proxy_ocr(file: UploadFile = File(...)):
             else exc.response.text
         )
         raise HTTPException(status_code=exc.response.status_code, detail=detail) from exc
+    except LaneShedError as exc:
+        status = "shed"
+        raise HTTPException(
+            status_code=exc.status_code, detail=str(exc), headers={"Retry-After": "1"}
+        ) from exc
     except RuntimeError as exc:
         status = "failed"
         raise HTTPException(status_code=503, detail=str(exc)) from exc
@@ -1487,6 +3412,49 @@ async def proxy_ocr(file: UploadFile = File(...)):
         )
 
 
+@app.get("/traces")
+async def list_traces(
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    event_type: Optional[str] = None,
+    intent: Optional[str] = None,
+    request_id: Optional[str] = None,
+    limit: int = 100,
+    before_id: Optional[int] = None,
+):
+    filters = {"event_type": event_type, "intent": intent, "request_id": request_id}
+    limit = min(max(limit, 1), TRACE_QUERY_MAX_LIMIT)
+    traces = await asyncio.to_thread(
+        query_traces, filters, parse_trace_time(since), parse_trace_time(until), limit, before_id
+    )
+    return {
+        "traces": traces,
+        "count": len(traces),
+        "next_before_id": traces[-1]["id"] if len(traces) == limit else None,
+    }
+
+
+@app.get("/traces/stats")
+async def trace_stats(
+    windows: str = TRACE_STATS_WINDOWS,
+    until: Optional[str] = None,
+    event_type: Optional[str] = None,
+    intent: Optional[str] = None,
+):
+    """p50/p95/p99 ของ latency แยกตาม event_type และ intent ในแต่ละช่วงเวลาย้อนหลัง"""
+    filters = {"event_type": event_type, "intent": intent}
+    until_at = parse_trace_time(until)
+    end = datetime.fromisoformat(until_at) if until_at else datetime.utcnow()
+    results: Dict[str, Any] = {}
+    for label in [entry.strip() for entry in windows.split(",") if entry.strip()]:
+        since_at = (end - parse_trace_duration(label)).isoformat(timespec="milliseconds")
+        results[label] = {
+            "since": since_at,
+            **await asyncio.to_thread(trace_latency_stats, filters, since_at, until_at),
+        }
+    return {"until": end.isoformat(timespec="milliseconds"), "windows": results}
+
+
 @app.get("/metrics")
 async def metrics():
     payload = generate_latest()
@@ -0,0 +1,35 @@
+"""fixture กลางของ front_dude: ชี้ path ข้อมูลไป temp dir ก่อน import main"""
+
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+SERVICE_DIR = Path(__file__).resolve().parents[1]
+_DATA_DIR = Path(tempfile.mkdtemp(prefix="front_dude_test_"))
+
+os.environ.setdefault("FRONT_CONFIG_ROOT", str(_DATA_DIR / "config"))
+os.environ.setdefault("FRONT_TRACE_DB_PATH", str(_DATA_DIR / "telemetry" / "front_traces.db"))
+os.environ.setdefault("TRACE_ARCHIVE_DIR", str(_DATA_DIR / "telemetry" / "archive"))
+
+
+def _load_service():
+    # โหลดเป็นชื่อเฉพาะ กันชนกับ main.py ของ service อื่นใน session เดียวกัน
+    spec = importlib.util.spec_from_file_location("front_dude_main", SERVICE_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+_service = _load_service()
+
+
+@pytest.fixture(scope="session")
+def front_main():
+    return _service
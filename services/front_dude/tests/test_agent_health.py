@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def health_checks(front_main, monkeypatch):
+    monkeypatch.setattr(front_main, "_agent_health", {})
+    monkeypatch.setattr(
+        front_main, "_agent_health_state", {"refreshed_at": 0.0, "started_at": float("-inf")}
+    )
+    monkeypatch.setattr(front_main, "_agent_health_lock", asyncio.Lock())
+    tool = front_main.ToolDefinition(
+        intent="test.health", name="test", method="GET_JSON", url="http://upstream/ready"
+    )
+    monkeypatch.setattr(front_main.tool_registry, "list_by_category", lambda category: [tool])
+    checks = []
+
+    async def fake_check(tool):
+        checks.append(tool.intent)
+        await asyncio.sleep(0.01)
+        return {"ok": True, "_checked_monotonic": front_main.time.monotonic()}
+
+    monkeypatch.setattr(front_main, "check_agent", fake_check)
+    return checks
+
+
+def test_concurrent_fresh_requests_share_refreshes(front_main, health_checks):
+    async def scenario():
+        return await asyncio.gather(*(front_main.agents_health(fresh=True) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    # รอบแรก + รอบเดียวสำหรับคำขอที่มาระหว่างรอบแรก ไม่ใช่หนึ่งรอบต่อคำขอ
+    assert len(health_checks) == 2
+    assert all(result["ok"] for result in results)
+    assert [result["cached"] for result in results].count(False) == 2
+
+
+def test_fresh_request_after_refresh_checks_again(front_main, health_checks):
+    asyncio.run(front_main.agents_health(fresh=True))
+    asyncio.run(front_main.agents_health(fresh=True))
+    assert len(health_checks) == 2
+
+
+def test_cached_request_does_not_check(front_main, health_checks):
+    asyncio.run(front_main.agents_health())
+    result = asyncio.run(front_main.agents_health())
+    assert len(health_checks) == 1
+    assert result["cached"] is True
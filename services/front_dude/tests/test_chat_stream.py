@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+
+def _events(body):
+    events = []
+    for block in body.split("\n\n"):
+        lines = block.splitlines()
+        if len(lines) == 2 and lines[0].startswith("event: "):
+            events.append((lines[0][7:], json.loads(lines[1][6:])))
+    return events
+
+
+@pytest.fixture
+def run_chat(front_main, monkeypatch):
+    async def no_sources(route_info, intent_payload):
+        return []
+
+    monkeypatch.setattr(front_main, "fetch_sources", no_sources)
+
+    def run(stream):
+        monkeypatch.setattr(front_main, "stream_llm_answer", stream)
+
+        async def collect():
+            response = await front_main.chat_stream(front_main.ChatRequest(message="hello there"))
+            return "".join([chunk async for chunk in response.body_iterator])
+
+        return _events(asyncio.run(collect()))
+
+    return run
+
+
+def test_stream_failure_after_tokens_marks_answer_truncated(run_chat):
+    async def broken_stream(*args, **kwargs):
+        yield "partial "
+        raise RuntimeError("ollama connection reset")
+
+    events = run_chat(broken_stream)
+    assert [name for name, _ in events] == ["routing", "sources", "token", "complete"]
+    complete = events[-1][1]
+    assert complete["answer"] == "partial"
+    assert complete["truncated"] is True
+
+
+def test_complete_stream_is_not_truncated(run_chat):
+    async def stream(*args, **kwargs):
+        yield "full "
+        yield "answer"
+
+    complete = run_chat(stream)[-1][1]
+    assert complete["answer"] == "full answer"
+    assert complete["truncated"] is False
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import pytest
+
+
+@pytest.fixture()
+def breaker(front_main):
+    tool = front_main.ToolDefinition(
+        intent="test.breaker",
+        name="test",
+        method="POST",
+        url="http://upstream/test",
+        breaker_failure_rate=0.5,
+        breaker_min_calls=4,
+        breaker_slow_seconds=2.0,
+        breaker_open_seconds=30.0,
+    )
+    return front_main.CircuitBreaker(tool)
+
+
+def _expire_open_window(breaker):
+    breaker.opened_at -= breaker.tool.breaker_open_seconds + 1
+
+
+def test_stays_closed_below_min_calls(breaker):
+    for _ in range(3):
+        assert breaker.before_call() is False
+        breaker.record(False, True, 0.1)
+    assert breaker.state == "closed"
+
+
+def test_opens_when_failure_rate_reaches_threshold(front_main, breaker):
+    for failed in (False, True, False, True):
+        breaker.record(breaker.before_call(), failed, 0.1)
+    assert breaker.state == "open"
+    with pytest.raises(front_main.CircuitOpenError):
+        breaker.before_call()
+    assert breaker.snapshot()["retry_in_seconds"] > 0
+
+
+def test_slow_calls_count_as_failures(breaker):
+    for _ in range(4):
+        breaker.record(breaker.before_call(), False, 5.0)
+    assert breaker.state == "open"
+
+
+def _open(breaker):
+    for _ in range(4):
+        breaker.record(breaker.before_call(), True, 0.1)
+    assert breaker.state == "open"
+
+
+def test_half_open_lets_one_probe_through(front_main, breaker):
+    _open(breaker)
+    _expire_open_window(breaker)
+    assert breaker.before_call() is True
+    assert breaker.state == "half_open"
+    with pytest.raises(front_main.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_successful_probe_closes_and_resets_window(breaker):
+    _open(breaker)
+    _expire_open_window(breaker)
+    probe = breaker.before_call()
+    breaker.record(probe, False, 0.1)
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["window_calls"] == 0
+    assert breaker.before_call() is False
+
+
+def test_failed_probe_reopens(front_main, breaker):
+    _open(breaker)
+    _expire_open_window(breaker)
+    probe = breaker.before_call()
+    breaker.record(probe, True, 0.1)
+    assert breaker.state == "open"
+    with pytest.raises(front_main.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_released_probe_allows_next_probe(breaker):
+    _open(breaker)
+    _expire_open_window(breaker)
+    assert breaker.before_call() is True
+    breaker.release_probe()
+    assert breaker.before_call() is True
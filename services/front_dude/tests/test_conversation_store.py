@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import pytest
+
+
+@pytest.fixture()
+def store(front_main, monkeypatch):
+    store = front_main.ConversationStore(ttl_seconds=60, max_sessions=2)
+    monkeypatch.setattr(front_main, "conversations", store)
+    return store
+
+
+def test_expired_session_is_dropped(store):
+    store.record_turn("s1", "m1", "q", "a", [1, 2], max_history=6)
+    assert store.get("s1") is not None
+    store._sessions["s1"].updated_at -= 61
+    assert store.get("s1") is None
+    assert len(store) == 0
+
+
+def test_least_recent_session_is_evicted(store):
+    store.record_turn("s1", "m1", "q", "a", None, max_history=6)
+    store.record_turn("s2", "m1", "q", "a", None, max_history=6)
+    store.record_turn("s1", "m1", "q2", "a2", None, max_history=6)
+    store.record_turn("s3", "m1", "q", "a", None, max_history=6)
+    assert store.get("s2") is None
+    assert store.get("s1") is not None and store.get("s3") is not None
+
+
+def test_history_is_trimmed_and_disabled_without_budget(store):
+    for turn in range(4):
+        store.record_turn("s1", "m1", f"q{turn}", f"a{turn}", None, max_history=4)
+    assert [message["content"] for message in store.get("s1").messages] == ["q2", "a2", "q3", "a3"]
+    store.record_turn("s2", "m1", "q", "a", None, max_history=0)
+    assert store.get("s2") is None
+
+
+def test_context_is_reused_only_for_same_model(front_main, store):
+    store.record_turn("s1", "m1", "q", "a", [1, 2], max_history=6)
+    assert front_main.conversation_inputs("s1", "m1") == ([], [1, 2])
+    history, context = front_main.conversation_inputs("s1", "m2")
+    assert context is None
+    assert [message["role"] for message in history] == ["user", "assistant"]
+
+
+def test_context_turns_restart_when_model_changes(store):
+    store.record_turn("s1", "m1", "q1", "a1", [1], max_history=6)
+    store.record_turn("s1", "m1", "q2", "a2", [1, 2], max_history=6)
+    assert store.get("s1").context_turns == 2
+    store.record_turn("s1", "m2", "q3", "a3", [9], max_history=6)
+    state = store.get("s1")
+    assert (state.model, state.context, state.context_turns) == ("m2", [9], 1)
+
+
+def test_context_resets_once_it_outgrows_history(store):
+    for turn in range(1, 4):
+        store.record_turn("s1", "m1", "q", "a", list(range(turn)), max_history=4)
+    state = store.get("s1")
+    assert state.context is None and state.context_turns == 0
+    assert len(state.messages) == 4
+
+
+def test_turn_without_context_clears_previous_context(store):
+    store.record_turn("s1", "m1", "q1", "a1", [1], max_history=6)
+    store.record_turn("s1", "m1", "q2", "a2", None, max_history=6)
+    state = store.get("s1")
+    assert state.context is None and state.context_turns == 0
+
+
+def test_clear_removes_session(front_main, store):
+    store.record_turn("s1", "m1", "q", "a", [1], max_history=6)
+    assert store.clear("s1") is True
+    assert store.clear("s1") is False
+    assert front_main.conversation_inputs("s1", "m1") == ([], None)
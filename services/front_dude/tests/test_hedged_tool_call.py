@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def slow_upstream(front_main, monkeypatch):
+    monkeypatch.setattr(front_main, "_lane_limiters", {})
+    calls = []
+
+    async def fake_call(tool, payload, **kwargs):
+        calls.append(payload)
+        await asyncio.sleep(0.05 if len(calls) == 1 else 0.0)
+        return {"call": len(calls)}
+
+    monkeypatch.setattr(front_main, "_call_tool", fake_call)
+    return calls
+
+
+def _tool(front_main, max_concurrency):
+    return front_main.ToolDefinition(
+        intent=f"test.hedge.{max_concurrency}",
+        name="test",
+        method="POST_JSON",
+        url="http://upstream/query",
+        hedge=True,
+        max_concurrency=max_concurrency,
+    )
+
+
+def test_hedge_is_skipped_when_lane_has_no_free_slot(front_main, slow_upstream):
+    tool = _tool(front_main, 1)
+
+    async def scenario():
+        async with front_main.lane_slot(tool.intent, tool.max_concurrency):
+            return await front_main.hedged_tool_call(tool, {"q": "x"}, delay_ms=1)
+
+    assert asyncio.run(scenario()) == {"call": 1}
+    assert len(slow_upstream) == 1
+
+
+def test_hedge_takes_and_returns_its_own_slot(front_main, slow_upstream):
+    tool = _tool(front_main, 2)
+
+    async def scenario():
+        async with front_main.lane_slot(tool.intent, tool.max_concurrency):
+            result = await front_main.hedged_tool_call(tool, {"q": "x"}, delay_ms=1)
+            await asyncio.sleep(0)
+            return result, front_main.lane_limiter(tool.intent, tool.max_concurrency).active
+
+    assert asyncio.run(scenario()) == ({"call": 2}, 1)
+    assert len(slow_upstream) == 2
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+
+def test_waiters_are_served_by_lane_priority(front_main):
+    limiter = front_main.LaneLimiter("test.lanes", 1)
+    order = []
+
+    async def worker(lane):
+        async with limiter.slot(lane):
+            order.append(lane)
+
+    async def scenario():
+        await limiter.acquire("chat")
+        tasks = [asyncio.create_task(worker(lane)) for lane in ("upload", "search", "webhook")]
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ["webhook", "search", "upload"]
+    assert limiter.active == 0
+
+
+def test_full_queue_is_shed_with_429(front_main, monkeypatch):
+    monkeypatch.setitem(front_main.LANE_QUEUE_MAX, "search", 1)
+    limiter = front_main.LaneLimiter("test.queue_full", 1)
+
+    async def scenario():
+        await limiter.acquire("search")
+        queued = asyncio.create_task(limiter.acquire("search"))
+        await asyncio.sleep(0)
+        with pytest.raises(front_main.LaneShedError) as excinfo:
+            await limiter.acquire("search")
+        limiter.release()
+        await queued
+        limiter.release()
+        return excinfo.value.status_code
+
+    assert asyncio.run(scenario()) == 429
+    assert limiter.active == 0
+
+
+def test_queue_deadline_is_shed_with_503(front_main, monkeypatch):
+    monkeypatch.setitem(front_main.LANE_QUEUE_TIMEOUTS, "chat", 0.01)
+    limiter = front_main.LaneLimiter("test.deadline", 1)
+
+    async def scenario():
+        await limiter.acquire("chat")
+        with pytest.raises(front_main.LaneShedError) as excinfo:
+            await limiter.acquire("chat")
+        limiter.release()
+        return excinfo.value.status_code
+
+    assert asyncio.run(scenario()) == 503
+    assert limiter.active == 0
+    assert limiter._depth["chat"] == 0
+
+
+def test_cancelled_waiter_does_not_leak_slot(front_main):
+    limiter = front_main.LaneLimiter("test.cancel", 1)
+
+    async def scenario():
+        await limiter.acquire("chat")
+        waiter = asyncio.create_task(limiter.acquire("chat"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        limiter.release()
+        await asyncio.wait_for(limiter.acquire("chat"), 1)
+        limiter.release()
+
+    asyncio.run(scenario())
+    assert limiter.active == 0
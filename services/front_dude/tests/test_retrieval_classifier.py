@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import copy
+
+import pytest
+
+
+@pytest.fixture()
+def retrieval_cfg(front_main):
+    return copy.deepcopy(front_main.DEFAULT_MODEL_CONFIG["retrieval"])
+
+
+def classify(front_main, message, cfg, *, has_code=False, thai_heavy=True):
+    return front_main._classify_retrieval(message, cfg, has_code=has_code, thai_heavy=thai_heavy)
+
+
+@pytest.mark.parametrize(
+    "message",
+    ["สวัสดีครับ", "ขอบคุณมากค่ะ", "hi!", "Thanks, bye"],
+)
+def test_smalltalk_skips_retrieval(front_main, retrieval_cfg, message):
+    assert classify(front_main, message, retrieval_cfg) == (False, "smalltalk")
+
+
+def test_greeting_followed_by_question_still_retrieves(front_main, retrieval_cfg):
+    message = "สวัสดีครับ อยากทราบขั้นตอนการลา"
+    assert classify(front_main, message, retrieval_cfg) == (True, "default")
+
+
+def test_english_keyword_matches_whole_words_only(front_main, retrieval_cfg):
+    assert classify(front_main, "this is odd", retrieval_cfg, thai_heavy=False) == (True, "default")
+
+
+def test_code_only_message_skips_retrieval(front_main, retrieval_cfg):
+    message = "def add(a, b): return a + b"
+    assert classify(front_main, message, retrieval_cfg, has_code=True, thai_heavy=False) == (
+        False,
+        "code_only",
+    )
+    assert classify(front_main, message, retrieval_cfg, has_code=True, thai_heavy=True)[0] is True
+
+
+def test_force_keyword_wins_over_code_and_smalltalk(front_main, retrieval_cfg):
+    assert classify(front_main, "ขอบคุณ ส่งไฟล์มาด้วย", retrieval_cfg) == (True, "force_keyword")
+    assert classify(front_main, "import pdf", retrieval_cfg, has_code=True, thai_heavy=False) == (
+        True,
+        "force_keyword",
+    )
+
+
+def test_short_and_arithmetic_messages_skip(front_main, retrieval_cfg):
+    assert classify(front_main, "ครับ", retrieval_cfg) == (False, "too_short")
+    assert classify(front_main, "12 * 4 = ?", retrieval_cfg) == (False, "skip_pattern")
+
+
+def test_invalid_skip_pattern_is_ignored(front_main, retrieval_cfg):
+    retrieval_cfg["skip_patterns"] = ["("]
+    assert classify(front_main, "นโยบายวันหยุด", retrieval_cfg)[0] is True
+    assert classify(front_main, "ราคาเท่าไหร่", retrieval_cfg) == (True, "default")
+
+
+def test_classifier_can_be_disabled(front_main, retrieval_cfg):
+    retrieval_cfg["classifier_enabled"] = False
+    assert classify(front_main, "สวัสดี", retrieval_cfg) == (True, "classifier_disabled")
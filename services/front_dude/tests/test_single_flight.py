@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+
+def test_single_flight_key_is_order_independent(front_main):
+    a = front_main.single_flight_key("doc.query", {"q": "x", "top_k": 4})
+    b = front_main.single_flight_key("doc.query", {"top_k": 4, "q": "x"})
+    assert a == b
+    assert a != front_main.single_flight_key("doc.query", {"q": "y", "top_k": 4})
+
+
+def test_concurrent_callers_share_one_call(front_main):
+    flight = front_main.SingleFlight()
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"value": 42}
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do("k", "test", factory) for _ in range(5)))
+        return results
+
+    results = asyncio.run(scenario())
+    assert calls == [1]
+    assert all(result is results[0] for result in results)
+    assert flight.in_flight() == 0
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call(front_main):
+    flight = front_main.SingleFlight()
+    release = None
+
+    async def factory():
+        await release.wait()
+        return "done"
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        first = asyncio.create_task(flight.do("k", "test", factory))
+        second = asyncio.create_task(flight.do("k", "test", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await second, first.cancelled()
+
+    assert asyncio.run(scenario()) == ("done", True)
+
+
+def test_call_is_cancelled_when_every_waiter_leaves(front_main):
+    flight = front_main.SingleFlight()
+    state = {}
+
+    async def factory():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def scenario():
+        waiters = [asyncio.create_task(flight.do("k", "test", factory)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert state == {"cancelled": True}
+    assert flight.in_flight() == 0
+
+
+def test_error_reaches_every_waiter(front_main):
+    flight = front_main.SingleFlight()
+
+    async def factory():
+        await asyncio.sleep(0)
+        raise RuntimeError("upstream down")
+
+    async def scenario():
+        return await asyncio.gather(
+            *(flight.do("k", "test", factory) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+    assert [str(result) for result in results] == ["upstream down"] * 3
+
+
+def test_stream_fans_out_and_replays_for_late_joiner(front_main):
+    flight = front_main.SingleFlight()
+    started = []
+    gate = None
+
+    async def factory():
+        started.append(1)
+        yield "a"
+        await gate.wait()
+        yield "b"
+
+    async def collect():
+        return [item async for item in flight.stream("k", "test", factory)]
+
+    async def scenario():
+        nonlocal gate
+        gate = asyncio.Event()
+        first = asyncio.create_task(collect())
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(collect())
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await first, await second
+
+    assert asyncio.run(scenario()) == (["a", "b"], ["a", "b"])
+    assert started == [1]
+    assert flight.in_flight() == 0
+
+
+def test_stream_cancelled_when_last_subscriber_leaves(front_main):
+    flight = front_main.SingleFlight()
+    state = {}
+
+    async def factory():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def scenario():
+        async def read_one():
+            async for item in flight.stream("k", "test", factory):
+                return item
+
+        assert await read_one() == "a"
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert state == {"cancelled": True}
+    assert flight.in_flight() == 0
+
+
+def test_stream_error_reaches_subscribers(front_main):
+    flight = front_main.SingleFlight()
+
+    async def factory():
+        yield "a"
+        raise RuntimeError("broken stream")
+
+    async def collect():
+        items = []
+        with pytest.raises(RuntimeError, match="broken stream"):
+            async for item in flight.stream("k", "test", factory):
+                items.append(item)
+        return items
+
+    async def scenario():
+        return await asyncio.gather(collect(), collect())
+
+    assert asyncio.run(scenario()) == [["a"], ["a"]]
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import gzip
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def trace_db(front_main, tmp_path, monkeypatch):
+    monkeypatch.setattr(front_main, "TRACE_DB_PATH", tmp_path / "traces.db")
+    monkeypatch.setattr(front_main, "TRACE_ARCHIVE_DIR", tmp_path / "archive")
+    (tmp_path / "archive").mkdir()
+    front_main.init_trace_db()
+    return tmp_path / "traces.db"
+
+
+def _insert(front_main, path, created_at, latency_ms, intent="doc.query"):
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            front_main.TRACE_INSERT_SQL,
+            (
+                created_at.isoformat(timespec="milliseconds"),
+                "endpoint",
+                None,
+                intent,
+                "{}",
+                json.dumps({"status": "success"}),
+                latency_ms,
+            ),
+        )
+
+
+def test_new_trace_db_is_incremental_without_vacuum(front_main, trace_db):
+    with sqlite3.connect(trace_db) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def test_legacy_trace_db_is_converted_only_on_request(front_main, tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE legacy (value TEXT)")
+    monkeypatch.setattr(front_main, "TRACE_DB_PATH", path)
+
+    front_main.init_trace_db()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    assert front_main._convert_trace_auto_vacuum() is True
+    assert front_main._convert_trace_auto_vacuum() is False
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def test_archive_rewrites_same_rows_instead_of_appending(front_main, trace_db):
+    day = datetime(2026, 1, 5, 10, 0)
+    for offset in range(3):
+        _insert(front_main, trace_db, day + timedelta(minutes=offset), 100.0)
+    with sqlite3.connect(trace_db) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM traces ORDER BY id").fetchall()
+
+    first = front_main._archive_trace_rows("endpoint", "2026-01-05", rows)
+    second = front_main._archive_trace_rows("endpoint", "2026-01-05", rows)
+
+    assert first == second
+    assert [path.name for path in first.parent.iterdir()] == [first.name]
+    with gzip.open(first, "rt", encoding="utf-8") as handle:
+        assert len(handle.readlines()) == 3
+
+
+def test_stats_include_compacted_minutes(front_main, trace_db):
+    now = datetime.utcnow().replace(microsecond=0)
+    old = now - timedelta(hours=2)
+    for latency in (40.0, 90.0, 400.0):
+        _insert(front_main, trace_db, old, latency)
+    _insert(front_main, trace_db, now - timedelta(minutes=1), 20.0)
+
+    cutoff = (now - timedelta(hours=1)).isoformat(timespec="milliseconds")
+    assert front_main._compact_trace_day("endpoint", cutoff) == 3
+
+    since = (now - timedelta(hours=3)).isoformat(timespec="milliseconds")
+    stats = front_main.trace_latency_stats(
+        {"event_type": None, "intent": None}, since, None
+    )
+    endpoint = stats["by_event_type"]["endpoint"]
+    assert endpoint["count"] == 4
+    assert endpoint["max"] == 400.0
+    assert endpoint["p50"] == 50.0
+    assert stats["by_intent"]["doc.query"]["count"] == 4
+
+    recent = (now - timedelta(minutes=30)).isoformat(timespec="milliseconds")
+    only_raw = front_main.trace_latency_stats({"event_type": None, "intent": None}, recent, None)
+    assert only_raw["by_event_type"]["endpoint"] == front_main.latency_percentiles([20.0])
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+
+
+def test_trace_writer_survives_unexpected_write_error(front_main, tmp_path, monkeypatch):
+    path = tmp_path / "traces.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE t (value TEXT)")
+    writer = front_main.TraceWriter(path, "INSERT INTO t (value) VALUES (?)")
+    original = writer._write_batch
+    calls = []
+
+    def flaky_write(batch):
+        calls.append(len(batch))
+        if len(calls) == 1:
+            raise ValueError("unexpected")
+        original(batch)
+
+    monkeypatch.setattr(writer, "_write_batch", flaky_write)
+    monkeypatch.setattr(front_main, "TRACE_FLUSH_SECONDS", 0.01)
+
+    async def scenario():
+        await writer.start()
+        writer.submit(("lost",))
+        await asyncio.sleep(0.05)
+        writer.submit(("kept",))
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert len(calls) == 2
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT value FROM t").fetchall() == [("kept",)]
@@ -91,7 +91,8 @@ const featureDefaults = {
   task_orchestration_enabled: true,
   tool_registry_validation: true,
   structured_logging_enabled: true,
-  eval_trace_enabled: true
+  eval_trace_enabled: true,
+  request_coalescing_enabled: true
 }
 
 const featureItems = [
@@ -114,6 +115,11 @@ const featureItems = [
     key: 'eval_trace_enabled',
     label: 'Eval / Trace Capture',
     description: 'บันทึก prompt, response และ latency เพื่อใช้วิเคราะห์'
+  },
+  {
+    key: 'request_coalescing_enabled',
+    label: 'Request Coalescing',
+    description: 'รวมคำขอที่เหมือนกันซึ่งเกิดพร้อมกันให้ยิง doc_dude / Ollama เพียงครั้งเดียว'
   }
 ]
 
@@ -167,6 +173,9 @@ export default function App() {
   const [activeTab, setActiveTab] = useState('chat')
   const [input, setInput] = useState('')
   const [chatHistory, setChatHistory] = useState([])
+  const [sessionId] = useState(() =>
+    window.crypto?.randomUUID ? window.crypto.randomUUID() : `web-${Date.now()}-${Math.random().toString(16).slice(2)}`
+  )
   const [streaming, setStreaming] = useState(false)
   const [streamSources, setStreamSources] = useState([])
   const [lastCorrelation, setLastCorrelation] = useState('')
@@ -348,7 +357,7 @@ export default function App() {
       const res = await fetch('/api/chat', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ message, mode, top_k: 4 })
+        body: JSON.stringify({ message, mode, top_k: 4, session_id: `web:${sessionId}` })
       })
       const cid = res.headers.get('X-Correlation-ID') || ''
       if (cid) setLastCorrelation(cid)
@@ -379,7 +388,7 @@ export default function App() {
             continue
           }
           if (event === 'token') {
-            assistant = assistant ? `${assistant} ${payload.value}` : payload.value
+            assistant += payload.value
             setChatHistory((prev) => {
               const next = [...prev]
               next[next.length - 1] = { role: 'assistant', content: assistant }
@@ -387,6 +396,8 @@ export default function App() {
             })
           } else if (event === 'routing') {
             setLastRouting(payload)
+          } else if (event === 'sources') {
+            setStreamSources(payload.items || [])
           } else if (event === 'complete') {
             assistant = payload.answer || assistant
             setChatHistory((prev) => {
@@ -402,7 +413,6 @@ export default function App() {
               }
               return next
             })
-            setStreamSources(payload.sources || [])
             setLastRouting(payload)
           } else if (event === 'error') {
             setChatHistory((prev) => {
@@ -751,6 +761,11 @@ export default function App() {
             <div style={{ marginTop: 4, fontSize: 13, color: '#6b7280' }}>
               ตรวจพบโค้ด: {lastRouting.has_code ? 'ใช่' : 'ไม่'} · ไทยเข้มข้น: {lastRouting.thai_heavy ? 'ใช่' : 'ไม่'}
             </div>
+            {lastRouting.retrieval && (
+              <div style={{ marginTop: 4, fontSize: 13, color: '#6b7280' }}>
+                ค้นฐานความรู้: {lastRouting.retrieval.needed ? 'ใช่' : 'ข้าม'} ({lastRouting.retrieval.reason})
+              </div>
+            )}
             {lastRouting.context && (
               <div style={{ marginTop: 8, fontSize: 12, color: '#6366f1' }}>บริบทที่ใช้: {lastRouting.context}</div>
             )}